@@ -1,18 +1,119 @@
+import json
+import os
+import time
 import requests
 import pytz
 
-SPOT_ENDPOINT = "https://min-api.cryptocompare.com/data/pricemulti"
-HISTORICAL_ENDPOINT = "https://min-api.cryptocompare.com/data/pricehistorical"
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# The API can be pointed at a local stand-in server with MISTBAT_PRICE_API
+API_ROOT = "https://min-api.cryptocompare.com"
+SPOT_PATH = "/data/pricemulti"
+HISTORICAL_PATH = "/data/pricehistorical"
+
+# (connect, read) timeouts in seconds
+TIMEOUT = (3.05, 15)
+# Responses worth retrying, with exponential backoff starting at BACKOFF seconds
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRIES = 5
+BACKOFF = 0.5
+
+_session = None
+
+
+def get_session():
+    """Return the process-wide session, so requests reuse pooled keep-alive
+    connections instead of opening a new one each time."""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8)
+        _session.mount("https://", adapter)
+        _session.mount("http://", adapter)
+    return _session
+
+
+def _request_key(path, params):
+    return path + "?" + json.dumps(params, sort_keys=True)
+
+
+def _get_json(path, params):
+    """GET an API path and return the decoded JSON, retrying timeouts, dropped
+    connections, 429s and 5xx responses with exponential backoff.
+
+    With MISTBAT_HTTP_REPLAY set to a file recorded earlier, responses come from
+    that file and the network is never touched. With MISTBAT_HTTP_RECORD set,
+    responses are also saved to that file for later replay."""
+    key = _request_key(path, params)
+    replay = os.environ.get("MISTBAT_HTTP_REPLAY")
+    if replay:
+        recorded = read_json_file(replay)
+        if key not in recorded:
+            raise KeyError(f"No recorded response for {key} in {replay}")
+        return recorded[key]
+
+    url = os.environ.get("MISTBAT_PRICE_API", API_ROOT) + path
+    for attempt in range(RETRIES + 1):
+        delay = BACKOFF * 2 ** attempt
+        try:
+            r = get_session().get(url, params=params, timeout=TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == RETRIES:
+                raise
+        else:
+            if r.status_code not in RETRY_STATUSES or attempt == RETRIES:
+                break
+            # Honour the server's own idea of when to come back
+            retry_after = r.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+        time.sleep(delay)
+
+    r.raise_for_status()
+    data = r.json()
+    record = os.environ.get("MISTBAT_HTTP_RECORD")
+    if record:
+        merge_json_file(record, {key: data})
+    return data
+
+
+def read_json_file(filename):
+    """Return the JSON object in the file, or {} if it is missing or corrupt."""
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def merge_json_file(filename, entries):
+    """Merge entries into the JSON object on disk and replace the file
+    atomically, so processes sharing the file never see a partial write.
+    The read-merge-replace holds an exclusive lock on a sidecar lock file
+    (where fcntl is available) so concurrent merges don't drop each other's
+    entries."""
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    with open(filename + ".lock", "a") as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        merged = read_json_file(filename)
+        merged.update(entries)
+        tmp = f"{filename}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(merged, f)
+        os.replace(tmp, filename)
 
 
 def get_coin_spot_prices(coins):
     params = {
-        "fsyms": coins,
-        "tsyms": ["USD"],
+        "fsyms": ",".join(sorted(coins)),
+        "tsyms": "USD",
         "extraParams": "mistbat"
     }
-    r = requests.get(url=SPOT_ENDPOINT, params=params)
-    data = r.json()
+    data = _get_json(SPOT_PATH, params)
     return {coin: data[coin]["USD"] for coin in data}
 
 
@@ -25,7 +126,6 @@ def get_historical_close(coin, ts):
         "extraParams": "mistbat",
     }
 
-    r = requests.get(url=HISTORICAL_ENDPOINT, params=params)
-    data = r.json()
+    data = _get_json(HISTORICAL_PATH, params)
 
     return data[coin]["USD"]
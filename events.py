@@ -3,6 +3,9 @@ import dateutil.parser
 import datetime
 import pytz
 import hashlib
+from units import to_units, from_units
+
+AMOUNT_FIELDS = ("amount", "buy_amount", "sell_amount", "fee_amount")
 
 
 class Event:
@@ -34,14 +37,27 @@ class Event:
         # Generate unique ID based on available info
         self.generate_id()
 
+        # Store amounts as integer base units. This happens after the id is
+        # generated so ids stay the same as when amounts were floats.
+        for name in AMOUNT_FIELDS:
+            if hasattr(self, name):
+                setattr(self, name, to_units(getattr(self, name)))
+
         # Get rid of any sub-second resolution
         self.time = self.time.replace(microsecond=0)
 
     def generate_id(self):
-        id = self.location[:3]
+        """Set the event id and the shorter legacy id it used to be known by.
+        Ids are the location prefix and 12 hex chars of a SHA-256 hash, either
+        of the exchange-provided id or of the event data. Exchanges that only
+        number their trades give the trade number as trade_id, which is hashed
+        along with the event data so that otherwise identical fills differ."""
+        prefix = self.location[:3]
         # If there's an id provided by the exchange leverage that
         if hasattr(self, "location_id"):
-            id += "-" + self.location_id[-5:]
+            digest = hashlib.sha256(self.location_id.encode()).hexdigest()
+            self.id = prefix + "-" + digest[-12:]
+            self.legacy_id = prefix + "-" + self.location_id[-5:]
         # Otherwise, hash a few things we have to get the id
         else:
             hashstr = (
@@ -56,8 +72,12 @@ class Event:
                 + str(getattr(self, "sell_amount", ""))
                 + getattr(self, "txid", "")
             )
-            id += "-" + hashlib.sha256(hashstr.encode()).hexdigest()[-5:]
-        self.id = id
+            legacy_digest = hashlib.sha256(hashstr.encode()).hexdigest()
+            if hasattr(self, "trade_id"):
+                hashstr += str(self.trade_id)
+            digest = hashlib.sha256(hashstr.encode()).hexdigest()
+            self.id = prefix + "-" + digest[-12:]
+            self.legacy_id = prefix + "-" + legacy_digest[-5:]
 
 
 class Exchange(Event):
@@ -72,9 +92,9 @@ class Exchange(Event):
             self.time.strftime("%Y-%m-%d %H:%M:%S"),
             self.id,
             self.sell_coin,
-            self.sell_amount,
+            from_units(self.sell_amount),
             self.buy_coin,
-            self.buy_amount,
+            from_units(self.buy_amount),
         )
 
 
@@ -103,10 +123,10 @@ class FiatExchange(Exchange):
                 self.time.strftime("%Y-%m-%d %H:%M:%S"),
                 alt_id or self.id,
                 self.sell_coin,
-                self.sell_amount,
-                self.fee_amount,
+                from_units(self.sell_amount),
+                from_units(self.fee_amount),
                 self.buy_coin,
-                self.buy_amount,
+                from_units(self.buy_amount),
                 self.rate,
                 self.buy_coin,
             )
@@ -115,10 +135,10 @@ class FiatExchange(Exchange):
                 self.time.strftime("%Y-%m-%d %H:%M:%S"),
                 alt_id or self.id,
                 self.sell_coin,
-                self.sell_amount,
+                from_units(self.sell_amount),
                 self.buy_coin,
-                self.buy_amount,
-                self.fee_amount,
+                from_units(self.buy_amount),
+                from_units(self.fee_amount),
                 self.rate,
                 self.sell_coin,
             )
@@ -133,7 +153,7 @@ class Send(Event):
             self.time.strftime("%Y-%m-%d %H:%M:%S"),
             self.id,
             self.coin,
-            self.amount,
+            from_units(self.amount),
             self.location,
         )
 
@@ -147,15 +167,43 @@ class Receive(Event):
             self.time.strftime("%Y-%m-%d %H:%M:%S"),
             self.id,
             self.coin,
-            self.amount,
+            from_units(self.amount),
             self.location,
         )
 
 
-def get_events(loaders, typ=None, remote_update=False):
+def build_aliases(items):
+    """Map every id that events or transactions are known by, current or legacy,
+    to the item. Legacy ids shared by more than one item map to None."""
+    aliases = {}
+    for item in items:
+        if item.legacy_id in aliases and aliases[item.legacy_id] is not item:
+            aliases[item.legacy_id] = None
+        else:
+            aliases[item.legacy_id] = item
+    for item in items:
+        aliases[item.id] = item
+    return aliases
+
+
+def lookup(aliases, id):
+    """Return the event or transaction known by the id, current or legacy.
+    Raises KeyError for unknown ids."""
+    if id not in aliases:
+        raise KeyError(id)
+    if aliases[id] is None:
+        raise Exception(
+            "Ambiguous legacy id: {}. Use the full id from lsev or lstx".format(id)
+        )
+    return aliases[id]
+
+
+def get_events(loaders, config_dir, data_dir, typ=None, remote_update=False):
     """Return events from exchange loaders.
     Args:
         loaders: A list of all the loader modules to be used.
+        config_dir: Directory holding the portfolio's config (e.g., manual_obs.yaml).
+        data_dir: Directory holding the portfolio's raw exchange data.
         typ: A filter for specific event types (e.g., 'Send')
         remote_update: Poll the exchange APIs and update the transaction records.
 
@@ -167,10 +215,15 @@ def get_events(loaders, typ=None, remote_update=False):
     for loader in loaders:
         if remote_update:
             print("Remote update from {}".format(loader.__name__))
-            loader.update_from_remote()
-        all_events.extend(loader.parse_events())
-
-    # TODO: confirm all events have unique id attribute
+            loader.update_from_remote(config_dir, data_dir)
+        all_events.extend(loader.parse_events(config_dir, data_dir))
+
+    # Confirm all events have a unique id
+    seen = set()
+    for ev in all_events:
+        if ev.id in seen:
+            raise Exception("Duplicate event id: {}".format(ev.id))
+        seen.add(ev.id)
 
     # Sort all events by time
     all_events.sort(key=lambda x: x.time)
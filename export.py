@@ -0,0 +1,215 @@
+import csv
+import datetime
+import json
+from ledger import event_entries
+from units import from_units
+
+FORM_8949_FORMATS = ["csv", "txf", "json"]
+FORM_8949_HEADINGS = [
+    "Description",
+    "Date Acquired",
+    "Date Sold",
+    "Proceeds",
+    "Cost Basis",
+    "Gain",
+    "Term",
+]
+
+# TXF reference numbers for short-term and long-term gain/loss on a security
+TXF_CODES = {"short": "N321", "long": "N323"}
+
+
+def _form_8949_rows(form_8949, aggregated, year):
+    """Yield (term, row) for every non-blank row of Form 8949, short-term first"""
+    for term in ("short", "long"):
+        rows = form_8949.generate_form(term=term, aggregated=aggregated, year=year)
+        for row in rows:
+            if str(row[-1]).strip():
+                row = list(row)
+                row[0] = " ".join(row[0].split())  # Drop the table padding
+                yield term, row
+
+
+def _date(date, fmt):
+    """Format an acquisition or sale date, which may also be 'Various'"""
+    if isinstance(date, datetime.datetime):
+        return date.strftime(fmt)
+    return str(date)
+
+
+def write_form_8949(form_8949, fmt, f, aggregated=False, year=None):
+    """Stream the rows of Form 8949 to the file object f in the given format
+    as they are generated, followed by per-term totals.
+
+    Returns:
+        Dict of total gain by term.
+    """
+    totals = {"short": 0.00, "long": 0.00}
+    rows = _form_8949_rows(form_8949, aggregated, year)
+
+    if fmt == "csv":
+        writer = csv.writer(f)
+        writer.writerow(FORM_8949_HEADINGS)
+        for term, row in rows:
+            writer.writerow(
+                [
+                    row[0],
+                    _date(row[1], "%m/%d/%Y"),
+                    _date(row[2], "%m/%d/%Y"),
+                    f"{row[3]:0.2f}",
+                    f"{row[4]:0.2f}",
+                    f"{row[5]:0.2f}",
+                    term.upper(),
+                ]
+            )
+            totals[term] += row[5]
+        for term, total in totals.items():
+            label = f"TOTAL {term.upper()}-TERM"
+            writer.writerow([label, "", "", "", "", f"{total:0.2f}", term.upper()])
+
+    elif fmt == "txf":
+        f.write("V042\nAmistbat\n")
+        f.write("D{}\n^\n".format(datetime.date.today().strftime("%m/%d/%Y")))
+        for term, row in rows:
+            f.write(
+                "TD\n{}\nC1\nL1\nP{}\nD{}\nD{}\n${:0.2f}\n${:0.2f}\n^\n".format(
+                    TXF_CODES[term],
+                    row[0],
+                    _date(row[1], "%m/%d/%Y"),
+                    _date(row[2], "%m/%d/%Y"),
+                    row[4],
+                    row[3],
+                )
+            )
+            totals[term] += row[5]
+
+    elif fmt == "json":
+        f.write('{"rows": [')
+        separator = "\n"
+        for term, row in rows:
+            record = {
+                "description": row[0],
+                "date_acquired": _date(row[1], "%Y-%m-%dT%H:%M:%S%z"),
+                "date_sold": _date(row[2], "%Y-%m-%dT%H:%M:%S%z"),
+                "proceeds": row[3],
+                "basis": row[4],
+                "gain": row[5],
+                "term": term,
+            }
+            f.write(separator + json.dumps(record))
+            separator = ",\n"
+            totals[term] += row[5]
+        totals = {term: round(total, 2) for term, total in totals.items()}
+        f.write('\n], "totals": ' + json.dumps(totals) + "}\n")
+
+    else:
+        raise Exception("Unrecognized format: " + fmt)
+
+    return totals
+
+
+RECORD_FORMATS = ["jsonl", "tsv"]
+RECORD_FIELDS = [
+    "id",
+    "time",
+    "type",
+    "location",
+    "coins",
+    "amounts",
+    "fmvs",
+    "fee_usd",
+    "groups",
+    "notes",
+]
+
+
+def event_record(ev):
+    """Structured record of an event. Amounts are signed from the point of view
+    of the event's location and fees are included as a negative amount."""
+    entries = event_entries(ev)
+    fmvs = {}
+    fmv_attrs = (("fmv", "coin"), ("buy_fmv", "buy_coin"), ("sell_fmv", "sell_coin"))
+    for attr, coin_attr in fmv_attrs:
+        if getattr(ev, attr, None) is not None:
+            fmvs[getattr(ev, coin_attr)] = getattr(ev, attr)
+    fee_usd = None
+    if getattr(ev, "fee_with", None) == "USD":
+        fee_usd = from_units(ev.fee_amount)
+    return {
+        "id": ev.id,
+        "time": ev.time.isoformat(),
+        "type": ev.__class__.__name__,
+        "location": ev.location,
+        "coins": [entry[1] for entry in entries],
+        "amounts": [from_units(entry[2]) for entry in entries],
+        "fmvs": fmvs,
+        "fee_usd": fee_usd,
+        "groups": None,
+        "notes": None,
+    }
+
+
+def transaction_record(tx):
+    """Structured record of a transaction. Amounts are signed from the point of view
+    of the portfolio, so a SendReceive only shows the coins lost to fees."""
+    typ = tx.__class__.__name__
+    if typ == "Shapeshift":
+        coins = [tx.receive.coin, tx.send.coin]
+        amounts = [tx.receive.amount, -tx.send.amount]
+        fmvs = {tx.receive.coin: tx.receive_fmv, tx.send.coin: tx.send_fmv}
+        location = f"{tx.send.location}>{tx.receive.location}"
+    elif typ in ("ExchangeTx", "FiatExchangeTx"):
+        coins = [tx.buy_coin, tx.sell_coin]
+        amounts = [tx.buy_amount, -tx.sell_amount]
+        fmvs = {tx.buy_coin: tx.buy_fmv, tx.sell_coin: tx.sell_fmv}
+        if typ == "FiatExchangeTx":  # The fmv is the exchange rate
+            fmvs = {tx.buy_coin if tx.investing else tx.sell_coin: tx.rate}
+        location = tx.location
+    elif typ == "SendReceive":
+        coins = [tx.coin]
+        amounts = [-tx.implied_fee]
+        fmvs = {tx.coin: tx.fmv}
+        location = f"{tx.origin}>{tx.destination}"
+    else:
+        coins = [tx.coin]
+        amounts = [-tx.amount if typ == "Spend" else tx.amount]
+        fmvs = {tx.coin: tx.fmv}
+        location = tx.location
+
+    fee_usd = from_units(tx.fee_usd)
+
+    return {
+        "id": tx.id,
+        "time": tx.time.isoformat(),
+        "type": typ,
+        "location": location,
+        "coins": coins,
+        "amounts": [from_units(amount) for amount in amounts],
+        "fmvs": fmvs,
+        "fee_usd": fee_usd,
+        "groups": getattr(tx, "groups", None),
+        "notes": getattr(tx, "notes", None),
+    }
+
+
+def write_records(records, fmt, f):
+    """Stream records (dicts with RECORD_FIELDS) to the file object f, one per line"""
+    if fmt == "jsonl":
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+    elif fmt == "tsv":
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(RECORD_FIELDS)
+        for record in records:
+            record["coins"] = ",".join(record["coins"])
+            record["amounts"] = ",".join(str(amount) for amount in record["amounts"])
+            record["fmvs"] = " ".join(
+                f"{coin}@{fmv}" for coin, fmv in record["fmvs"].items()
+            )
+            writer.writerow(
+                ["" if record[f] is None else record[f] for f in RECORD_FIELDS]
+            )
+
+    else:
+        raise Exception("Unrecognized format: " + fmt)
@@ -0,0 +1,61 @@
+import bisect
+
+
+def _item_values(item, attrs):
+    """Collect the set of values of attrs on an event or transaction, including
+    those on the Send and Receive events wrapped by SendReceive and Shapeshift."""
+    values = set()
+    for obj in (item, getattr(item, "send", None), getattr(item, "receive", None)):
+        for attr in attrs:
+            val = getattr(obj, attr, None)
+            if val:
+                values.add(val)
+    return values
+
+
+class LedgerIndex(object):
+    """Time-sorted events or transactions with per-coin and per-location indexes.
+    A query bisects the time range and then only walks the narrowest index."""
+
+    def __init__(self, items):
+        self.items = sorted(items, key=lambda x: x.time)
+        self.times = [item.time for item in self.items]
+        self.by_coin = {}
+        self.by_location = {}
+        for pos, item in enumerate(self.items):
+            for coin in _item_values(item, ("coin", "buy_coin", "sell_coin")):
+                self.by_coin.setdefault(coin, []).append(pos)
+            for location in _item_values(item, ("location", "origin", "destination")):
+                self.by_location.setdefault(location, []).append(pos)
+
+    def query(self, since=None, until=None, coins=None, locations=None, types=None):
+        """Return the items at or after `since` and before `until` that involve
+        any of `coins`, any of `locations` and are any of `types` (class names).
+        Filters that are None or empty are ignored."""
+        lo = bisect.bisect_left(self.times, since) if since else 0
+        hi = bisect.bisect_left(self.times, until) if until else len(self.items)
+
+        # Positions within the time range for each index filter in use
+        candidates = []
+        for index, keys in ((self.by_coin, coins), (self.by_location, locations)):
+            if not keys:
+                continue
+            positions = set()
+            for key in keys:
+                key_positions = index.get(key, [])
+                start = bisect.bisect_left(key_positions, lo)
+                end = bisect.bisect_left(key_positions, hi)
+                positions.update(key_positions[start:end])
+            candidates.append(positions)
+
+        if candidates:
+            candidates.sort(key=len)
+            positions = sorted(candidates[0].intersection(*candidates[1:]))
+        else:
+            positions = range(lo, hi)
+
+        items = (self.items[pos] for pos in positions)
+        if types:
+            types = set(types)
+            items = (item for item in items if item.__class__.__name__ in types)
+        return list(items)
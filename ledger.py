@@ -0,0 +1,178 @@
+import dateutil.parser
+import itertools
+import json
+import os
+import events as events_module
+
+# Events are stored in one partition per year, by the year of the transaction
+# they belong to, so a SendReceive spanning New Year's stays in one partition.
+# Each year end also gets a checkpoint of the open lots and the balances.
+PARTITION_FILE = "events-{year}.json"
+CHECKPOINT_FILE = "checkpoint-{year}-{method}.json"
+# The lineage index traces every disposal back to the lots it used up
+LINEAGE_FILE = "lineage-{method}.json"
+
+
+def event_to_record(ev):
+    record = dict(ev.__dict__)
+    record["type"] = ev.__class__.__name__
+    record["time"] = ev.time.isoformat()
+    return record
+
+
+def event_from_record(record):
+    """Rebuild an event without going back through Event.__init__, which
+    would convert the already converted amounts and regenerate the id"""
+    record = dict(record)
+    cls = getattr(events_module, record.pop("type"))
+    ev = cls.__new__(cls)
+    ev.__dict__.update(record)
+    ev.time = dateutil.parser.parse(record["time"])
+    return ev
+
+
+def _tx_events(tx):
+    """The events a transaction was built from"""
+    return [
+        getattr(tx, attr)
+        for attr in ("exchange", "send", "receive")
+        if getattr(tx, attr, None) is not None
+    ]
+
+
+def write_partitions(transactions, ledger_dir):
+    """Write each year's events to its own partition. Returns the years written."""
+    os.makedirs(ledger_dir, exist_ok=True)
+    partitions = {}
+    for tx in transactions:
+        partition = partitions.setdefault(tx.time.year, [])
+        partition.extend(event_to_record(ev) for ev in _tx_events(tx))
+
+    for year, records in partitions.items():
+        path = os.path.join(ledger_dir, PARTITION_FILE.format(year=year))
+        with open(path, "w") as f:
+            json.dump(records, f, separators=(",", ":"))
+    return sorted(partitions)
+
+
+def read_partition(ledger_dir, year):
+    """Return the events in a year's partition, sorted by time"""
+    path = os.path.join(ledger_dir, PARTITION_FILE.format(year=year))
+    with open(path, "r") as f:
+        records = json.load(f)
+    events = [event_from_record(record) for record in records]
+    events.sort(key=lambda x: x.time)
+    return events
+
+
+def event_entries(ev):
+    """The (location, coin, amount) entries of an event"""
+    entries = ev.entries()
+    if type(entries[0]) == str:  # Sends and Receives have a single entry
+        entries = [entries]
+    return entries
+
+
+def balances_by_year(events, years):
+    """Return {year: {location: {coin: amount}}} as of the end of each year"""
+    by_year = {}
+    balances = {}
+    years = sorted(years)
+    pending = list(years)
+    for ev in sorted(events, key=lambda x: x.time):
+        while pending and ev.time.year > pending[0]:
+            by_year[pending.pop(0)] = {l: dict(c) for l, c in balances.items()}
+        for location, coin, amount in event_entries(ev):
+            balances.setdefault(location, {}).setdefault(coin, 0)
+            balances[location][coin] += amount
+    for year in pending:
+        by_year[year] = {l: dict(c) for l, c in balances.items()}
+    return by_year
+
+
+def sweep_balances(events):
+    """Run through time-sorted events keeping a running balance of every coin
+    but USD at every location. Events at the same time are all applied before
+    balances are checked, since their order is arbitrary.
+
+    Returns the final balances ({location: {coin: amount}}) and, for every
+    balance that goes negative, {(location, coin): (index of the event after
+    which it first did, balance)}.
+    """
+    balances = {}
+    overdrafts = {}
+    for _, group in itertools.groupby(enumerate(events), key=lambda x: x[1].time):
+        touched = {}  # (location, coin) -> index of the last event touching it
+        for i, ev in group:
+            for location, coin, amount in event_entries(ev):
+                if coin == "USD":
+                    continue
+                coins = balances.setdefault(location, {})
+                coins[coin] = coins.get(coin, 0) + amount
+                touched[(location, coin)] = i
+        for (location, coin), i in touched.items():
+            balance = balances[location][coin]
+            if balance < 0 and (location, coin) not in overdrafts:
+                overdrafts[(location, coin)] = (i, balance)
+    return balances, overdrafts
+
+
+def write_checkpoint(ledger_dir, year, method, lots, balances):
+    """Write the open lots ({coin: lots}) and balances at the end of a year"""
+    lots = {
+        coin: [[lot[0].isoformat()] + list(lot[1:]) for lot in coin_lots]
+        for coin, coin_lots in lots.items()
+    }
+    path = os.path.join(ledger_dir, CHECKPOINT_FILE.format(year=year, method=method))
+    with open(path, "w") as f:
+        json.dump({"lots": lots, "balances": balances}, f, separators=(",", ":"))
+
+
+def read_checkpoint(ledger_dir, year, method):
+    """Return the open lots ({coin: lots}) and balances at the end of a year"""
+    path = os.path.join(ledger_dir, CHECKPOINT_FILE.format(year=year, method=method))
+    try:
+        with open(path, "r") as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        raise RuntimeError(f"No {method} checkpoint for {year}. Run checkpoint?")
+    lots = {
+        coin: [[dateutil.parser.parse(lot[0])] + lot[1:] for lot in coin_lots]
+        for coin, coin_lots in checkpoint["lots"].items()
+    }
+    return lots, checkpoint["balances"]
+
+
+def write_lineage(ledger_dir, method, links, transactions):
+    """Write the lineage index: the links of every disposal, a description of
+    every transaction they mention and the legacy ids they are known by"""
+    mentioned = set(links)
+    for tx_links in links.values():
+        for coin, lot_id, amount, hops in tx_links:
+            mentioned.add(lot_id)
+            mentioned.update(hops)
+    aliases = events_module.build_aliases(transactions)
+    index = {
+        "links": links,
+        "transactions": {
+            tx.id: str(tx) for tx in transactions if tx.id in mentioned
+        },
+        "aliases": {
+            id: tx.id if tx else None
+            for id, tx in aliases.items()
+            if tx is None or (id != tx.id and tx.id in mentioned)
+        },
+    }
+    path = os.path.join(ledger_dir, LINEAGE_FILE.format(method=method))
+    with open(path, "w") as f:
+        json.dump(index, f, separators=(",", ":"))
+
+
+def read_lineage(ledger_dir, method):
+    """Return the lineage index written by write_lineage"""
+    path = os.path.join(ledger_dir, LINEAGE_FILE.format(method=method))
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise RuntimeError(f"No {method} lineage index. Run checkpoint?")
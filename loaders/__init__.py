@@ -1,7 +1,85 @@
-import loaders.coinbase
-import loaders.gdax
-import loaders.liqui
-import loaders.binance
-import loaders.manual
+"""Registry of event loaders.
 
-all = [loaders.coinbase, loaders.gdax, loaders.liqui, loaders.binance, loaders.manual]
+A loader is a module with parse_events(config_dir, data_dir) and
+update_from_remote(config_dir, data_dir). It may also have
+get_balances(config_dir, data_dir), returning the balances the exchange
+reported as {location: {coin: amount}}, which verify checks the events
+against, and UNCHECKED_LOCATIONS, the locations whose reported balances its
+own events make impossible to check (GDAX fills are booked at coinbase).
+Loaders are registered by name and only imported when selected, so
+unused sources cost nothing.
+
+Besides the built-in loaders, others can be registered by installed packages
+through the "mistbat.loaders" entry point group, or listed in the portfolio's
+loaders.yaml (see loaders.yaml.example), which can also pick the loaders to
+use by default.
+"""
+import importlib
+import yaml
+
+try:
+    from importlib.metadata import entry_points
+except ImportError:  # Python < 3.8
+    try:
+        from importlib_metadata import entry_points
+    except ImportError:
+        entry_points = None
+
+BUILTIN = {
+    "coinbase": "loaders.coinbase",
+    "gdax": "loaders.gdax",
+    "liqui": "loaders.liqui",
+    "binance": "loaders.binance",
+    "manual": "loaders.manual",
+    "csv": "loaders.csvfile",
+}
+
+ENTRY_POINT_GROUP = "mistbat.loaders"
+
+
+def _read_config(config_dir):
+    try:
+        with open(config_dir + "/loaders.yaml") as f:
+            return yaml.load(f) or {}
+    except FileNotFoundError:
+        return {}
+
+
+def _plugins():
+    """Return the entry points registered in ENTRY_POINT_GROUP, or none
+    if importlib.metadata isn't available"""
+    if entry_points is None:
+        return []
+    try:
+        return entry_points(group=ENTRY_POINT_GROUP)
+    except TypeError:  # Python < 3.10 only returns a dict of groups
+        return entry_points().get(ENTRY_POINT_GROUP, [])
+
+
+def registry(config_dir):
+    """Return {loader name: module path} for every registered loader."""
+    modules = dict(BUILTIN)
+    for ep in _plugins():
+        # ep.module is Python 3.9+, the value is "module:attr" everywhere
+        modules[ep.name] = ep.value.split(":")[0].strip()
+    modules.update(_read_config(config_dir).get("modules") or {})
+    return modules
+
+
+def default_names(config_dir):
+    """Return the loader names to use when none are selected explicitly."""
+    config = _read_config(config_dir)
+    return config.get("default") or list(registry(config_dir))
+
+
+def load(names, config_dir):
+    """Import and return the named loader modules, in order."""
+    modules = registry(config_dir)
+    unknown = [name for name in names if name not in modules]
+    if unknown:
+        raise KeyError(
+            "Unknown loaders: {} (registered: {})".format(
+                ", ".join(unknown), ", ".join(modules)
+            )
+        )
+    return [importlib.import_module(modules[name]) for name in names]
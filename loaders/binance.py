@@ -1,47 +1,112 @@
-import json
 from events import *
-from xdg import XDG_DATA_HOME, XDG_CONFIG_HOME
+from loaders.dumps import read_dump, write_dump
 import time
 
 
-def update_from_remote():
-    """Poll the binance API for transaction history and save as json file."""
+# The exchange's symbol table is cached in the data directory for this long
+SYMBOLS_MAX_AGE = 7 * 24 * 60 * 60
+
+
+def get_symbols(client, config_dir, data_dir):
+    """Return {symbol: [base asset, quote asset]} for every pair on the
+    exchange, from the local cache if it is recent enough"""
+    try:
+        cached = read_dump(data_dir, "binance_symbols.json")
+        if time.time() - cached["fetched"] < SYMBOLS_MAX_AGE:
+            return cached["symbols"]
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+
+    exchange_info = client.get_exchange_info()
+    symbols = {
+        sym["symbol"]: [sym["baseAsset"], sym["quoteAsset"]]
+        for sym in exchange_info["symbols"]
+    }
+    write_dump(
+        config_dir,
+        data_dir,
+        "binance_symbols.json",
+        {"fetched": time.time(), "symbols": symbols},
+    )
+    return symbols
+
+
+def candidate_assets(deposits, withdraws, account, stored_trades, symbols):
+    """Assets that may have been traded: those deposited, withdrawn, held now
+    or in trades already stored."""
+    assets = set(obs["asset"] for obs in deposits["depositList"])
+    assets.update(obs["asset"] for obs in withdraws["withdrawList"])
+    assets.update(
+        balance["asset"]
+        for balance in account["balances"]
+        if float(balance["free"]) or float(balance["locked"])
+    )
+    for pair, pair_trades in stored_trades.items():
+        if pair_trades and pair in symbols:
+            assets.update(symbols[pair])
+    return assets
+
+
+def pairs_to_sync(deposits, withdraws, account, stored_trades, symbols):
+    """Return the symbols to request trades for. The first sync requests every
+    symbol. Later ones request every pair with a candidate asset on either
+    side, so a coin bought with a candidate and sold again in full between
+    syncs is still found through its pair with that candidate."""
+    if not any(stored_trades.values()):
+        return list(symbols)
+    assets = candidate_assets(deposits, withdraws, account, stored_trades, symbols)
+    return [
+        pair
+        for pair, (base, quote) in symbols.items()
+        if base in assets or quote in assets
+    ]
+
+
+def update_from_remote(config_dir, data_dir):
+    """Poll the binance API for transaction history and save as json file.
+    After the first sync, trades are only requested for pairs with an asset
+    that may have been traded, rather than for every symbol on the exchange."""
     from binance.client import Client
+    from binance.exceptions import BinanceAPIException
     import yaml
 
-    keys = yaml.load(open(XDG_CONFIG_HOME + "/mistbat/secrets.yaml"))["binance"]
+    keys = yaml.load(open(config_dir + "/secrets.yaml"))["binance"]
     client = Client(keys["api_key"], keys["secret_key"])
 
     deposits = client.get_deposit_history()
     withdraws = client.get_withdraw_history()
     b_resources = {"deposits": deposits, "withdraws": withdraws}
 
-    exchange_info = client.get_exchange_info()
-    all_pairs = [sym["symbol"] for sym in exchange_info["symbols"]]
+    try:
+        trades = read_dump(data_dir, "binance.json")["trades"]
+    except FileNotFoundError:
+        trades = {}
+
+    symbols = get_symbols(client, config_dir, data_dir)
+    pairs = pairs_to_sync(deposits, withdraws, client.get_account(), trades, symbols)
 
-    trades = {}
-    print(f"Total pairs to loop through: {len(all_pairs)}")
-    for index, pair in enumerate(all_pairs):
+    print(f"Total pairs to loop through: {len(pairs)} of {len(symbols)}")
+    for index, pair in enumerate(pairs):
         if index % 10 == 0:
             print(f"Currently: {index}")
         try:
             trades[pair] = client.get_my_trades(symbol=pair)
-        except:
+        except BinanceAPIException as e:
+            if e.status_code not in (418, 429):
+                raise
             print("API limit exceeded. Pausing for 60 seconds.")
             time.sleep(61)
             trades[pair] = client.get_my_trades(symbol=pair)
-            
 
         # 500 trades max per pair
         assert len(trades[pair]) < 500
 
     b_resources["trades"] = trades
 
-    with open(XDG_DATA_HOME + "/mistbat/binance.json", "w") as f:
-        f.write(json.dumps(b_resources, indent=2))
+    write_dump(config_dir, data_dir, "binance.json", b_resources)
 
 
-def parse_events():
+def parse_events(config_dir, data_dir):
     """Take json file of binance transactions and parse into Event instances.
     Returns:
       A list of instances of Event subclasses (e.g., Exchange, FiatExchange, Send)
@@ -51,8 +116,7 @@ def parse_events():
     events = []
 
     # Load up the JSON file
-    with open(XDG_DATA_HOME + "/mistbat/binance.json", "r") as f:
-        json_data = json.load(f)
+    json_data = read_dump(data_dir, "binance.json")
 
     for obs in json_data["deposits"]["depositList"]:
         # Handle differing Bitcoin Cash symbols
@@ -119,6 +183,7 @@ def parse_events():
                 sell_amount=sell_amount,
                 fee_with=obs["commissionAsset"],
                 fee_amount=float(obs["commission"]),
+                trade_id=obs["id"],
             )
             events.append(exchange)
 
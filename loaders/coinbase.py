@@ -1,14 +1,25 @@
 import json
+from decimal import Decimal
 from events import *
-from xdg import XDG_DATA_HOME, XDG_CONFIG_HOME
+from loaders.dumps import read_dump, write_dump
+
+
+def total_balances(accounts):
+    """Return {currency: amount} summed over the accounts, since a currency
+    can have more than one wallet. Amounts are kept as decimal strings."""
+    totals = {}
+    for account in accounts:
+        total = totals.get(account["currency"], Decimal(0))
+        totals[account["currency"]] = total + Decimal(account["amount"])
+    return {currency: str(total) for currency, total in totals.items()}
 
 
 # TODO: fix nomenclature in this function
-def update_from_remote():
+def update_from_remote(config_dir, data_dir):
     from coinbase.wallet.client import Client
     import yaml
 
-    keys = yaml.load(open(XDG_CONFIG_HOME + "/mistbat/secrets.yaml"))["coinbase"]
+    keys = yaml.load(open(config_dir + "/secrets.yaml"))["coinbase"]
     client = Client(keys["api_key"], keys["secret_key"])
 
     accounts = [
@@ -20,7 +31,13 @@ def update_from_remote():
         for account in client.get_accounts().data
     ]
 
-    cb_resources = {"buys": {}, "sells": {}, "transactions_filtered": {}}
+    cb_resources = {
+        "buys": {},
+        "sells": {},
+        "transactions_filtered": {},
+        # Balances as of this update, for verify to check the events against
+        "balances": total_balances(accounts),
+    }
     for account in accounts:
         # Coinbase Buys
         buys = json.loads(str(client.get_buys(account["id"])))["data"]
@@ -47,11 +64,20 @@ def update_from_remote():
             )
         )
 
-        with open(XDG_DATA_HOME + "/mistbat/coinbase.json", "w") as f:
-            f.write(json.dumps(cb_resources, indent=2))
+    write_dump(config_dir, data_dir, "coinbase.json", cb_resources)
+
+
+def get_balances(config_dir, data_dir):
+    """Return {location: {coin: amount}} as reported by Coinbase at the last
+    remote update"""
+    balances = read_dump(data_dir, "coinbase.json").get("balances")
+    if balances is None:
+        # Saved before balances were recorded
+        return {}
+    return {"coinbase": balances}
 
 
-def parse_events():
+def parse_events(config_dir, data_dir):
     # Returns Exchanges, Sends, Receives
     # Does not do things like parse into Coins
     # This will IGNORE deposits and withdrawals from GDAX.
@@ -60,13 +86,13 @@ def parse_events():
     events = []
 
     # Load up the JSON file
-    with open(XDG_DATA_HOME + "/mistbat/coinbase.json", "r") as f:
-        json_data = json.load(f)
+    json_data = read_dump(data_dir, "coinbase.json")
 
     # Verify that only known transaction types are present
     buys = json_data.pop("buys")
     sells = json_data.pop("sells")
     transactions_filtered = json_data.pop("transactions_filtered")
+    json_data.pop("balances", None)
     assert len(json_data) == 0  # There should be nothing else in the file
     # The only observations this is set up to parse are send, exchange_deposit
     # and exchange_withdrawal
@@ -0,0 +1,145 @@
+"""Generic loader for CSV trade history exports.
+
+Each source in csv_sources.yaml names a CSV file in the data directory and maps
+its columns onto event fields (see csv_sources.yaml.example). Files are streamed
+row by row through the csv module, so even very large exports are parsed in
+bounded memory.
+"""
+import csv
+import datetime
+import yaml
+from events import *
+from loaders.dumps import open_text
+
+COLUMNS = (
+    "time",
+    "side",
+    "pair",
+    "coin",
+    "qty",
+    "price",
+    "fee",
+    "fee_coin",
+    "txid",
+    "id",
+)
+
+DEFAULT_SIDES = {
+    "buy": "buy",
+    "sell": "sell",
+    "deposit": "receive",
+    "withdrawal": "send",
+}
+
+
+def update_from_remote(config_dir, data_dir):
+    pass
+
+
+def get_sources(config_dir):
+    """Return the list of CSV sources configured in csv_sources.yaml, if any."""
+    try:
+        with open(config_dir + "/csv_sources.yaml", "r") as f:
+            sources = yaml.load(f) or []
+    except FileNotFoundError:
+        return []
+
+    for source in sources:
+        unknown = set(source["columns"]) - set(COLUMNS)
+        if unknown:
+            raise Exception(
+                "Unknown columns for {}: {}".format(source["file"], ", ".join(unknown))
+            )
+        for required in ("time", "side", "qty"):
+            if required not in source["columns"]:
+                raise Exception(f"No {required} column mapped for {source['file']}")
+    return sources
+
+
+def iter_events(filename, source):
+    """Yield an event for every row of the CSV file described by `source`."""
+    location = source["location"]
+    columns = source["columns"]
+    sides = {k.lower(): v for k, v in source.get("sides", DEFAULT_SIDES).items()}
+    separator = source.get("pair_separator", "/")
+    time_format = source.get("time_format")
+
+    def get(row, field, default=None):
+        column = columns.get(field)
+        if column is None or row[column] is None or row[column] == "":
+            return default
+        return row[column]
+
+    def require(row, line, *fields):
+        """Value of the first of the fields that is filled in on the row"""
+        for field in fields:
+            cell = get(row, field)
+            if cell is not None and cell.strip():
+                return cell
+        raise Exception(f"{filename}:{line}: missing {' or '.join(fields)} {row}")
+
+    with open_text(filename) as f:
+        reader = csv.DictReader(f, delimiter=source.get("delimiter", ","))
+        missing = set(columns.values()) - set(reader.fieldnames or [])
+        if missing:
+            raise Exception(f"{filename}: no {', '.join(sorted(missing))} column")
+        for line, row in enumerate(reader, start=2):
+            side = sides.get(require(row, line, "side").strip().lower())
+            if side is None:
+                raise Exception(f"{filename}:{line}: unrecognized side {row}")
+
+            # strptime is much faster than dateutil's guessing on big files
+            time = require(row, line, "time")
+            if time_format:
+                time = datetime.datetime.strptime(time, time_format)
+
+            extra = {}
+            if get(row, "id"):
+                extra["location_id"] = get(row, "id")
+
+            if side in ("send", "receive"):
+                coin = require(row, line, "coin", "pair")
+                cls = Send if side == "send" else Receive
+                yield cls(
+                    time=time,
+                    location=location,
+                    coin=coin,
+                    amount=float(require(row, line, "qty")),
+                    txid=get(row, "txid", ""),
+                    **extra,
+                )
+                continue
+
+            base, quote = require(row, line, "pair").split(separator)
+            qty = float(require(row, line, "qty"))
+            total = round(float(require(row, line, "price")) * qty, 8)
+            if side == "buy":
+                buy_coin, buy_amount, sell_coin, sell_amount = base, qty, quote, total
+            else:
+                buy_coin, buy_amount, sell_coin, sell_amount = quote, total, base, qty
+
+            fee_with = get(row, "fee_coin", source.get("fee_coin", quote))
+            fee_amount = float(get(row, "fee", 0))
+            cls = Exchange
+            if "USD" in (buy_coin, sell_coin):
+                # Fees on fiat exchanges are accounted for in USD
+                if fee_amount and fee_with != "USD":
+                    raise Exception(f"{filename}:{line}: fiat trade fee not in USD")
+                cls, fee_with = FiatExchange, "USD"
+            yield cls(
+                time=time,
+                location=location,
+                buy_coin=buy_coin,
+                buy_amount=buy_amount,
+                sell_coin=sell_coin,
+                sell_amount=sell_amount,
+                fee_with=fee_with,
+                fee_amount=fee_amount,
+                **extra,
+            )
+
+
+def parse_events(config_dir, data_dir):
+    # Returns Exchanges, Sends and Receives as a generator
+    for source in get_sources(config_dir):
+        yield from iter_events(data_dir + "/" + source["file"], source)
@@ -0,0 +1,72 @@
+"""Raw exchange dumps in the data directory.
+
+A dump is written once per remote update as compact JSON, compressed with
+gzip or lzma if loaders.yaml asks for it, to a temporary file that is then
+renamed over the old dump. A crash mid-write leaves the previous dump intact.
+Dumps are read back whichever way they were compressed.
+"""
+import gzip
+import io
+import json
+import lzma
+import os
+from loaders import _read_config
+
+# Compression name -> (file suffix, compress)
+COMPRESSIONS = {
+    "none": ("", None),
+    "gzip": (".gz", gzip.compress),
+    "lzma": (".xz", lzma.compress),
+}
+
+OPENERS = {".gz": gzip.open, ".xz": lzma.open}
+
+
+def open_text(filename):
+    """Open a text file for reading, decompressing it if it ends in .gz or .xz"""
+    opener = OPENERS.get(os.path.splitext(filename)[1], io.open)
+    return opener(filename, "rt", newline="")
+
+
+def _variants(data_dir, name):
+    return [data_dir + "/" + name + suffix for suffix, _ in COMPRESSIONS.values()]
+
+
+def dump_path(data_dir, name):
+    """Return the path of the most recently written dump called `name`
+    (e.g., "coinbase.json"), however it is compressed"""
+    existing = [path for path in _variants(data_dir, name) if os.path.exists(path)]
+    if not existing:
+        raise FileNotFoundError(f"No {name} in {data_dir}. Run remoteupdate?")
+    return max(existing, key=os.path.getmtime)
+
+
+def read_dump(data_dir, name):
+    """Return the JSON data of a dump"""
+    with open_text(dump_path(data_dir, name)) as f:
+        return json.load(f)
+
+
+def write_dump(config_dir, data_dir, name, data):
+    """Atomically replace the dump called `name` with the JSON data,
+    compressed as set by `compression` in loaders.yaml"""
+    compression = _read_config(config_dir).get("compression", "none")
+    if compression not in COMPRESSIONS:
+        raise Exception(f"Unknown compression in loaders.yaml: {compression}")
+    suffix, compress = COMPRESSIONS[compression]
+
+    content = json.dumps(data, separators=(",", ":")).encode()
+    if compress:
+        content = compress(content)
+    path = data_dir + "/" + name + suffix
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+    # Don't leave an older dump compressed some other way behind
+    for variant in _variants(data_dir, name):
+        if variant != path and os.path.exists(variant):
+            os.remove(variant)
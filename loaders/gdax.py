@@ -1,13 +1,16 @@
-import json
 from events import *
-from xdg import XDG_DATA_HOME, XDG_CONFIG_HOME
+from loaders.dumps import read_dump, write_dump
 
+# Fills are booked at coinbase but the transfers between GDAX and Coinbase
+# aren't parsed, so Coinbase's reported balances can't be checked
+UNCHECKED_LOCATIONS = ["coinbase"]
 
-def update_from_remote():
+
+def update_from_remote(config_dir, data_dir):
     import gdax
     import yaml
 
-    keys = yaml.load(open(XDG_CONFIG_HOME + "/mistbat/secrets.yaml"))["gdax"]
+    keys = yaml.load(open(config_dir + "/secrets.yaml"))["gdax"]
     client = gdax.AuthenticatedClient(
         keys["api_key"], keys["secret_key"], keys["passphrase"]
     )
@@ -23,18 +26,16 @@ def update_from_remote():
         for page in fills_paginated:
             fills.extend(page)
 
-    with open(XDG_DATA_HOME + "/mistbat/gdax.json", "w") as f:
-        f.write(json.dumps(fills, indent=2))
+    write_dump(config_dir, data_dir, "gdax.json", fills)
 
 
-def parse_events():
+def parse_events(config_dir, data_dir):
     # Returns Exchanges ("fills") only.
     # Sends and Receives are handled by the Coinbase loader.
     events = []
 
     # Load up the JSON file
-    with open(XDG_DATA_HOME + "/mistbat/gdax.json", "r") as f:
-        json_data = json.load(f)
+    json_data = read_dump(data_dir, "gdax.json")
 
     # Filter out the "message" garbage the API has started to return (2021)
     json_data = [data for data in json_data if type(data) == dict]
@@ -55,6 +56,7 @@ def parse_events():
             sell_amount=float(buy["usd_volume"]),
             fee_with="USD",
             fee_amount=float(buy["fee"]),
+            trade_id=buy["trade_id"],
         )
         events.append(fiat_exchange)
 
@@ -74,6 +76,7 @@ def parse_events():
             sell_amount=float(sell["size"]),
             fee_with="USD",
             fee_amount=float(sell["fee"]),
+            trade_id=sell["trade_id"],
         )
         events.append(fiat_exchange)
 
@@ -1,12 +1,11 @@
 import json
 from datetime import datetime as dt
 from events import *
-from xdg import XDG_DATA_HOME
 
 coinmap = {"Bitcoin": "BTC", "Ethereum": "ETH", "Litecoin": "LTC"}
 
 
-def update_from_remote():
+def update_from_remote(config_dir, data_dir):
     pass
 
 
@@ -44,5 +43,5 @@ def parse_history_txt(filename):
     return events
 
 
-def parse_events():
-    return parse_history_txt(XDG_DATA_HOME + "/mistbat/liqui_history.txt")
+def parse_events(config_dir, data_dir):
+    return parse_history_txt(data_dir + "/liqui_history.txt")
@@ -1,18 +1,17 @@
 import yaml
 from events import *
-from xdg import XDG_CONFIG_HOME
 
 
-def update_from_remote():
+def update_from_remote(config_dir, data_dir):
     pass
 
 
-def parse_events():
+def parse_events(config_dir, data_dir):
     # Return Exchanges, Sends, Receives
     events = []
 
     # Load up the YAML file
-    with open(XDG_CONFIG_HOME + "/mistbat/manual_obs.yaml", "r") as f:
+    with open(config_dir + "/manual_obs.yaml", "r") as f:
         observations = yaml.load(f)
 
     for obs in observations:
@@ -1,39 +1,132 @@
 import click
+import datetime
+import io
+import os
+import pytz
+import shlex
+import sys
 import time
 import loaders
 import yaml
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
 from prettytable import PrettyTable
-from xdg import XDG_CONFIG_HOME, XDG_DATA_HOME
-from cryptocompare import get_historical_close, get_coin_spot_prices
-from events import get_events
+from xdg import XDG_CACHE_HOME, XDG_CONFIG_HOME, XDG_DATA_HOME
+from events import get_events, build_aliases, lookup
+from index import LedgerIndex
+from ledger import (
+    balances_by_year,
+    event_entries,
+    read_checkpoint,
+    read_lineage,
+    read_partition,
+    sweep_balances,
+    write_checkpoint,
+    write_lineage,
+    write_partitions,
+)
 from transactions import (
     get_transactions,
     annotate_transactions,
     fmv_transactions,
     imply_fees,
+    propose_matches,
+)
+from prices import LedgerPrices, PriceChain, get_price_chain
+from units import to_units, from_units, value
+from watch import watch as watch_pipeline
+from export import (
+    FORM_8949_FORMATS,
+    RECORD_FORMATS,
+    event_record,
+    transaction_record,
+    write_form_8949,
+    write_records,
 )
-from tax import Form8949
+from pipeline import Pipeline
+from report import REPORT_FORMATS, build_report, fee_totals, get_holdings, write_report
+from tax import Form8949, LOT_METHODS, get_lot_selections, get_whatif_disposals
+
+
+# Where a portfolio's config and data live, the loaders that read its data and
+# the price providers that value it
+Portfolio = namedtuple("Portfolio", ["config_dir", "data_dir", "loaders", "prices"])
 
+PRICE_CACHE = XDG_CACHE_HOME + "/mistbat/prices.json"
 
-def print_usd_exposure():
+
+def print_usd_exposure(events):
     """Calculate total amount of USD invested and not redeemed and total fees spent."""
-    fiat_events = get_events(loaders.all, "FiatExchange")
-    invested = round(sum(ev.sell_amount for ev in fiat_events if ev.investing), 2)
-    redeemed = round(sum(ev.buy_amount for ev in fiat_events if ev.redeeming), 2)
-    net_invested = round(invested - redeemed, 2)
+    fiat_events = [ev for ev in events if ev.__class__.__name__ == "FiatExchange"]
+    invested = sum(ev.sell_amount for ev in fiat_events if ev.investing)
+    redeemed = sum(ev.buy_amount for ev in fiat_events if ev.redeeming)
+    net_invested = round(from_units(invested - redeemed), 2)
 
-    fees = round(sum(ev.fee_amount for ev in fiat_events), 2)
+    fees = round(from_units(sum(ev.fee_amount for ev in fiat_events)), 2)
     print(
         "USD Exposure: {} + {} fees (FIAT ONLY) = {:.2f}".format(
             net_invested, fees, net_invested + fees
         )
     )
-    print("Aggregate Fee %: {:.2f}%".format(fees * 100 / (invested - redeemed)))
+    print("Aggregate Fee %: {:.2f}%".format(fees * 100 / net_invested))
+
+
+def filter_ledger(items, since, until, coins, locations, types):
+    """Narrow time-sorted events or transactions down to the requested filters."""
+    if not (since or until or coins or locations or types):
+        return items
+    since = since.replace(tzinfo=pytz.utc) if since else None
+    until = until.replace(tzinfo=pytz.utc) if until else None
+    return LedgerIndex(items).query(since, until, coins, locations, types)
+
+
+def portfolio_pipeline(portfolio, annotate=True):
+    """Pipeline from the portfolio's loaders to Form 8949"""
+    return Pipeline(
+        lambda: get_events(
+            portfolio.loaders, portfolio.config_dir, portfolio.data_dir
+        ),
+        portfolio.config_dir,
+        portfolio.data_dir,
+        annotate=annotate,
+    )
 
 
 @click.group()
-def cli():
-    pass
+@click.option(
+    "--config-dir",
+    help="Directory with the portfolio's config files",
+    default=XDG_CONFIG_HOME + "/mistbat",
+)
+@click.option(
+    "--data-dir",
+    help="Directory with the portfolio's exchange data and fmvs",
+    default=XDG_DATA_HOME + "/mistbat",
+)
+@click.option(
+    "--price-cache",
+    help="File of fetched prices to reuse and share with other runs",
+    default=PRICE_CACHE,
+)
+@click.option(
+    "--loaders",
+    "loader_names",
+    help="Comma-separated loaders to read events from (default: loaders.yaml or all)",
+    default=None,
+)
+@click.pass_context
+def cli(ctx, config_dir, data_dir, price_cache, loader_names):
+    if loader_names:
+        names = [name.strip() for name in loader_names.split(",") if name.strip()]
+    else:
+        names = loaders.default_names(config_dir)
+    try:
+        selected = loaders.load(names, config_dir)
+    except KeyError as e:
+        raise click.BadParameter(e.args[0], param_hint="--loaders")
+    prices = get_price_chain(config_dir, price_cache)
+    ctx.obj = Portfolio(config_dir, data_dir, selected, prices)
 
 
 @cli.command()
@@ -43,15 +136,48 @@ def cli():
     is_flag=True,
     default=False,
 )
-def lsev(remote_update):
+@click.option(
+    "--format",
+    "fmt",
+    help="Stream structured records instead of descriptions",
+    type=click.Choice(RECORD_FORMATS),
+    default=None,
+)
+@click.option(
+    "--since",
+    help="Only list items at or after this date (UTC)",
+    type=click.DateTime(formats=["%Y-%m-%d", "%Y-%m-%d %H:%M:%S"]),
+    default=None,
+)
+@click.option(
+    "--until",
+    help="Only list items before this date (UTC)",
+    type=click.DateTime(formats=["%Y-%m-%d", "%Y-%m-%d %H:%M:%S"]),
+    default=None,
+)
+@click.option("--coin", help="Only list items involving this coin", multiple=True)
+@click.option("--location", help="Only list items at this location", multiple=True)
+@click.option("--type", "typ", help="Only list items of this type", multiple=True)
+@click.pass_obj
+def lsev(portfolio, remote_update, fmt, since, until, coin, location, typ):
     """List all events parsed from observations."""
-    events = get_events(loaders.all, remote_update=remote_update)
+    all_events = get_events(
+        portfolio.loaders,
+        portfolio.config_dir,
+        portfolio.data_dir,
+        remote_update=remote_update,
+    )
+    events = filter_ledger(all_events, since, until, coin, location, typ)
+    if fmt:
+        write_records((event_record(ev) for ev in events), fmt, sys.stdout)
+        return
+
     for ev in events:
         print(ev)
 
     print("--------------------")
     print("{} total events".format(len(events)))
-    print_usd_exposure()
+    print_usd_exposure(all_events)
 
 
 @cli.command()
@@ -65,73 +191,246 @@ def lsev(remote_update):
 @click.option(
     "--minimal", help="Omit everything other than headline", is_flag=True, default=False
 )
-def lstx(no_group, no_annotations, minimal):
+@click.option(
+    "--format",
+    "fmt",
+    help="Stream structured records instead of descriptions",
+    type=click.Choice(RECORD_FORMATS),
+    default=None,
+)
+@click.option(
+    "--since",
+    help="Only list items at or after this date (UTC)",
+    type=click.DateTime(formats=["%Y-%m-%d", "%Y-%m-%d %H:%M:%S"]),
+    default=None,
+)
+@click.option(
+    "--until",
+    help="Only list items before this date (UTC)",
+    type=click.DateTime(formats=["%Y-%m-%d", "%Y-%m-%d %H:%M:%S"]),
+    default=None,
+)
+@click.option("--coin", help="Only list items involving this coin", multiple=True)
+@click.option("--location", help="Only list items at this location", multiple=True)
+@click.option("--type", "typ", help="Only list items of this type", multiple=True)
+@click.option(
+    "--watch",
+    help="Keep running and print what changes whenever config or data files change",
+    is_flag=True,
+    default=False,
+)
+@click.pass_obj
+def lstx(
+    portfolio,
+    no_group,
+    no_annotations,
+    minimal,
+    fmt,
+    since,
+    until,
+    coin,
+    location,
+    typ,
+    watch,
+):
     """List all transactions that have been derived from events and annotated."""
-    events = get_events(loaders.all)
-    transactions = get_transactions(events, XDG_CONFIG_HOME + "/mistbat/tx_match.yaml")
-    if not no_annotations:
-        transactions = annotate_transactions(
-            transactions, XDG_CONFIG_HOME + "/mistbat/tx_annotations.yaml"
-        )
-    transactions = fmv_transactions(
-        transactions, XDG_DATA_HOME + "/mistbat/tx_fmv.yaml"
-    )
-    transactions = imply_fees(transactions)
+    pipeline = portfolio_pipeline(portfolio, annotate=not no_annotations)
 
-    if no_group:
-        transactions = [
-            tx for tx in transactions if getattr(tx, "groups", None) is None
-        ]
+    def render():
+        transactions = pipeline.transactions()
+        if no_group:
+            transactions = [
+                tx for tx in transactions if getattr(tx, "groups", None) is None
+            ]
+        transactions = filter_ledger(transactions, since, until, coin, location, typ)
 
-    # Print transactions
-    for tx in transactions:
-        if minimal:
-            print(tx)
-        else:
-            print(tx.description())
+        if fmt:
+            write_records(
+                (transaction_record(tx) for tx in transactions), fmt, sys.stdout
+            )
+            return
 
-    print("--------------------")
-    print("{} total transactions".format(len(transactions)))
-    print_usd_exposure()
+        # Print transactions
+        for tx in transactions:
+            if minimal:
+                print(tx)
+            else:
+                print(tx.description())
+
+        print("--------------------")
+        print("{} total transactions".format(len(transactions)))
+        print_usd_exposure(pipeline.events())
+
+    if watch:
+        watch_pipeline(pipeline, render, [portfolio.config_dir, portfolio.data_dir])
+    else:
+        render()
 
 
 @cli.command()
-def fees():
-    events = get_events(loaders.all)
-    transactions = get_transactions(events, XDG_CONFIG_HOME + "/mistbat/tx_match.yaml")
+@click.pass_obj
+def fees(portfolio):
+    events = get_events(portfolio.loaders, portfolio.config_dir, portfolio.data_dir)
+    transactions = get_transactions(events, portfolio.config_dir + "/tx_match.yaml")
     transactions = fmv_transactions(
-        transactions, XDG_DATA_HOME + "/mistbat/tx_fmv.yaml"
+        transactions, portfolio.data_dir + "/tx_fmv.yaml"
     )
     transactions = imply_fees(transactions)
 
     print("\nFees Incurred")
     print("-------------")
-    fees = {}
-    for tx in transactions:
-        fees[tx.__class__.__name__] = fees.get(tx.__class__.__name__, 0) + tx.fee_usd
+    fees = fee_totals(transactions)
     for k, v in fees.items():
-        print(f"{k}: USD {v:0.2f}")
-    print("TOTAL: USD {:0.2f}\n".format(sum(fees.values())))
+        print(f"{k}: USD {from_units(v):0.2f}")
+    print("TOTAL: USD {:0.2f}\n".format(from_units(sum(fees.values()))))
 
     print("\nFees Incurred (negative values ignored)")
     print("-----------------------------------------")
-    fees = {}
-    for tx in transactions:
-        fees[tx.__class__.__name__] = fees.get(tx.__class__.__name__, 0) + max(
-            tx.fee_usd, 0
-        )
+    fees = fee_totals(transactions, ignore_negative=True)
     for k, v in fees.items():
-        print(f"{k}: USD {v:0.2f}")
-    print("TOTAL: USD {:0.2f}\n".format(sum(fees.values())))
+        print(f"{k}: USD {from_units(v):0.2f}")
+    print("TOTAL: USD {:0.2f}\n".format(from_units(sum(fees.values()))))
+
+
+@cli.command()
+@click.option(
+    "--window", help="Hours after a send to look for a receive", type=float, default=24
+)
+@click.option(
+    "--tolerance",
+    help="Largest fraction of a send that may be lost to fees",
+    type=float,
+    default=0.01,
+)
+@click.option(
+    "--usd-tolerance",
+    help="Largest fractional USD value difference for a Shapeshift",
+    type=float,
+    default=0.05,
+)
+@click.pass_obj
+def match(portfolio, window, tolerance, usd_tolerance):
+    """Propose tx_match.yaml pairs for unmatched Send and Receive events"""
+    events = get_events(portfolio.loaders, portfolio.config_dir, portfolio.data_dir)
+    proposals = propose_matches(
+        events,
+        portfolio.config_dir + "/tx_match.yaml",
+        tolerance=tolerance,
+        window=window,
+        usd_tolerance=usd_tolerance,
+    )
+
+    for typ in ("SendReceive", "Shapeshift"):
+        print(f"{typ}:")
+        for send, receive, reason in proposals[typ]:
+            print(
+                f"  - {send.id} {receive.id}  # {reason}: {send.coin} {from_units(send.amount)} -> {receive.coin} {from_units(receive.amount)}"
+            )
+        print()
+
+
+@cli.command()
+@click.option(
+    "--context",
+    help="Events to show on each side of the first negative balance",
+    type=int,
+    default=5,
+)
+@click.pass_obj
+def verify(portfolio, context):
+    """Check running balances for missing or out-of-order events and compare
+    the final balances with those reported by the exchanges"""
+    events = get_events(portfolio.loaders, portfolio.config_dir, portfolio.data_dir)
+    balances, overdrafts = sweep_balances(events)
+
+    if overdrafts:
+        print("NEGATIVE BALANCES")
+        first = sorted(overdrafts.items(), key=lambda x: x[1][0])
+        for (location, coin), (index, balance) in first:
+            print(
+                "{} {} {} {:.8f} after {}".format(
+                    events[index].time.strftime("%Y-%m-%d %H:%M:%S"),
+                    location,
+                    coin,
+                    from_units(balance),
+                    events[index].id,
+                )
+            )
+
+        # The events of that location and coin around the first overdraft
+        (location, coin), (index, _) = first[0]
+        print(f"\n{location} {coin} events around the first negative balance:")
+        history = []
+        running = 0
+        for i, ev in enumerate(events):
+            for entry_location, entry_coin, amount in event_entries(ev):
+                if entry_location == location and entry_coin == coin:
+                    running += amount
+                    history.append((i, ev, running))
+        position = [i for i, _, _ in history].index(index)
+        shown = history[max(0, position - context) : position + context + 1]
+        for i, ev, running in shown:
+            marker = "  <-- first negative" if i == index else ""
+            print(f"  {ev} [balance {from_units(running):.8f}]{marker}")
+        print()
+
+    # Final balances against what the exchanges report
+    unchecked = {}
+    for loader in portfolio.loaders:
+        for location in getattr(loader, "UNCHECKED_LOCATIONS", []):
+            unchecked.setdefault(location, []).append(loader.__name__.split(".")[-1])
+    mismatches = []
+    for loader in portfolio.loaders:
+        if not hasattr(loader, "get_balances"):
+            continue
+        reported = loader.get_balances(portfolio.config_dir, portfolio.data_dir)
+        for location, coins in reported.items():
+            if location in unchecked:
+                print(
+                    "Skipped final balances at {}: {} events are booked there too".format(
+                        location, ", ".join(unchecked[location])
+                    )
+                )
+                continue
+            held = balances.get(location, {})
+            for coin in sorted(set(coins) | set(held)):
+                if coin == "USD":
+                    continue
+                expected = to_units(coins.get(coin, 0))
+                if held.get(coin, 0) != expected:
+                    mismatches.append([location, coin, expected, held.get(coin, 0)])
+            print(f"Checked final balances at {location} against the exchange")
+
+    if mismatches:
+        print("\nFINAL BALANCES THAT DON'T MATCH THE EXCHANGE")
+        table = PrettyTable(
+            ["Location", "Coin", "Reported", "From Events", "Difference"]
+        )
+        for location, coin, expected, held in mismatches:
+            table.add_row(
+                [
+                    location,
+                    coin,
+                    from_units(expected),
+                    from_units(held),
+                    from_units(held - expected),
+                ]
+            )
+        print(table)
+
+    if overdrafts or mismatches:
+        sys.exit(1)
+    print(f"OK: {len(events)} events, no negative balances")
 
 
 @cli.command()
 @click.option("--verbose", help="Print progress", is_flag=True, default=False)
-def updatefmv(verbose):
+@click.pass_obj
+def updatefmv(portfolio, verbose):
     """Update the tx_fmv.yaml file for any missing figures"""
     # Load storage file and events and transactions
     try:
-        fmv_raw = yaml.load(open(XDG_DATA_HOME + "/mistbat/tx_fmv.yaml"))
+        fmv_raw = yaml.load(open(portfolio.data_dir + "/tx_fmv.yaml"))
     except FileNotFoundError:
         fmv_raw = {}
     fmv_data = {}
@@ -145,52 +444,66 @@ def updatefmv(verbose):
         fmvs["comment"] = comment
         fmv_data[id] = fmvs
 
-    events = get_events(loaders.all)
-    transactions = get_transactions(events, XDG_CONFIG_HOME + "/mistbat/tx_match.yaml")
+    events = get_events(portfolio.loaders, portfolio.config_dir, portfolio.data_dir)
+    transactions = get_transactions(events, portfolio.config_dir + "/tx_match.yaml")
+
+    # Stored fmvs may be keyed by a current or legacy transaction id
+    aliases = build_aliases(transactions)
+    stored_ids = {aliases[id]: id for id in fmv_data if aliases.get(id)}
 
     # Identify missing transactions
-    missing = [tx for tx in transactions if tx.missing_fmv and tx.id not in fmv_data]
+    missing = [tx for tx in transactions if tx.missing_fmv and tx not in stored_ids]
 
     # Error-check that stored transactions have necessary FMV info
-    stored = [tx for tx in transactions if tx.id in fmv_data]
-    for tx in stored:
-        stored_coins = set(fmv_data[tx.id].keys())
+    for tx, id in stored_ids.items():
+        stored_coins = set(fmv_data[id].keys())
         stored_coins.remove("comment")
         if set(tx.affected_coins) != stored_coins:
             raise RuntimeError(f"Transaction {tx.id} does not have correct fmv info")
 
-    # Confirm that the tx_fmv file doesn't have any unknown tx ids
-    diff = set(id for id in fmv_data) - set(tx.id for tx in transactions)
+    # Confirm that the tx_fmv file doesn't have any unknown or ambiguous tx ids
+    diff = set(id for id in fmv_data) - set(stored_ids.values())
     diff = ", ".join(diff)
     if len(diff) != 0:
         raise RuntimeError(
             f"Unrecognized transaction ids in tx_fmv.yaml: {diff}. Tip: Dont inlude fiat transaction fmvs."
         )
 
-    # Fill remaining missing transactions with public closing price
+    # Fill remaining missing transactions from prices already in the ledger, then
+    # the configured price providers. Whatever was found is saved even if a
+    # later lookup fails.
     print(f"{len(missing)} missing transactions") if verbose else None
-    for tx in missing:
-        print(f"{tx.id}")
-        fmv_data[tx.id] = {"comment": "from crytpocompare daily close api"}
-        for coin in tx.affected_coins:
-            coin_fmv = get_historical_close(coin, int(tx.time.timestamp()))
-            fmv_data[tx.id][coin] = coin_fmv
-            print(f"{coin}@{coin_fmv}\n") if verbose else None
-            time.sleep(0.1)
-
-    # Convert fmv_data back into fmv_raw and dump to disk
-    fmv_raw = {}
-    for id, coins in fmv_data.items():
-        comment = coins.pop("comment")
-        fmv_raw[id] = " ".join(f"{coin}@{price}" for coin, price in coins.items())
-        if comment:
-            fmv_raw[id] += " -- " + comment
-
-    yaml.dump(
-        fmv_raw,
-        open(XDG_DATA_HOME + "/mistbat/tx_fmv.yaml", "w"),
-        default_flow_style=False,
+    prices = PriceChain(
+        [LedgerPrices(transactions)] + portfolio.prices.providers,
+        portfolio.prices.cache,
     )
+    try:
+        for tx in missing:
+            print(f"{tx.id}")
+            fmvs = {}
+            sources = set()
+            for coin in tx.affected_coins:
+                ts = int(tx.time.timestamp())
+                coin_fmv, source = prices.close(coin, ts)
+                fmvs[coin] = coin_fmv
+                sources.add(source)
+                print(f"{coin}@{coin_fmv}\n") if verbose else None
+            fmvs["comment"] = "from " + ", ".join(sorted(sources))
+            fmv_data[tx.id] = fmvs
+    finally:
+        # Convert fmv_data back into fmv_raw and dump to disk
+        fmv_raw = {}
+        for id, coins in fmv_data.items():
+            comment = coins.pop("comment")
+            fmv_raw[id] = " ".join(f"{coin}@{price}" for coin, price in coins.items())
+            if comment:
+                fmv_raw[id] += " -- " + comment
+
+        yaml.dump(
+            fmv_raw,
+            open(portfolio.data_dir + "/tx_fmv.yaml", "w"),
+            default_flow_style=False,
+        )
 
 
 @cli.command()
@@ -203,20 +516,91 @@ def updatefmv(verbose):
 @click.option(
     "--year", help="Limit report to a particular year", is_flag=False, default=None
 )
-def tax(aggregated, year):
+@click.option(
+    "--method",
+    help="Lot selection method. SPECID reads lot selections from tx_lots.yaml",
+    type=click.Choice(list(LOT_METHODS)),
+    default="FIFO",
+)
+@click.option(
+    "--format",
+    "fmt",
+    help="Stream rows in a machine-readable format instead of printing tables",
+    type=click.Choice(FORM_8949_FORMATS),
+    default=None,
+)
+@click.option(
+    "--output",
+    help="File to write --format output to (default stdout)",
+    type=click.File("w"),
+    default="-",
+)
+@click.option(
+    "--from-checkpoint",
+    help="Start from the prior year-end checkpoint and read only this year's events",
+    is_flag=True,
+    default=False,
+)
+@click.option(
+    "--jobs",
+    help="Replay each coin's lots in a pool of this many processes",
+    type=int,
+    default=1,
+)
+@click.option(
+    "--watch",
+    help="Keep running and print what changes whenever config or data files change",
+    is_flag=True,
+    default=False,
+)
+@click.pass_obj
+def tax(
+    portfolio, aggregated, year, method, fmt, output, from_checkpoint, jobs, watch
+):
     """Generate the information needed for IRS Form 8949"""
-    events = get_events(loaders.all)
-    transactions = get_transactions(events, XDG_CONFIG_HOME + "/mistbat/tx_match.yaml")
-    transactions = annotate_transactions(
-        transactions, XDG_CONFIG_HOME + "/mistbat/tx_annotations.yaml"
-    )
-    transactions = fmv_transactions(
-        transactions, XDG_DATA_HOME + "/mistbat/tx_fmv.yaml"
-    )
-    transactions = imply_fees(transactions)
+    ledger_dir = portfolio.data_dir + "/ledger"
+    directories = [portfolio.config_dir, portfolio.data_dir]
+    if from_checkpoint:
+        if not year:
+            raise click.UsageError("--from-checkpoint needs --year")
+        pipeline = Pipeline(
+            lambda: read_partition(ledger_dir, year),
+            portfolio.config_dir,
+            portfolio.data_dir,
+            partial=True,
+        )
+        directories.append(ledger_dir)
+    else:
+        pipeline = portfolio_pipeline(portfolio)
+    if watch and output.name != "<stdout>":
+        raise click.UsageError("--watch prints to stdout and can't take --output")
+
+    def render():
+        opening_lots = None
+        if from_checkpoint:
+            opening_lots, _ = read_checkpoint(ledger_dir, int(year) - 1, method)
+        form_8949 = pipeline.form_8949(method, opening_lots, jobs)
+        if fmt:
+            write_form_8949(
+                form_8949,
+                fmt,
+                sys.stdout if watch else output,
+                aggregated=aggregated,
+                year=year,
+            )
+        else:
+            return print_form_8949(form_8949, aggregated, year)
+
+    if watch:
+        watch_pipeline(pipeline, render, directories)
+    else:
+        return render()
 
-    form_8949 = Form8949(transactions)
 
+def print_form_8949(form_8949, aggregated, year):
+    """Print the short-term and long-term tables of Form 8949 with their totals.
+    Returns the totals as a batch summary."""
+    summary = {}
     print("SHORT-TERM CAPITAL GAINS")
     table = PrettyTable(
         [
@@ -235,6 +619,7 @@ def tax(aggregated, year):
             total_gain += line[-1]
     print(table)
     print(f"TOTAL SHORT-TERM CAPITAL GAIN: USD {total_gain:0.2f}")
+    summary["short"] = {"Gain": to_units(round(total_gain, 2))}
 
     print("\nLONG-TERM CAPITAL GAINS")
     table = PrettyTable(
@@ -254,6 +639,8 @@ def tax(aggregated, year):
             total_gain += line[-1]
     print(table)
     print(f"TOTAL LONG-TERM CAPITAL GAIN: USD {total_gain:0.2f}")
+    summary["long"] = {"Gain": to_units(round(total_gain, 2))}
+    return summary
 
 
 @cli.command()
@@ -263,19 +650,47 @@ def tax(aggregated, year):
     is_flag=True,
     default=False,
 )
-def currentbasis(harvest):
+@click.option(
+    "--target",
+    help="Show the fewest lots to sell to realize this USD gain (negative for a loss)",
+    type=float,
+    default=None,
+)
+@click.option("--coin", help="Limit the --target harvest to one coin", default=None)
+@click.option(
+    "--method",
+    help="Lot selection method. SPECID reads lot selections from tx_lots.yaml",
+    type=click.Choice(list(LOT_METHODS)),
+    default="FIFO",
+)
+@click.option(
+    "--jobs",
+    help="Replay each coin's lots in a pool of this many processes",
+    type=int,
+    default=1,
+)
+@click.pass_obj
+def currentbasis(portfolio, harvest, target, coin, method, jobs):
     """See available basis by coin"""
-    events = get_events(loaders.all)
-    transactions = get_transactions(events, XDG_CONFIG_HOME + "/mistbat/tx_match.yaml")
+    events = get_events(portfolio.loaders, portfolio.config_dir, portfolio.data_dir)
+    transactions = get_transactions(events, portfolio.config_dir + "/tx_match.yaml")
     transactions = annotate_transactions(
-        transactions, XDG_CONFIG_HOME + "/mistbat/tx_annotations.yaml"
+        transactions, portfolio.config_dir + "/tx_annotations.yaml"
     )
     transactions = fmv_transactions(
-        transactions, XDG_DATA_HOME + "/mistbat/tx_fmv.yaml"
+        transactions, portfolio.data_dir + "/tx_fmv.yaml"
     )
     transactions = imply_fees(transactions)
 
-    form_8949 = Form8949(transactions)
+    lot_selections = None
+    if method == "SPECID":
+        lot_selections = get_lot_selections(portfolio.config_dir + "/tx_lots.yaml")
+    form_8949 = Form8949(transactions, method, lot_selections, jobs=jobs)
+
+    if target is not None:
+        print_harvest(portfolio, form_8949, to_units(target), coin)
+        return
+
     print("\nAVAILABLE BASIS REPORT")
     print(
         "Note: Coin totals will slighly deviate from 'holdings' since SENDRECV fees do not impact basis.\n"
@@ -289,32 +704,184 @@ def currentbasis(harvest):
     ]
     if harvest:
         table_headings.append("Cum. G/L at Spot Price")
-        spot_prices = get_coin_spot_prices(
-            set(form_8949.current_available_basis().keys()))
+        spot_prices = portfolio.prices.spot(
+            set(form_8949.current_available_basis().keys())
+        )
     table = PrettyTable(table_headings)
 
+    summary = {}
     for coin, available_basis in form_8949.current_available_basis().items():
-        coin_usd_total = 0.00
-        coin_amount_total = 0.00
-        cumulative_gain_or_loss = 0.00
+        coin_usd_total = 0
+        coin_amount_total = 0
+        cumulative_gain_or_loss = 0
         for basis in available_basis:
             time = basis[0].strftime("%Y-%m-%d %H:%M:%S")
-            amount = round(basis[1], 8)
-            fmv = round(basis[2], 2)
-            total = round(amount * fmv, 2)
+            amount = from_units(basis[1])
+            fmv = round(basis[2] / basis[1], 2)
+            total = round(from_units(basis[2]), 2)
             row = [coin, time, amount, fmv, total]
             if harvest:
-                cumulative_gain_or_loss += (spot_prices[coin] * amount) - (fmv * amount)
-                row.append(round(cumulative_gain_or_loss, 2))
+                cumulative_gain_or_loss += value(basis[1], spot_prices[coin]) - basis[2]
+                row.append(round(from_units(cumulative_gain_or_loss), 2))
             table.add_row(row)
-            coin_usd_total += total
-            coin_amount_total += amount
-        row = ["", "TOTAL", round(coin_amount_total, 8), "", round(coin_usd_total, 2)]
+            coin_usd_total += basis[2]
+            coin_amount_total += basis[1]
+        row = [
+            "",
+            "TOTAL",
+            from_units(coin_amount_total),
+            "",
+            round(from_units(coin_usd_total), 2),
+        ]
         if harvest:
             row.append("")
         table.add_row(row)
         table.add_row([" "] * len(table.field_names))
+        summary[coin] = {"Amount": coin_amount_total, "Total Basis": coin_usd_total}
+    print(table)
+    return summary
+
+
+@cli.command()
+@click.argument("scenario_file", type=click.Path(exists=True))
+@click.option(
+    "--method",
+    help="Lot selection method (FIFO, LIFO or HIFO)",
+    type=click.Choice(list(LOT_METHODS)),
+    default="FIFO",
+)
+@click.pass_obj
+def whatif(portfolio, scenario_file, method):
+    """Simulate hypothetical sales against the current open lots"""
+    if method == "SPECID":
+        raise click.BadParameter(
+            "hypothetical sales have no lot selections, use FIFO, LIFO or HIFO",
+            param_hint="--method",
+        )
+    events = get_events(portfolio.loaders, portfolio.config_dir, portfolio.data_dir)
+    transactions = get_transactions(events, portfolio.config_dir + "/tx_match.yaml")
+    transactions = annotate_transactions(
+        transactions, portfolio.config_dir + "/tx_annotations.yaml"
+    )
+    transactions = fmv_transactions(
+        transactions, portfolio.data_dir + "/tx_fmv.yaml"
+    )
+    transactions = imply_fees(transactions)
+    form_8949 = Form8949(transactions, method)
+
+    # Only hit the spot price API if some disposal doesn't name a price
+    disposals_raw = yaml.load(open(scenario_file))
+    spot_prices = None
+    unpriced = set(d["coin"] for d in disposals_raw if d.get("price") is None)
+    if unpriced:
+        spot_prices = portfolio.prices.spot(unpriced)
+    disposals = get_whatif_disposals(disposals_raw, spot_prices)
+
+    table = PrettyTable(
+        [
+            "Scenario",
+            "Coin",
+            "Amount",
+            "Date Sold",
+            "Proceeds",
+            "Basis",
+            "Gain",
+            "Short-Term Gain",
+            "Long-Term Gain",
+        ]
+    )
+    totals = {}
+    for row in form_8949.whatif(disposals):
+        scenario, coin, amount, date, proceeds, basis, gain, short, long = row
+        table.add_row(
+            [
+                scenario,
+                coin,
+                from_units(amount),
+                date.strftime("%Y-%m-%d"),
+                round(from_units(proceeds), 2),
+                round(from_units(basis), 2),
+                round(from_units(gain), 2),
+                round(from_units(short), 2),
+                round(from_units(long), 2),
+            ]
+        )
+        total = totals.setdefault((scenario, date.year), [0, 0])
+        total[0] += short
+        total[1] += long
+    print(table)
+
+    # Gains already realized in each year the scenarios touch
+    realized = {}
+    for scenario, year in totals:
+        if year in realized:
+            continue
+        realized[year] = []
+        for term in ("short", "long"):
+            rows = form_8949.generate_form(term=term, aggregated=True, year=year)
+            realized[year].append(
+                sum(row[-1] for row in rows if str(row[-1]).strip())
+            )
+
+    for (scenario, year), (short, long) in totals.items():
+        short, long = from_units(short), from_units(long)
+        print(
+            "{} ({}): SHORT-TERM USD {:0.2f} + {:0.2f} = {:0.2f}, LONG-TERM USD {:0.2f} + {:0.2f} = {:0.2f}".format(
+                scenario,
+                year,
+                realized[year][0],
+                short,
+                realized[year][0] + short,
+                realized[year][1],
+                long,
+                realized[year][1] + long,
+            )
+        )
+
+
+def print_harvest(portfolio, form_8949, target, coin):
+    """Print the lots to sell to realize the target gain or loss at spot price."""
+    coins = [coin] if coin else list(form_8949.assets.keys())
+    spot_prices = portfolio.prices.spot(set(coins))
+    rows = form_8949.harvest(spot_prices, target, coin)
+
+    print(
+        "\nHARVEST PLAN FOR USD {:0.2f} {}".format(
+            from_units(target), coin or "(ALL COINS)"
+        )
+    )
+    table = PrettyTable(
+        [
+            "Coin",
+            "Date Acquired",
+            "Amount",
+            "Basis per Coin",
+            "Spot Price",
+            "G/L at Spot Price",
+            "Term",
+        ]
+    )
+    totals = {"short": 0, "long": 0}
+    for row in rows:
+        coin, acquired, amount, basis, spot, gain, term = row
+        table.add_row(
+            [
+                coin,
+                acquired.strftime("%Y-%m-%d %H:%M:%S"),
+                from_units(amount),
+                round(basis / amount, 2),
+                round(spot, 2),
+                round(from_units(gain), 2),
+                term.upper(),
+            ]
+        )
+        totals[term] += gain
     print(table)
+    print(f"SHORT-TERM G/L: USD {from_units(totals['short']):0.2f}")
+    print(f"LONG-TERM G/L: USD {from_units(totals['long']):0.2f}")
+    print(f"TOTAL G/L: USD {from_units(totals['short'] + totals['long']):0.2f}")
+    if round(from_units(totals["short"] + totals["long"] - target), 2) != 0:
+        print("Note: Target not reachable with the available lots.")
 
 
 @cli.command()
@@ -324,52 +891,31 @@ def currentbasis(harvest):
     is_flag=True,
     default=False,
 )
-def holdings(aggregated):
+@click.pass_obj
+def holdings(portfolio, aggregated):
     """List all coins held with USD values. Also list holdings by exchange."""
-    totals = {}
-    events = get_events(loaders.all)
+    events = get_events(portfolio.loaders, portfolio.config_dir, portfolio.data_dir)
 
-    # Get raw accounting-style entries for each event e.g., (coinbase, LTC, +1.00)
-    all_entries = [[], [], []]  # location, coin, amount (will be zipped)
-    for ev in events:
-        entries = ev.entries()
-        # Try-catch block needed to deal with single vs multiple entries per event
-        try:
-            locations, coins, amounts = zip(*entries)
-            all_entries[0].extend(locations)
-            all_entries[1].extend(coins)
-            all_entries[2].extend(amounts)
-        except TypeError:
-            location, coin, amount = entries
-            all_entries[0].append(location)
-            all_entries[1].append(coin)
-            all_entries[2].append(amount)
-
-    # Process the accounting-style entries into a nested dict of
-    # location -> coin -> amount
-    for location, coin, amount in zip(*all_entries):
-        totals.setdefault(location, {}).setdefault(coin, 0)
-        totals[location][coin] += amount
+    # Nested dict of location -> coin -> amount
+    totals = get_holdings(events)
 
     # Get set of coin symbols to prepare to poll coinmarketcap API
-    my_coins = set(all_entries[1])
-    my_coins.remove("USD")
+    my_coins = set(coin for coins in totals.values() for coin in coins)
 
     # Poll coinmarketcap API for spot prices of all coins and store them in a dict
-    coin_spotprices = get_coin_spot_prices(my_coins)
+    coin_spotprices = portfolio.prices.spot(my_coins)
 
     total_usd = 0
     location_usd = {}
     total_bycoin = {}
     for location in totals:
-        if "USD" in totals[location]:
-            del totals[location]["USD"]
-
         location_usd[location] = 0
         for coin, amount in totals[location].items():
-            if round(amount, 9) != 0:
+            if amount != 0:
                 total_bycoin[coin] = total_bycoin.get(coin, 0) + amount
-                location_usd[location] += amount * coin_spotprices[coin]
+                location_usd[location] += from_units(
+                    value(amount, coin_spotprices[coin])
+                )
         # print('Total (in USD) at {}: ${:.2f}\n'.format(location, location_usd))
         total_usd += location_usd[location]
 
@@ -378,8 +924,8 @@ def holdings(aggregated):
         # Sort total_bycoin by USD value
         coins_sorted_usd = []
         for coin, amount in total_bycoin.items():
-            usd_value = amount * coin_spotprices[coin]
-            coins_sorted_usd.append((coin, amount, usd_value))
+            usd_value = from_units(value(amount, coin_spotprices[coin]))
+            coins_sorted_usd.append((coin, from_units(amount), usd_value))
         coins_sorted_usd.sort(key=lambda x: x[2], reverse=True)
 
         # Print out the total coin values sorted by value
@@ -400,13 +946,13 @@ def holdings(aggregated):
             # Sort coins within a location by USD value
             coins_sorted_usd = []
             for coin, amount in totals[location].items():
-                usd_value = amount * coin_spotprices[coin]
-                coins_sorted_usd.append((coin, amount, usd_value))
+                usd_value = from_units(value(amount, coin_spotprices[coin]))
+                coins_sorted_usd.append((coin, from_units(amount), usd_value))
             coins_sorted_usd.sort(key=lambda x: x[2], reverse=True)
 
             # Print out the total coin values sorted by value
             for coin in coins_sorted_usd:
-                if round(coin[1], 9) != 0:
+                if coin[1] != 0:
                     print(
                         "    {} {:.8f} (USD {:.2f} @ USD {:.2f} per {})".format(
                             coin[0], coin[1], coin[2], coin_spotprices[coin[0]], coin[0]
@@ -415,20 +961,289 @@ def holdings(aggregated):
 
     print("-----------------")
     print("Total Portfolio Value: USD {:.2f}".format(total_usd))
+    return {
+        coin: {"Amount": amount, "USD Value": value(amount, coin_spotprices[coin])}
+        for coin, amount in total_bycoin.items()
+    }
+
+
+@cli.command()
+@click.option(
+    "--year",
+    help="Year of the Form 8949 preview (default this year)",
+    type=int,
+    default=None,
+)
+@click.option(
+    "--method",
+    help="Lot selection method. SPECID reads lot selections from tx_lots.yaml",
+    type=click.Choice(list(LOT_METHODS)),
+    default="FIFO",
+)
+@click.option(
+    "--format",
+    "fmt",
+    help="Output format",
+    type=click.Choice(REPORT_FORMATS),
+    default="text",
+)
+@click.option(
+    "--output",
+    help="File to write the report to (default stdout)",
+    type=click.File("w"),
+    default="-",
+)
+@click.option(
+    "--jobs",
+    help="Replay each coin's lots in a pool of this many processes",
+    type=int,
+    default=1,
+)
+@click.pass_obj
+def report(portfolio, year, method, fmt, output, jobs):
+    """Report holdings, open lots, unrealized gains, fees and a Form 8949
+    preview from one run of the pipeline"""
+    events = get_events(portfolio.loaders, portfolio.config_dir, portfolio.data_dir)
+    transactions = get_transactions(events, portfolio.config_dir + "/tx_match.yaml")
+    transactions = annotate_transactions(
+        transactions, portfolio.config_dir + "/tx_annotations.yaml"
+    )
+    transactions = fmv_transactions(
+        transactions, portfolio.data_dir + "/tx_fmv.yaml"
+    )
+    transactions = imply_fees(transactions)
+
+    lot_selections = None
+    if method == "SPECID":
+        lot_selections = get_lot_selections(portfolio.config_dir + "/tx_lots.yaml")
+    form_8949 = Form8949(transactions, method, lot_selections, jobs=jobs)
+
+    # One spot price lookup for everything held or in an open lot
+    holdings = get_holdings(events)
+    coins = set(
+        coin
+        for held in holdings.values()
+        for coin, amount in held.items()
+        if amount != 0
+    )
+    for coin, available_basis in form_8949.current_available_basis().items():
+        if available_basis:
+            coins.add(coin)
+    spot_prices = portfolio.prices.spot(coins)
+
+    now = datetime.datetime.now(pytz.utc)
+    write_report(
+        build_report(
+            holdings, transactions, form_8949, spot_prices, year or now.year, now
+        ),
+        fmt,
+        output,
+    )
+
+
+@cli.command()
+@click.option(
+    "--method",
+    help="Lot selection method. SPECID reads lot selections from tx_lots.yaml",
+    type=click.Choice(list(LOT_METHODS)),
+    default="FIFO",
+)
+@click.pass_obj
+def checkpoint(portfolio, method):
+    """Partition events by year and checkpoint open lots at each year end"""
+    events = get_events(portfolio.loaders, portfolio.config_dir, portfolio.data_dir)
+    transactions = get_transactions(events, portfolio.config_dir + "/tx_match.yaml")
+    transactions = fmv_transactions(
+        transactions, portfolio.data_dir + "/tx_fmv.yaml"
+    )
+    transactions = imply_fees(transactions)
+
+    lot_selections = None
+    if method == "SPECID":
+        lot_selections = get_lot_selections(portfolio.config_dir + "/tx_lots.yaml")
+    form_8949 = Form8949(transactions, method, lot_selections)
+
+    ledger_dir = portfolio.data_dir + "/ledger"
+    years = write_partitions(transactions, ledger_dir)
+    lots_by_year = form_8949.open_lots_by_year(years[-1])
+    balances = balances_by_year(events, years)
+    for year in years:
+        write_checkpoint(
+            ledger_dir, year, method, lots_by_year.get(year, {}), balances[year]
+        )
+        print(f"{year}: partition and {method} checkpoint written")
+    write_lineage(ledger_dir, method, form_8949.lineage(), transactions)
+    print(f"{method} lineage index written")
+    print(
+        "Older partitions are only needed to rebuild checkpoints and can be archived."
+    )
+
+
+@cli.command()
+@click.argument("txid")
+@click.option(
+    "--method",
+    help="Lot selection method the lineage index was written for",
+    type=click.Choice(list(LOT_METHODS)),
+    default="FIFO",
+)
+@click.pass_obj
+def trace(portfolio, txid, method):
+    """Trace a disposal back to the acquisitions and transfers its lots came from"""
+    index = read_lineage(portfolio.data_dir + "/ledger", method)
+    aliases = dict(index["aliases"])
+    aliases.update((id, id) for id in index["transactions"])
+    try:
+        tx_id = lookup(aliases, txid)
+    except KeyError:
+        raise click.BadParameter(
+            f"{txid} is not in the {method} lineage index", param_hint="TXID"
+        )
+    print(index["transactions"][tx_id])
+    print_lineage(index, tx_id, 1)
+
+
+def print_lineage(index, tx_id, depth):
+    """Print the lots a disposal used up and, for lots acquired by disposing of
+    another coin, the lineage of that disposal in turn"""
+    indent = "   " * depth
+    for coin, lot_id, amount, hops in index["links"].get(tx_id, []):
+        print(f"{indent}<- {coin} {from_units(amount):.8f} from lot {lot_id}")
+        for hop in hops:
+            print(f"{indent}   via {index['transactions'][hop]}")
+        print(f"{indent}   {index['transactions'].get(lot_id, 'opening lot')}")
+        print_lineage(index, lot_id, depth + 1)
+
+
+BATCH_COMMANDS = ["tax", "holdings", "currentbasis"]
+# Heading of the row keys in each command's summary
+BATCH_SUMMARY_KEYS = {"tax": "Term", "holdings": "Coin", "currentbasis": "Coin"}
+
+
+def run_portfolio(directory, command, price_cache, loader_names=None):
+    """Run one mistbat command against a portfolio directory, capturing its output.
+
+    Returns (directory, exit status, output, seconds taken, summary). The
+    summary is what the command returned, {key: {column: base units}}, or
+    None if it ran in a mode that doesn't summarize (e.g., tax --format)."""
+    args = ["--config-dir", directory, "--data-dir", directory]
+    args += ["--price-cache", price_cache]
+    if loader_names:
+        args += ["--loaders", loader_names]
+    args += command
+    start = time.perf_counter()
+    output = io.StringIO()
+    status = 0
+    summary = None
+    with redirect_stdout(output):
+        try:
+            summary = cli.main(args, prog_name="mistbat", standalone_mode=False)
+        except click.ClickException as e:
+            print(f"Error: {e.format_message()}")
+            status = e.exit_code
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            print(f"Error: {e.__class__.__name__}: {e}")
+            status = 1
+    if status != 0:
+        summary = None
+    return directory, status, output.getvalue(), time.perf_counter() - start, summary
+
+
+def print_batch_summary(command, summaries):
+    """Print the sum of the portfolios' summaries, skipping portfolios that
+    failed or didn't summarize"""
+    summaries = [summary for summary in summaries if summary]
+    if not summaries:
+        return
+    totals = {}
+    for summary in summaries:
+        for key, columns in summary.items():
+            row = totals.setdefault(key, {})
+            for column, amount in columns.items():
+                row[column] = row.get(column, 0) + amount
+
+    columns = list(next(iter(totals.values())))
+    table = PrettyTable([BATCH_SUMMARY_KEYS[command]] + columns)
+    for key, row in totals.items():
+        table.add_row(
+            [key]
+            + [
+                from_units(row.get(column, 0))
+                if column == "Amount"
+                else round(from_units(row.get(column, 0)), 2)
+                for column in columns
+            ]
+        )
+    print(f"COMBINED {command.upper()} SUMMARY OF {len(summaries)} PORTFOLIOS")
+    print(table)
+
+
+@cli.command()
+@click.argument("command", type=click.Choice(BATCH_COMMANDS))
+@click.argument(
+    "portfolios", nargs=-1, required=True, type=click.Path(exists=True, file_okay=False)
+)
+@click.option(
+    "--args",
+    "command_args",
+    help="Options passed to each run, e.g. '--year 2018 --aggregated'",
+    default="",
+)
+@click.option(
+    "--jobs",
+    help="Portfolios to process at once (default: one per CPU)",
+    type=int,
+    default=None,
+)
+@click.pass_obj
+def batch(portfolio, command, portfolios, command_args, jobs):
+    """Run tax, holdings or currentbasis for many portfolio directories.
+
+    Each portfolio directory holds its own config and data files side by side.
+    All runs share one price cache. After each portfolio's output comes a
+    combined summary: gains by term for tax, and amounts with their USD value
+    or basis by coin for holdings and currentbasis."""
+    command = [command] + shlex.split(command_args)
+    # Each portfolio uses its own loaders.yaml unless --loaders was given
+    params = click.get_current_context().parent.params
+    price_cache, loader_names = params["price_cache"], params["loader_names"]
+
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        runs = [
+            pool.submit(run_portfolio, directory, command, price_cache, loader_names)
+            for directory in portfolios
+        ]
+        results = [run.result() for run in runs]
+
+    for directory, status, output, seconds, summary in results:
+        print(f"==> {directory} <==")
+        print(output)
+
+    print_batch_summary(command[0], [result[4] for result in results])
+
+    table = PrettyTable(["Portfolio", "Exit Status", "Seconds"])
+    for directory, status, output, seconds, summary in results:
+        table.add_row([directory, status, round(seconds, 2)])
+    print(table)
+    failed = sum(1 for result in results if result[1] != 0)
+    print(f"{len(results) - failed} of {len(results)} portfolios succeeded")
+    if failed:
+        sys.exit(1)
 
 
 @cli.command()
 @click.argument("exchange")
-def remoteupdate(exchange):
-    """Fetch updated coinbase information from remote"""
-    if exchange == "coinbase":
-        loaders.coinbase.update_from_remote()
-    elif exchange == "gdax":
-        loaders.gdax.update_from_remote()
-    elif exchange == "binance":
-        loaders.binance.update_from_remote()
-    else:
+@click.pass_obj
+def remoteupdate(portfolio, exchange):
+    """Fetch updated exchange information from remote"""
+    try:
+        (loader,) = loaders.load([exchange], portfolio.config_dir)
+    except KeyError:
         print("Bad exchange specified.")
+        return
+    loader.update_from_remote(portfolio.config_dir, portfolio.data_dir)
 
 
 if __name__ == "__main__":
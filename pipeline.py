@@ -0,0 +1,90 @@
+import os
+from tax import Form8949, get_lot_selections
+from transactions import (
+    get_transactions,
+    annotate_transactions,
+    fmv_transactions,
+    imply_fees,
+)
+
+# The stages from raw data to Form 8949, in order
+STAGES = ["events", "transactions", "form_8949"]
+
+# The config and data files each stage reads besides the output of the stage
+# before it. Any other file is taken to be a source of events.
+STAGE_FILES = {
+    "transactions": ["tx_match.yaml", "tx_annotations.yaml", "tx_fmv.yaml"],
+    "form_8949": ["tx_lots.yaml"],
+}
+
+
+class Pipeline(object):
+    """Events, transactions and the Form 8949 lot replay of a portfolio, each
+    computed when first asked for and kept until invalidate() is told that a
+    file it reads has changed.
+
+    Transactions are annotated and given their fmvs in place, so they are
+    rebuilt from the events whenever any of their files change."""
+
+    def __init__(self, load_events, config_dir, data_dir, annotate=True, partial=False):
+        self.load_events = load_events
+        self.config_dir = config_dir
+        self.data_dir = data_dir
+        self.annotate = annotate
+        self.partial = partial
+        self.cached = {}
+        self.computed = set()  # Stages computed at least once
+
+    def events(self):
+        if "events" not in self.cached:
+            self.cached["events"] = self.load_events()
+            self.computed.add("events")
+        return self.cached["events"]
+
+    def transactions(self):
+        if "transactions" not in self.cached:
+            transactions = get_transactions(
+                self.events(),
+                self.config_dir + "/tx_match.yaml",
+                partial=self.partial,
+            )
+            if self.annotate:
+                transactions = annotate_transactions(
+                    transactions,
+                    self.config_dir + "/tx_annotations.yaml",
+                    partial=self.partial,
+                )
+            transactions = fmv_transactions(
+                transactions, self.data_dir + "/tx_fmv.yaml"
+            )
+            self.cached["transactions"] = imply_fees(transactions)
+            self.computed.add("transactions")
+        return self.cached["transactions"]
+
+    def form_8949(self, method="FIFO", opening_lots=None, jobs=1):
+        if "form_8949" not in self.cached:
+            lot_selections = None
+            if method == "SPECID":
+                lot_selections = get_lot_selections(
+                    self.config_dir + "/tx_lots.yaml"
+                )
+            self.cached["form_8949"] = Form8949(
+                self.transactions(), method, lot_selections, opening_lots, jobs
+            )
+            self.computed.add("form_8949")
+        return self.cached["form_8949"]
+
+    def invalidate(self, paths):
+        """Drop the stages that read any of the changed files and the stages
+        after them. Returns the names of those that will be recomputed."""
+        first = len(STAGES)
+        for path in paths:
+            name = os.path.basename(path)
+            stage = "events"
+            for file_stage, files in STAGE_FILES.items():
+                if name in files:
+                    stage = file_stage
+            first = min(first, STAGES.index(stage))
+        for stage in STAGES[first:]:
+            self.cached.pop(stage, None)
+        return [stage for stage in STAGES[first:] if stage in self.computed]
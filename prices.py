@@ -0,0 +1,297 @@
+"""Price providers, tried in priority order.
+
+A provider answers spot(coins), returning {coin: USD price} for the coins it
+can price, and close(coin, ts), returning the USD daily close for the day of
+the unix timestamp or None. PriceChain asks each provider in turn and only
+passes on what is still unpriced, so a local cache or price files on disk
+answer before any remote API is touched.
+
+The chain is configured by prices.yaml (see prices.yaml.example).
+"""
+import datetime
+import mmap
+import os
+import time
+import yaml
+import cryptocompare
+from transactions import ExchangeTx, FiatExchangeTx
+
+# Spot prices in the cache are reused for this many seconds
+SPOT_CACHE_TTL = 300
+
+
+class CacheProvider:
+    """Spot prices fetched in the last SPOT_CACHE_TTL seconds and every daily
+    close fetched before, kept in one JSON file that several processes can
+    share."""
+
+    description = "cached daily close"
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.entries = cryptocompare.read_json_file(cache_file)
+
+    @staticmethod
+    def _close_key(coin, ts):
+        day = datetime.datetime.fromtimestamp(ts, datetime.timezone.utc)
+        return f"close:{coin}:{day:%Y-%m-%d}"
+
+    def spot(self, coins):
+        now = time.time()
+        prices = {}
+        for coin in coins:
+            fetched = self.entries.get("spot:" + coin)
+            if fetched and now - fetched[0] < SPOT_CACHE_TTL:
+                prices[coin] = fetched[1]
+        return prices
+
+    def close(self, coin, ts):
+        return self.entries.get(self._close_key(coin, ts))
+
+    def store(self, spot=None, closes=None):
+        """Save spot prices ({coin: price}) and closes ({(coin, ts): price})."""
+        now = time.time()
+        entries = {"spot:" + coin: [now, spot[coin]] for coin in spot or {}}
+        for (coin, ts), price in (closes or {}).items():
+            entries[self._close_key(coin, ts)] = price
+        if entries:
+            self.entries.update(entries)
+            cryptocompare.merge_json_file(self.cache_file, entries)
+
+
+class FileProvider:
+    """Daily closes from <COIN>.csv files in a directory.
+
+    Rows are either `time,close` or klines (`open time,open,high,low,close,...`
+    as exported by Binance), sorted by time. Times are unix seconds,
+    milliseconds or ISO dates. Files are memory-mapped and binary searched,
+    so even multi-gigabyte archives are only touched where needed.
+    """
+
+    description = "local price files"
+
+    # Rows older than this aren't used for a lookup
+    MAX_AGE = 24 * 60 * 60
+
+    def __init__(self, directory):
+        self.directory = os.path.expanduser(directory)
+        self.maps = {}
+
+    def _map(self, coin):
+        if coin not in self.maps:
+            self.maps[coin] = None
+            filename = os.path.join(self.directory, coin + ".csv")
+            if os.path.exists(filename) and os.path.getsize(filename) > 0:
+                with open(filename, "rb") as f:
+                    self.maps[coin] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.maps[coin]
+
+    @staticmethod
+    def _parse(line):
+        """Return (unix time, close) for a row, or None for headers and blanks."""
+        fields = line.split(b",")
+        if len(fields) < 2:
+            return None
+        close = fields[4] if len(fields) >= 5 else fields[1]
+        stamp = fields[0].strip().decode()
+        try:
+            if stamp.isdigit():
+                ts = int(stamp)
+                ts = ts // 1000 if ts > 10 ** 11 else ts
+            else:
+                parsed = datetime.datetime.fromisoformat(stamp)
+                if parsed.tzinfo is None:
+                    parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+                ts = int(parsed.timestamp())
+            return ts, float(close)
+        except ValueError:
+            return None
+
+    def spot(self, coins):
+        return {}
+
+    def close(self, coin, ts):
+        mm = self._map(coin)
+        if mm is None:
+            return None
+
+        # Find the last row at or before ts. Each probe reads the line
+        # around the midpoint, so only O(log n) pages are faulted in.
+        lo, hi = 0, len(mm)
+        best = None
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = mm.rfind(b"\n", 0, mid) + 1
+            end = mm.find(b"\n", start)
+            end = len(mm) if end == -1 else end
+            row = self._parse(mm[start:end])
+            if row is None or row[0] <= ts:
+                best = row or best
+                lo = end + 1
+            else:
+                hi = start
+
+        if best is None or ts - best[0] > self.MAX_AGE:
+            return None
+        return best[1]
+
+
+class LedgerPrices:
+    """Prices the ledger already knows: the rates of fiat exchanges, fmvs the
+    exchanges reported (e.g., Coinbase's native amounts) and the relative
+    prices of crypto-crypto trades.
+
+    close(coin, ts) uses the observation of the coin nearest in time on the
+    same UTC day. Failing that, it chains through that day's crypto-crypto
+    trades to a coin that has one. Trades at exactly ts are left out of the
+    chain, since they are the transaction being priced.
+    """
+
+    description = "ledger trades"
+
+    def __init__(self, transactions):
+        self.observed = {}  # (coin, day) -> [(time, USD price)]
+        self.pairs = {}  # day -> {coin: [(time, other coin, other coins per coin)]}
+
+        for tx in transactions:
+            if isinstance(tx, FiatExchangeTx):
+                if tx.investing:
+                    self._observe(tx.buy_coin, tx.time, tx.sell_amount / tx.buy_amount)
+                else:
+                    self._observe(tx.sell_coin, tx.time, tx.buy_amount / tx.sell_amount)
+                continue
+
+            for name in ("send", "receive", "exchange"):
+                event = getattr(tx, name, None)
+                if getattr(event, "fmv", None):
+                    self._observe(event.coin, event.time, event.fmv)
+                if getattr(event, "buy_fmv", None):
+                    self._observe(event.buy_coin, event.time, event.buy_fmv)
+                    self._observe(event.sell_coin, event.time, event.sell_fmv)
+
+            if isinstance(tx, ExchangeTx):
+                day = self.pairs.setdefault(tx.time.date(), {})
+                day.setdefault(tx.buy_coin, []).append(
+                    (tx.time, tx.sell_coin, tx.sell_amount / tx.buy_amount)
+                )
+                day.setdefault(tx.sell_coin, []).append(
+                    (tx.time, tx.buy_coin, tx.buy_amount / tx.sell_amount)
+                )
+
+    def _observe(self, coin, time, price):
+        if float(price) > 0:
+            self.observed.setdefault((coin, time.date()), []).append(
+                (time, float(price))
+            )
+
+    def _nearest(self, observations, when):
+        return min(observations, key=lambda obs: abs(obs[0] - when))
+
+    def spot(self, coins):
+        return {}
+
+    def close(self, coin, ts):
+        when = datetime.datetime.fromtimestamp(ts, datetime.timezone.utc)
+        day = when.date()
+
+        # Breadth-first through the day's trades, so the shortest chain wins
+        ratios = {coin: 1.0}
+        frontier = [coin]
+        while frontier:
+            for current in frontier:
+                observations = self.observed.get((current, day))
+                if observations:
+                    return ratios[current] * self._nearest(observations, when)[1]
+            following = []
+            for current in frontier:
+                trades = [
+                    trade
+                    for trade in self.pairs.get(day, {}).get(current, [])
+                    if trade[0] != when and trade[1] not in ratios
+                ]
+                for other in set(trade[1] for trade in trades):
+                    _, _, ratio = self._nearest(
+                        [trade for trade in trades if trade[1] == other], when
+                    )
+                    ratios[other] = ratios[current] * ratio
+                    following.append(other)
+            frontier = following
+        return None
+
+
+class CryptoCompareProvider:
+    """The cryptocompare API."""
+
+    description = "crytpocompare daily close api"
+
+    def spot(self, coins):
+        return cryptocompare.get_coin_spot_prices(coins)
+
+    def close(self, coin, ts):
+        price = cryptocompare.get_historical_close(coin, ts)
+        # Stay well inside the API's rate limit
+        time.sleep(0.1)
+        return price
+
+
+class PriceChain:
+    """Providers in priority order. Remote answers are saved to the cache,
+    if there is one."""
+
+    def __init__(self, providers, cache=None):
+        self.providers = providers
+        self.cache = cache
+
+    def spot(self, coins):
+        """Return {coin: USD spot price} for every coin. Raises KeyError if no
+        provider can price some coin."""
+        prices = {}
+        for provider in self.providers:
+            missing = set(coins) - set(prices)
+            if not missing:
+                break
+            found = provider.spot(missing)
+            prices.update(found)
+            if self.cache and isinstance(provider, CryptoCompareProvider):
+                self.cache.store(spot=found)
+
+        missing = set(coins) - set(prices)
+        if missing:
+            raise KeyError("No spot price for " + ", ".join(sorted(missing)))
+        return prices
+
+    def close(self, coin, ts):
+        """Return (USD daily close, description of where it came from) for
+        the coin on the day of the unix timestamp. Raises KeyError if no
+        provider has it."""
+        for provider in self.providers:
+            price = provider.close(coin, ts)
+            if price is not None:
+                if self.cache and isinstance(provider, CryptoCompareProvider):
+                    self.cache.store(closes={(coin, ts): price})
+                return price, provider.description
+        raise KeyError(f"No daily close for {coin} at {ts}")
+
+
+def get_price_chain(config_dir, cache_file):
+    """Build the PriceChain configured in prices.yaml. Without one, the chain
+    is the cache followed by cryptocompare."""
+    try:
+        with open(config_dir + "/prices.yaml") as f:
+            config = yaml.load(f) or {}
+    except FileNotFoundError:
+        config = {}
+
+    cache = CacheProvider(cache_file)
+    providers = []
+    for name in config.get("providers", ["cache", "files", "cryptocompare"]):
+        if name == "cache":
+            providers.append(cache)
+        elif name == "files":
+            if config.get("files"):
+                providers.append(FileProvider(config["files"]))
+        elif name == "cryptocompare":
+            providers.append(CryptoCompareProvider())
+        else:
+            raise Exception(f"Unknown price provider in prices.yaml: {name}")
+    return PriceChain(providers, cache if cache in providers else None)
@@ -0,0 +1,229 @@
+"""Portfolio report: holdings, open lots with their unrealized gain, fees and a
+preview of the year's Form 8949, all from a single run of the pipeline and a
+single spot price lookup, rendered as text or JSON."""
+import datetime as dt
+import json
+import pytz
+from prettytable import PrettyTable
+from ledger import event_entries
+from units import from_units, value
+
+REPORT_FORMATS = ["text", "json"]
+
+
+def get_holdings(events):
+    """Return {location: {coin: amount}} of the coins held at each location,
+    summed from the accounting-style entries of the events. USD is left out."""
+    totals = {}
+    for ev in events:
+        for location, coin, amount in event_entries(ev):
+            totals.setdefault(location, {}).setdefault(coin, 0)
+            totals[location][coin] += amount
+    for location in totals:
+        totals[location].pop("USD", None)
+    return totals
+
+
+def fee_totals(transactions, ignore_negative=False):
+    """Return {transaction type: total USD fee}"""
+    fees = {}
+    for tx in transactions:
+        fee = max(tx.fee_usd, 0) if ignore_negative else tx.fee_usd
+        fees[tx.__class__.__name__] = fees.get(tx.__class__.__name__, 0) + fee
+    return fees
+
+
+def _usd(units):
+    return round(from_units(units), 2)
+
+
+def build_report(holdings, transactions, form_8949, spot_prices, year, now=None):
+    """Assemble the report as plain values, ready to render or dump as JSON.
+
+    Args:
+        holdings: {location: {coin: amount}} as returned by get_holdings.
+        transactions: Transactions with their fees implied.
+        form_8949: Form8949 of the transactions.
+        spot_prices: {coin: USD spot price} of every coin held or in an open lot.
+        year: Year of the Form 8949 preview.
+        now: Time the open lots are valued at, for their term.
+    """
+    now = now or dt.datetime.now(pytz.utc)
+
+    locations = {}
+    for location, coins in holdings.items():
+        held = {
+            coin: {
+                "amount": from_units(amount),
+                "usd": _usd(value(amount, spot_prices[coin])),
+            }
+            for coin, amount in coins.items()
+            if amount != 0
+        }
+        locations[location] = {
+            "usd": round(sum(coin["usd"] for coin in held.values()), 2),
+            "coins": held,
+        }
+
+    basis = {}
+    for coin, lots in form_8949.unrealized(spot_prices, now).items():
+        if not lots:
+            continue
+        gains = {"short": 0, "long": 0}
+        for lot in lots:
+            gains[lot[4]] += lot[3]
+        amount = sum(lot[1] for lot in lots)
+        cost = sum(lot[2] for lot in lots)
+        basis[coin] = {
+            "amount": from_units(amount),
+            "basis": _usd(cost),
+            "spot_price": spot_prices[coin],
+            "value": _usd(value(amount, spot_prices[coin])),
+            "unrealized_gain": _usd(gains["short"] + gains["long"]),
+            "short_term_gain": _usd(gains["short"]),
+            "long_term_gain": _usd(gains["long"]),
+            "lots": [
+                {
+                    "acquired": acquired.isoformat(),
+                    "amount": from_units(lot_amount),
+                    "basis": _usd(lot_cost),
+                    "gain": _usd(gain),
+                    "term": term,
+                }
+                for acquired, lot_amount, lot_cost, gain, term in lots
+            ],
+        }
+
+    fees = fee_totals(transactions)
+    positive_fees = fee_totals(transactions, ignore_negative=True)
+
+    realized = {}
+    for term in ("short", "long"):
+        rows = form_8949.generate_form(term=term, aggregated=False, year=year)
+        realized[term] = round(sum(row[-1] for row in rows if str(row[-1]).strip()), 2)
+
+    return {
+        "generated": now.isoformat(),
+        "method": form_8949.method,
+        "spot_prices": dict(sorted(spot_prices.items())),
+        "holdings": {
+            "locations": locations,
+            "total_usd": round(sum(l["usd"] for l in locations.values()), 2),
+        },
+        "basis": basis,
+        "unrealized_gain": round(
+            sum(coin["unrealized_gain"] for coin in basis.values()), 2
+        ),
+        "fees": {
+            "by_type": {typ: _usd(fee) for typ, fee in fees.items()},
+            "total": _usd(sum(fees.values())),
+            "by_type_positive": {typ: _usd(fee) for typ, fee in positive_fees.items()},
+            "total_positive": _usd(sum(positive_fees.values())),
+        },
+        "tax_preview": {
+            "year": int(year),
+            "short_term_gain": realized["short"],
+            "long_term_gain": realized["long"],
+            "total_gain": round(realized["short"] + realized["long"], 2),
+        },
+    }
+
+
+def write_report(report, fmt, f):
+    """Write the report to the file object f as text or JSON"""
+    if fmt == "json":
+        json.dump(report, f, indent=2)
+        f.write("\n")
+        return
+    if fmt != "text":
+        raise Exception("Unrecognized format: " + fmt)
+
+    spot_prices = report["spot_prices"]
+    f.write(f"PORTFOLIO REPORT ({report['generated']}, {report['method']})\n")
+
+    f.write("\nHOLDINGS\n")
+    holdings = report["holdings"]
+    by_value = sorted(holdings["locations"].items(), key=lambda x: -x[1]["usd"])
+    for location, held in by_value:
+        f.write("{} (USD {:.2f})\n".format(location, held["usd"]))
+        coins = sorted(held["coins"].items(), key=lambda x: -x[1]["usd"])
+        for coin, amount in coins:
+            f.write(
+                "    {} {:.8f} (USD {:.2f} @ USD {:.2f} per {})\n".format(
+                    coin, amount["amount"], amount["usd"], spot_prices[coin], coin
+                )
+            )
+    f.write("Total Portfolio Value: USD {:.2f}\n".format(holdings["total_usd"]))
+
+    f.write("\nOPEN LOTS\n")
+    table = PrettyTable(
+        [
+            "Coin",
+            "Date Acquired",
+            "Amount",
+            "Basis per Coin",
+            "Total Basis",
+            "G/L at Spot Price",
+            "Term",
+        ]
+    )
+    for coin, coin_basis in report["basis"].items():
+        for lot in coin_basis["lots"]:
+            table.add_row(
+                [
+                    coin,
+                    lot["acquired"][:19].replace("T", " "),
+                    lot["amount"],
+                    round(lot["basis"] / lot["amount"], 2),
+                    lot["basis"],
+                    lot["gain"],
+                    lot["term"].upper(),
+                ]
+            )
+    f.write(str(table) + "\n")
+
+    f.write("\nUNREALIZED GAIN BY COIN\n")
+    table = PrettyTable(
+        [
+            "Coin",
+            "Amount",
+            "Total Basis",
+            "Spot Price",
+            "Value",
+            "Short-Term G/L",
+            "Long-Term G/L",
+            "Total G/L",
+        ]
+    )
+    for coin, coin_basis in report["basis"].items():
+        table.add_row(
+            [
+                coin,
+                coin_basis["amount"],
+                coin_basis["basis"],
+                round(coin_basis["spot_price"], 2),
+                coin_basis["value"],
+                coin_basis["short_term_gain"],
+                coin_basis["long_term_gain"],
+                coin_basis["unrealized_gain"],
+            ]
+        )
+    f.write(str(table) + "\n")
+    f.write("TOTAL UNREALIZED G/L: USD {:.2f}\n".format(report["unrealized_gain"]))
+
+    fees = report["fees"]
+    f.write("\nFEES INCURRED\n")
+    for typ, fee in fees["by_type"].items():
+        positive = fees["by_type_positive"][typ]
+        f.write(f"{typ}: USD {fee:0.2f} (USD {positive:0.2f} ignoring negatives)\n")
+    f.write(
+        "TOTAL: USD {:0.2f} (USD {:0.2f} ignoring negatives)\n".format(
+            fees["total"], fees["total_positive"]
+        )
+    )
+
+    preview = report["tax_preview"]
+    f.write(f"\nFORM 8949 PREVIEW FOR {preview['year']}\n")
+    f.write(f"SHORT-TERM CAPITAL GAIN: USD {preview['short_term_gain']:0.2f}\n")
+    f.write(f"LONG-TERM CAPITAL GAIN: USD {preview['long_term_gain']:0.2f}\n")
+    f.write(f"TOTAL CAPITAL GAIN: USD {preview['total_gain']:0.2f}\n")
@@ -1,32 +1,481 @@
+import bisect
+import collections
+import heapq
+import itertools
 import pytz
 import datetime as dt
+import dateutil.parser
+import yaml
+from concurrent.futures import ProcessPoolExecutor
+from events import build_aliases, lookup
+from transactions import SendReceive, Shapeshift
+from units import to_units, from_units, value, split
+
+
+def _one_year_after(date):
+    """The same date a year later. A year after Feb 29 is Feb 28."""
+    try:
+        return date.replace(year=date.year + 1)
+    except ValueError:  # Feb 29
+        return date.replace(year=date.year + 1, day=28)
 
 
 def _held_1yr(acquired, disposed):
     """Determine whether the trade qualifies for LT treatment"""
-    acquired = acquired.date()
-    min_date = dt.date(
-        year=acquired.year + 1, month=acquired.month, day=acquired.day + 1
-    )
-    if disposed.date() >= min_date:
-        return True
-    else:
-        return False
+    return disposed.date() > _one_year_after(acquired.date())
+
+
+def _long_term_cutoff(disposed):
+    """Ordinal of the earliest acquisition date that is NOT long-term on `disposed`,
+    i.e., the first date whose _one_year_after isn't before it"""
+    disposed = disposed.date()
+    # Start from a date that is long-term or just barely not, then step forward
+    cutoff = disposed.replace(year=disposed.year - 1, day=min(disposed.day, 28))
+    while _one_year_after(cutoff) < disposed:
+        cutoff += dt.timedelta(days=1)
+    return cutoff.toordinal()
+
+
+def _take_from(lot, amount):
+    """Remove `amount` coins from the lot, along with their share of its cost"""
+    cost = split(lot[2], amount, lot[1])
+    lot[1] -= amount
+    lot[2] -= cost
+    return [lot[0], amount, cost, lot[3]]
+
+
+class FifoLots(object):
+    """Open lots of a single coin, consumed first-in first-out.
+    Each lot is a list of [time acquired, amount, total cost, acquiring tx id]."""
+
+    def __init__(self):
+        self.lots = collections.deque()
+
+    def add(self, lot):
+        self.lots.append(lot)
+
+    def _peek(self):
+        return self.lots[0]
+
+    def _pop(self):
+        self.lots.popleft()
+
+    def open_lots(self):
+        """Return the remaining lots sorted by time acquired"""
+        return sorted((lot for lot in self.lots if lot[1] > 0), key=lambda x: x[0])
+
+    def take(self, amount, selections=None):
+        """Consume `amount` coins worth of lots and return the basis used.
+        Partially consumed lots stay in the pool with their amount and cost reduced."""
+        used_basis = []
+        remaining = amount
+        while len(self.lots) and remaining > 0:
+            lot = self._peek()
+            if lot[1] == 0:
+                # Lot was emptied by a specific identification, drop it
+                self._pop()
+                continue
+            if remaining < lot[1]:
+                # Chews up some but not all of this lot
+                used_basis.append(_take_from(lot, remaining))
+                remaining = 0
+            else:
+                # Chews up all of this lot, leaving it empty in case anything
+                # (e.g., a specific identification index) still refers to it
+                remaining -= lot[1]
+                used_basis.append(_take_from(lot, lot[1]))
+                self._pop()
+        assert remaining == 0, "Not enough basis to match"
+        return used_basis
+
+
+class LifoLots(FifoLots):
+    """Open lots of a single coin, consumed last-in first-out"""
+
+    def __init__(self):
+        self.lots = []
+
+    def _peek(self):
+        return self.lots[-1]
+
+    def _pop(self):
+        self.lots.pop()
+
+
+class HifoLots(FifoLots):
+    """Open lots of a single coin, consumed highest cost per coin first.
+    Ties in cost are broken by consuming the earliest lot first."""
+
+    def __init__(self):
+        self.lots = []
+        self._counter = itertools.count()
+
+    def add(self, lot):
+        if lot[1] == 0:
+            # Nothing to consume, as FIFO and LIFO skip such lots when taking
+            return
+        heapq.heappush(self.lots, (-lot[2] / lot[1], next(self._counter), lot))
+
+    def _peek(self):
+        return self.lots[0][2]
+
+    def _pop(self):
+        heapq.heappop(self.lots)
+
+    def open_lots(self):
+        return sorted(
+            (entry[2] for entry in self.lots if entry[2][1] > 0), key=lambda x: x[0]
+        )
+
+
+class SpecificLots(FifoLots):
+    """Open lots of a single coin, consumed by specific identification.
+    Any part of a disposal without a lot selection falls back to FIFO."""
+
+    def __init__(self):
+        FifoLots.__init__(self)
+        self.index = {}
+
+    def add(self, lot):
+        FifoLots.add(self, lot)
+        self.index[lot[3]] = lot
+
+    def _pop(self):
+        lot = self.lots.popleft()
+        self.index.pop(lot[3], None)
+
+    def take(self, amount, selections=None):
+        used_basis = []
+        remaining = amount
+        for lot_id, lot_amount in selections or []:
+            lot = self.index.get(lot_id)
+            if lot is None or lot[1] < lot_amount:
+                raise Exception(
+                    "Bad lot selection: {} {}".format(lot_id, from_units(lot_amount))
+                )
+            used_basis.append(_take_from(lot, lot_amount))
+            remaining -= lot_amount
+            if lot[1] == 0:
+                # Leave the emptied lot in the deque, FifoLots.take skips it
+                del self.index[lot_id]
+        assert remaining >= 0, "Lot selections exceed disposal"
+        if remaining > 0:
+            used_basis += FifoLots.take(self, remaining)
+        return used_basis
+
+
+LOT_METHODS = {
+    "FIFO": FifoLots,
+    "LIFO": LifoLots,
+    "HIFO": HifoLots,
+    "SPECID": SpecificLots,
+}
+
+
+class LotSnapshot(object):
+    """Read-only snapshot of a coin's open lots in the order a lot method would
+    consume them, with running totals of amount and cost. The cost of selling
+    the first x coins is then a bisect instead of a replay. Specific
+    identification has no order to snapshot and is rejected."""
+
+    def __init__(self, open_lots, method="FIFO"):
+        if method == "SPECID":
+            raise Exception("Lot snapshots need FIFO, LIFO or HIFO, not SPECID")
+        if method == "LIFO":
+            lots = sorted(open_lots, key=lambda x: x[0], reverse=True)
+        elif method == "HIFO":
+            lots = sorted(open_lots, key=lambda x: (-x[2] / x[1], x[0]))
+        else:
+            lots = sorted(open_lots, key=lambda x: x[0])
+        self.method = method
+        self.times = [lot[0] for lot in lots]
+        # Acquisition dates as ordinals, negated for LIFO so they stay ascending
+        sign = -1 if self.method == "LIFO" else 1
+        self.ordinals = [sign * lot[0].date().toordinal() for lot in lots]
+        self.amounts = [lot[1] for lot in lots]
+        self.costs = [lot[2] for lot in lots]
+        self.cum_amount = list(itertools.accumulate(self.amounts))
+        self.cum_cost = list(itertools.accumulate(self.costs))
+
+    @property
+    def total(self):
+        return self.cum_amount[-1] if self.cum_amount else 0
+
+    def basis(self, x):
+        """Cost of the first x coins to be consumed"""
+        i = bisect.bisect_left(self.cum_amount, x)
+        if i == len(self.cum_amount):
+            return self.cum_cost[-1] if self.cum_cost else 0
+        prev_amount = self.cum_amount[i - 1] if i else 0
+        prev_cost = self.cum_cost[i - 1] if i else 0
+        return prev_cost + split(self.costs[i], x - prev_amount, self.amounts[i])
+
+    def long_term(self, start, end, disposed):
+        """Return (amount, basis) of the coins consumed between positions start
+        and end that would get long-term treatment if disposed on `disposed`"""
+        if self.method == "FIFO" or self.method == "LIFO":
+            # Lots are in time order, so the long-term lots form one contiguous run
+            cutoff = _long_term_cutoff(disposed)
+            if self.method == "FIFO":
+                long_lots = bisect.bisect_left(self.ordinals, cutoff)
+                boundary = self.cum_amount[long_lots - 1] if long_lots else 0
+                lo, hi = start, min(end, boundary)
+            else:
+                short_lots = bisect.bisect_right(self.ordinals, -cutoff)
+                boundary = self.cum_amount[short_lots - 1] if short_lots else 0
+                lo, hi = max(start, boundary), end
+            if hi <= lo:
+                return 0, 0
+            return hi - lo, self.basis(hi) - self.basis(lo)
+
+        # Otherwise walk the lots in the consumed range
+        long_amount = 0
+        long_basis = 0
+        previous = 0
+        for i, cum_amount in enumerate(self.cum_amount):
+            lo, hi = max(start, previous), min(end, cum_amount)
+            if hi > lo and _held_1yr(self.times[i], disposed):
+                long_amount += hi - lo
+                long_basis += self.basis(hi) - self.basis(lo)
+            if cum_amount >= end:
+                break
+            previous = cum_amount
+        return long_amount, long_basis
+
+
+class Lineage(object):
+    """Where the coins of one coin's lots are held, so that each disposal can
+    be traced back to the acquisitions whose lots it used up and the transfers
+    that brought those coins to where they were disposed of.
+
+    Each location holds fragments of lots, [amount, transfer tx ids], keyed by
+    acquiring tx id. The lot pool itself doesn't know about locations, so a
+    transfer moves the oldest fragments held at its origin."""
+
+    def __init__(self):
+        self.held = collections.defaultdict(dict)  # location -> {lot id: fragments}
+        # Disposal tx id -> [acquiring tx id, amount, transfer tx ids] for
+        # every lot the disposal used up
+        self.links = {}
+
+    def add(self, location, lot_id, amount, hops=()):
+        self.held[location].setdefault(lot_id, []).append([amount, list(hops)])
+
+    def _take(self, location, lot_id, amount):
+        """Remove up to `amount` of the lot from a location. Returns the
+        (amount, transfer tx ids) taken."""
+        lots = self.held[location]
+        fragments = lots.get(lot_id, [])
+        taken = []
+        while fragments and amount > 0:
+            part = min(amount, fragments[0][0])
+            taken.append((part, fragments[0][1]))
+            fragments[0][0] -= part
+            amount -= part
+            if fragments[0][0] == 0:
+                fragments.pop(0)
+        if lot_id in lots and not fragments:
+            del lots[lot_id]
+        return taken
+
+    def _take_oldest(self, location, amount):
+        taken = []
+        for lot_id in list(self.held[location]):
+            if amount <= 0:
+                break
+            for part, hops in self._take(location, lot_id, amount):
+                taken.append((lot_id, part, hops))
+                amount -= part
+        return taken
+
+    def transfer(self, tx_id, origin, destination, amount):
+        """Move `amount` coins from origin to destination. The transfer's fee
+        stays behind, as it does in the lot pool."""
+        for lot_id, part, hops in self._take_oldest(origin, amount):
+            self.add(destination, lot_id, part, hops + [tx_id])
+
+    def dispose(self, tx_id, location, used_basis):
+        """Record the lots used up by a disposal at `location`. Coins of a lot
+        that aren't held there are taken from wherever they are held."""
+        links = []
+        for lot in used_basis:
+            lot_id, remaining = lot[3], lot[1]
+            for held_at in [location] + list(self.held):
+                if remaining <= 0:
+                    break
+                for part, hops in self._take(held_at, lot_id, remaining):
+                    links.append([lot_id, part, hops])
+                    remaining -= part
+            if remaining > 0:
+                links.append([lot_id, remaining, []])
+        self.links[tx_id] = links
+
+
+def replay_lots(method, lot_selections, opening_lots, records, year_ends=()):
+    """Replay one coin's transactions through a lot pool. Each record is
+    (tx id, basis contribution or None, amount disposed of or None, location,
+    (origin, destination, amount received) for transfers or None). Each of
+    year_ends is (number of records, year): the lots open once that many
+    records have been replayed are the ones open at the end of the year.
+
+    Returns ({tx id: basis used up}, lots open at the end, lineage links,
+    {year: lots open at the end of it}). A module-level function so that it
+    can run in a worker process."""
+    lots = LOT_METHODS[method]()
+    lineage = Lineage()
+    for lot in opening_lots:
+        lots.add(list(lot))
+        lineage.add(None, lot[3], lot[1])
+    years_at = {}
+    for position, year in year_ends:
+        years_at.setdefault(position, []).append(year)
+    open_by_year = {}
+
+    def snapshot(position):
+        for year in years_at.get(position, []):
+            open_by_year[year] = [list(lot) for lot in lots.open_lots()]
+
+    used_basis = {}
+    for position, record in enumerate(records):
+        snapshot(position)
+        tx_id, basis, disposed, location, transfer = record
+        if basis:
+            lots.add([basis[0], basis[1], basis[2], tx_id])
+            lineage.add(location, tx_id, basis[1])
+        if disposed:
+            try:
+                used_basis[tx_id] = lots.take(disposed, lot_selections.get(tx_id))
+            except AssertionError as e:
+                raise AssertionError(f"{e} for {tx_id}. Run verify?") from e
+            lineage.dispose(tx_id, location, used_basis[tx_id])
+        if transfer:
+            lineage.transfer(tx_id, *transfer)
+    snapshot(len(records))
+    return used_basis, lots.open_lots(), lineage.links, open_by_year
+
+
+def get_lot_selections(tx_lots_file):
+    """Parse the specific identification file into a dict of
+    disposal tx id -> list of (acquiring tx id, amount)."""
+    try:
+        lots_raw = yaml.load(open(tx_lots_file))
+    except FileNotFoundError:
+        return {}
+
+    selections = {}
+    for disposal_id, lots in (lots_raw or {}).items():
+        selections[disposal_id] = []
+        for lot in lots:
+            lot_id, amount = lot.split()
+            selections[disposal_id].append((lot_id, to_units(amount)))
+    return selections
+
+
+def get_whatif_disposals(disposals_raw, spot_prices=None):
+    """Turn the hypothetical disposals parsed from a whatif file into a list of
+    dicts with scenario, coin, amount, price and date. Price defaults to the
+    spot price and date defaults to now."""
+    now = dt.datetime.now(pytz.utc)
+
+    disposals = []
+    for disposal in disposals_raw:
+        date = disposal.get("date")
+        if date is None:
+            date = now
+        else:
+            date = dateutil.parser.parse(str(date))
+            if date.tzinfo is None:
+                date = date.replace(tzinfo=pytz.utc)
+        price = disposal.get("price")
+        if price is None:
+            price = spot_prices[disposal["coin"]]
+        disposals.append(
+            {
+                "scenario": str(disposal.get("scenario", "default")),
+                "coin": disposal["coin"],
+                "amount": to_units(disposal["amount"]),
+                "price": float(price),
+                "date": date,
+            }
+        )
+    return disposals
 
 
 class Form8949(object):
-    def __init__(self, transactions):
-        self.method = "FIFO"  # This class only works for FIFO
+    def __init__(
+        self,
+        transactions,
+        method="FIFO",
+        lot_selections=None,
+        opening_lots=None,
+        jobs=1,
+    ):
+        if method not in LOT_METHODS:
+            raise Exception("Unrecognized lot method: " + method)
+        self.method = method
+        self.lot_selections = {}
+        if lot_selections:
+            # Selections may name transactions by current or legacy id. When
+            # starting from a checkpoint, disposals outside these transactions
+            # are skipped and lots may be ones carried in from the checkpoint.
+            aliases = build_aliases(transactions)
+            for disposal_id, lots in lot_selections.items():
+                if opening_lots and disposal_id not in aliases:
+                    continue
+                try:
+                    disposal_id = lookup(aliases, disposal_id).id
+                except KeyError:
+                    raise Exception("Bad lot selection id: {}".format(disposal_id))
+                self.lot_selections[disposal_id] = [
+                    (lookup(aliases, lot).id if lot in aliases else lot, amount)
+                    for lot, amount in lots
+                ]
+        self.opening_lots = opening_lots or {}
         self.assets = self.generate_assets(transactions)
+        if jobs > 1 and len(self.assets) > 1:
+            self.replay_assets(jobs)
 
     def generate_assets(self, transactions):
         assets = {}
+        for coin, lots in self.opening_lots.items():
+            assets[coin] = Asset(coin, self.method, self.lot_selections, lots)
         for tx in transactions:
             for coin in tx.affected_coins:
-                asset = assets.setdefault(coin, Asset(coin))
-                asset.add_tx(tx)
+                if coin not in assets:
+                    assets[coin] = Asset(coin, self.method, self.lot_selections)
+                assets[coin].add_tx(tx)
         return assets
 
+    def replay_assets(self, jobs):
+        """Replay the lots of every Asset in a pool of `jobs` processes. Each
+        worker only gets its coin's transactions as compact records, and the
+        results are merged back in coin order."""
+        assets = [self.assets[coin] for coin in sorted(self.assets)]
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            replays = pool.map(replay_lots, *zip(*(a.replay_args() for a in assets)))
+            for asset, replay in zip(assets, replays):
+                asset.used_basis, asset.available_basis, asset.lineage, _ = replay
+
+    def lineage(self):
+        """Return {disposal tx id: [[coin, acquiring tx id, amount, transfer
+        tx ids]]}, tracing every disposal to the lots it used up"""
+        links = {}
+        for asset in self.assets.values():
+            asset.current_available_basis()
+            for tx_id, tx_links in asset.lineage.items():
+                links.setdefault(tx_id, []).extend(
+                    [asset.coin] + link for link in tx_links
+                )
+        return links
+
+    def open_lots_by_year(self, last_year):
+        """Return {year: {coin: lots open at the end of that year}}"""
+        by_year = {}
+        for asset in self.assets.values():
+            for year, lots in asset.open_lots_by_year(last_year).items():
+                by_year.setdefault(year, {})[asset.coin] = lots
+        return by_year
+
     def short_term(self):
         return [row for row in self.all_term() if not _held_1yr(row[1], row[2])]
 
@@ -39,35 +488,149 @@ class Form8949(object):
             basis[asset.coin] = asset.current_available_basis()
         return basis
 
+    def unrealized(self, spot_prices, now=None):
+        """Return {coin: rows} of the open lots valued at spot price. Each row
+        is [date acquired, amount, basis, gain at spot price, term]."""
+        now = now or dt.datetime.now(pytz.utc)
+        lots = {}
+        for coin, available_basis in self.current_available_basis().items():
+            lots[coin] = [
+                [
+                    lot[0],
+                    lot[1],
+                    lot[2],
+                    value(lot[1], spot_prices[coin]) - lot[2],
+                    "long" if _held_1yr(lot[0], now) else "short",
+                ]
+                for lot in available_basis
+            ]
+        return lots
+
+    def harvest(self, spot_prices, target, coin=None, now=None):
+        """Return the fewest open lots (and amounts of them) to sell at spot price
+        to realize `target` USD of gain, or of loss if `target` is negative.
+        Lots with the largest gain or loss are sold first and only the last lot
+        is sold partially. Limited to a single coin if `coin` is given.
+
+        Each row is [coin, date acquired, amount, basis, spot price, gain, term].
+        """
+        now = now or dt.datetime.now(pytz.utc)
+        sign = -1 if target < 0 else 1
+
+        # Heap of candidate lots, biggest gain (or loss) in the target direction first
+        candidates = []
+        for asset_coin, available_basis in self.current_available_basis().items():
+            if coin and asset_coin != coin:
+                continue
+            for lot in available_basis:
+                gain = value(lot[1], spot_prices[asset_coin]) - lot[2]
+                if gain * sign > 0:
+                    candidates.append((-gain * sign, lot[0], asset_coin, lot))
+        heapq.heapify(candidates)
+
+        rows = []
+        realized = 0
+        while candidates and (target - realized) * sign > 0:
+            _, _, lot_coin, lot = heapq.heappop(candidates)
+            spot = spot_prices[lot_coin]
+            amount, basis = lot[1], lot[2]
+            gain = value(amount, spot) - basis
+            if abs(target - realized) < abs(gain):
+                # Only sell as much of this lot as needed to hit the target
+                amount = split(lot[1], abs(target - realized), abs(gain))
+                if amount == 0:
+                    # Remainder is below one base unit of this coin
+                    break
+                basis = split(lot[2], amount, lot[1])
+                gain = value(amount, spot) - basis
+            realized += gain
+            term = "long" if _held_1yr(lot[0], now) else "short"
+            rows.append([lot_coin, lot[0], amount, basis, spot, gain, term])
+        return rows
+
+    def whatif(self, disposals):
+        """Evaluate hypothetical disposals against a snapshot of the open lots
+        without touching the ledger. Each disposal is a dict with scenario, coin,
+        amount, price and date. Disposals of the same coin within a scenario
+        consume lots one after the other; separate scenarios each start from
+        the same open lots.
+
+        Each row is [scenario, coin, amount, date, proceeds, basis, gain,
+        short-term gain, long-term gain].
+        """
+        snapshots = {}
+        consumed = {}  # (scenario, coin) -> coins already consumed
+        rows = []
+        for disposal in disposals:
+            coin = disposal["coin"]
+            if coin not in snapshots:
+                open_lots = []
+                if coin in self.assets:
+                    open_lots = self.assets[coin].current_available_basis()
+                snapshots[coin] = LotSnapshot(open_lots, self.method)
+            snapshot = snapshots[coin]
+
+            key = (disposal["scenario"], coin)
+            start = consumed.get(key, 0)
+            end = start + disposal["amount"]
+            assert end <= snapshot.total, "Not enough basis to match"
+            consumed[key] = end
+
+            proceeds = value(disposal["amount"], disposal["price"])
+            basis = snapshot.basis(end) - snapshot.basis(start)
+            long_amount, long_basis = snapshot.long_term(start, end, disposal["date"])
+            long_gain = value(long_amount, disposal["price"]) - long_basis
+            short_gain = proceeds - basis - long_gain
+            rows.append(
+                [
+                    disposal["scenario"],
+                    coin,
+                    disposal["amount"],
+                    disposal["date"],
+                    proceeds,
+                    basis,
+                    proceeds - basis,
+                    short_gain,
+                    long_gain,
+                ]
+            )
+        return rows
+
     def generate_form(self, term, aggregated, year):
-        """Term argument is 'short', 'long' or 'all'. Aggregate is whether to have a single disposition that is traced to multiple acquisitions appear as a single row."""
-        all_rows = []
+        """Term argument is 'short', 'long' or 'all'. Aggregate is whether to have a single disposition that is traced to multiple acquisitions appear as a single row.
+        Rows are yielded as they are generated, with a blank row ahead of each coin's rows."""
         for asset in self.assets.values():
-            tax_history = asset.tax_history(term, aggregated, year)
-            if len(tax_history):
-                all_rows.append([" "] * 6)
-            all_rows.extend(tax_history)
-        return all_rows
+            blank_row = [" "] * 6
+            for row in asset.tax_history(term, aggregated, year):
+                if blank_row:
+                    yield blank_row
+                    blank_row = None
+                yield row
 
 
 class Asset(object):
     """Asset class used for tracking tax basis of each asset"""
 
-    def __init__(self, coin):
+    def __init__(self, coin, method="FIFO", lot_selections=None, opening_lots=None):
         self.coin = coin
+        self.method = method
+        self.lot_selections = lot_selections or {}
+        self.opening_lots = opening_lots or []  # Open lots carried in from a checkpoint
         self.transactions = []
+        self.used_basis = None
+        self.available_basis = None
+        self.lineage = None
 
     def add_tx(self, tx):
         self.transactions.append(tx)
+        self.used_basis = None  # Invalidate any previous replay
 
     def current_available_basis(self):
-        self.transactions.sort(key=lambda x: x.time)
-        available_basis = self._tx_used_basis(self.transactions[-1], True)
-        return available_basis
+        self._replay()
+        return self.available_basis
 
     def tax_history(self, term, aggregated, year):
-        self.transactions.sort(key=lambda x: x.time)
-        tax_history = []
+        self._replay()
         for tx in self.transactions:
             if year and tx.time.year != int(year):
                 continue
@@ -78,42 +641,70 @@ class Asset(object):
                 tx, used_basis, term, aggregated
             )  # Calculate the tax impact of the tx based on the used basis and in the way we specify
             if tax_impact:
-                tax_history.extend(tax_impact)
-        return tax_history
-
-    def _tx_used_basis(self, tx, return_available_basis=False):
-        """Return an array that represents a row of Form 8949"""
-        assert tx in self.transactions
-        available_basis = []
-
-        for tx_iter in self.transactions:
-            used_basis = []
-            matched_ar = 0.00
-            available_basis += filter(None, [tx_iter.basis_contribution(self.coin)])
-            amount_realized = tx_iter.amount_realized(self.coin)
-            if amount_realized:
-                # Match basis to amount realized
-                for basis in list(available_basis):
-                    basis = list(basis)
-                    if (amount_realized[1] - matched_ar) < basis[1]:
-                        # Chews up some but not all of this basis item
-                        available_basis[0][1] -= amount_realized[1] - matched_ar
-                        used_basis += [
-                            [basis[0], (amount_realized[1] - matched_ar), basis[2]]
-                        ]
-                        matched_ar += amount_realized[1] - matched_ar
-                        break
-                    elif (amount_realized[1] - matched_ar) >= basis[1]:
-                        # Chews up all of or more than this basis item
-                        del available_basis[0]
-                        used_basis += [basis]
-                        matched_ar += basis[1]
-                assert round(matched_ar, 8) == round(amount_realized[1], 8), "Not enough basis to match"
-            if tx == tx_iter:
-                if return_available_basis:
-                    return available_basis
-                else:
-                    return used_basis
+                yield from tax_impact
+
+    def _replay(self):
+        """Run every transaction through the lot pool once, recording the basis
+        each disposal used up and the lots that remain open at the end."""
+        if self.used_basis is not None:
+            return
+        self.used_basis, self.available_basis, self.lineage, _ = replay_lots(
+            *self.replay_args()
+        )
+
+    def replay_args(self):
+        """Arguments for replay_lots: the lot method, the lot selections of this
+        coin's disposals, the opening lots and a compact record of each
+        transaction in time order"""
+        self.transactions.sort(key=lambda x: x.time)
+        records = []
+        for tx in self.transactions:
+            amount_realized = tx.amount_realized(self.coin)
+            location, transfer = getattr(tx, "location", None), None
+            if isinstance(tx, SendReceive):
+                received = tx.amount - tx.implied_fee
+                transfer = (tx.origin, tx.destination, received)
+            elif isinstance(tx, Shapeshift):
+                event = tx.send if self.coin == tx.send.coin else tx.receive
+                location = event.location
+            records.append(
+                (
+                    tx.id,
+                    tx.basis_contribution(self.coin),
+                    amount_realized[1] if amount_realized else None,
+                    location,
+                    transfer,
+                )
+            )
+        lot_selections = {
+            id: self.lot_selections[id]
+            for id, _, disposed, _, _ in records
+            if disposed and id in self.lot_selections
+        }
+        return self.method, lot_selections, self.opening_lots, records
+
+    def open_lots_by_year(self, last_year):
+        """Return {year: lots open at the end of that year} for every year from
+        the first transaction through last_year"""
+        args = self.replay_args()  # Sorts the transactions by time
+        year_ends = []
+        year = self.transactions[0].time.year if self.transactions else last_year
+        for position, tx in enumerate(self.transactions):
+            while tx.time.year > year:
+                year_ends.append((position, year))
+                year += 1
+        while year <= last_year:
+            year_ends.append((len(self.transactions), year))
+            year += 1
+        replay = replay_lots(*args, year_ends)
+        self.used_basis, self.available_basis, self.lineage, by_year = replay
+        return by_year
+
+    def _tx_used_basis(self, tx):
+        """Return the basis items used up by the tx, each being
+        [time acquired, amount, total cost, acquiring tx id]"""
+        self._replay()
+        return self.used_basis.get(tx.id, [])
 
     def _tax_impact(self, tx, used_basis, term, aggregated):
         # If this is the transaction of interest, we need to report the used basis aka rows of 8949
@@ -128,16 +719,21 @@ class Asset(object):
             amount_realized[1],
             None,
             amount_realized[0],
-            0.00,
-            0.00,
-            0.00,
+            0,
+            0,
+            0,
         ]
+        # Proceeds are shared out across the used basis items by amount
+        unshared_amount = amount_realized[1]
+        unshared_proceeds = amount_realized[2]
         for basis in used_basis:
-            description = f"{self.coin} {round(basis[1], 8):12.8f}"
+            description = f"{self.coin} {from_units(basis[1]):12.8f}"
             date_acquired = basis[0]
             date_sold = amount_realized[0]
-            proceeds = basis[1] * amount_realized[2]
-            tx_basis = basis[1] * basis[2]
+            proceeds = split(unshared_proceeds, basis[1], unshared_amount)
+            unshared_amount -= basis[1]
+            unshared_proceeds -= proceeds
+            tx_basis = basis[2]
             gain = proceeds - tx_basis
 
             if term == "short" and _held_1yr(date_acquired, date_sold):
@@ -151,9 +747,9 @@ class Asset(object):
                     description,
                     date_acquired,
                     date_sold,
-                    round(proceeds, 2),
-                    round(tx_basis, 2),
-                    round(gain, 2),
+                    round(from_units(proceeds), 2),
+                    round(from_units(tx_basis), 2),
+                    round(from_units(gain), 2),
                 )
             )
 
@@ -166,10 +762,10 @@ class Asset(object):
             aggregated_row[4] += tx_basis
             aggregated_row[5] += gain
 
-        aggregated_row[0] = f"{self.coin} {round(aggregated_row[0], 8):12.8f}"
-        aggregated_row[3] = round(aggregated_row[3], 2)
-        aggregated_row[4] = round(aggregated_row[4], 2)
-        aggregated_row[5] = round(aggregated_row[5], 2)
+        aggregated_row[0] = f"{self.coin} {from_units(aggregated_row[0]):12.8f}"
+        aggregated_row[3] = round(from_units(aggregated_row[3]), 2)
+        aggregated_row[4] = round(from_units(aggregated_row[4]), 2)
+        aggregated_row[5] = round(from_units(aggregated_row[5]), 2)
 
         if aggregated_row[1] is None:
             aggregated_row = (
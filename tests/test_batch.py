@@ -0,0 +1,17 @@
+from mistbat import print_batch_summary
+
+
+def test_batch_summary_sums_portfolios(capsys):
+    summaries = [
+        {"BTC": {"Amount": 100000000, "USD Value": 40000000000}},
+        None,  # A portfolio that failed
+        {
+            "BTC": {"Amount": 50000000, "USD Value": 20000000000},
+            "ETH": {"Amount": 200000000, "USD Value": 30000000000},
+        },
+    ]
+    print_batch_summary("holdings", summaries)
+    out = capsys.readouterr().out
+    assert "SUMMARY OF 2 PORTFOLIOS" in out
+    assert "| BTC  |  1.5   |   600.0   |" in out
+    assert "| ETH  |  2.0   |   300.0   |" in out
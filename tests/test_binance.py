@@ -0,0 +1,31 @@
+from loaders.binance import pairs_to_sync
+
+SYMBOLS = {
+    "ETHBTC": ["ETH", "BTC"],
+    "XRPBTC": ["XRP", "BTC"],
+    "XRPETH": ["XRP", "ETH"],
+    "LTCUSDT": ["LTC", "USDT"],
+}
+NO_BALANCES = {"balances": [{"asset": "BTC", "free": "0", "locked": "0"}]}
+
+
+def _history(deposited=(), withdrawn=()):
+    deposits = {"depositList": [{"asset": coin} for coin in deposited]}
+    withdraws = {"withdrawList": [{"asset": coin} for coin in withdrawn]}
+    return deposits, withdraws
+
+
+def test_first_sync_requests_every_symbol():
+    deposits, withdraws = _history(deposited=["BTC"])
+    pairs = pairs_to_sync(deposits, withdraws, NO_BALANCES, {}, SYMBOLS)
+    assert sorted(pairs) == sorted(SYMBOLS)
+
+
+def test_coin_bought_and_sold_in_full_is_found():
+    # XRP was bought with BTC and sold again in full between syncs, so it was
+    # never deposited, withdrawn or held
+    deposits, withdraws = _history(deposited=["BTC"])
+    stored = {"ETHBTC": [{"id": 1}]}
+    pairs = pairs_to_sync(deposits, withdraws, NO_BALANCES, stored, SYMBOLS)
+    assert "XRPBTC" in pairs
+    assert "LTCUSDT" not in pairs
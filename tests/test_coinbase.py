@@ -0,0 +1,10 @@
+from loaders.coinbase import total_balances
+
+
+def test_total_balances_sums_wallets_of_a_currency():
+    accounts = [
+        {"id": "a", "currency": "BTC", "amount": "0.10000000"},
+        {"id": "b", "currency": "BTC", "amount": "0.20000000"},
+        {"id": "c", "currency": "ETH", "amount": "1.5"},
+    ]
+    assert total_balances(accounts) == {"BTC": "0.30000000", "ETH": "1.5"}
@@ -0,0 +1,81 @@
+import gzip
+import pytest
+from events import Exchange, FiatExchange, Receive
+from loaders.csvfile import iter_events
+
+# As csv_sources.yaml.example maps a Kraken export
+SOURCE = {
+    "file": "trades.csv",
+    "location": "kraken",
+    "time_format": "%Y-%m-%d %H:%M:%S",
+    "columns": {
+        "time": "Date",
+        "side": "Type",
+        "pair": "Pair",
+        "qty": "Amount",
+        "price": "Price",
+        "fee": "Fee",
+        "txid": "TxHash",
+        "id": "TradeID",
+    },
+    "sides": {"Buy": "buy", "Sell": "sell", "Deposit": "receive"},
+}
+
+HEADER = "Date,Type,Pair,Amount,Price,Fee,TxHash,TradeID\n"
+ROWS = """\
+2018-01-01 00:00:00,Deposit,BTC,1.5,,,abc,T1
+2018-01-02 00:00:00,Buy,ETH/BTC,10,0.1,0.001,,T2
+2018-01-03 00:00:00,Sell,ETH/USD,5,1000,2.5,,T3
+"""
+
+
+def _events(tmp_path, content, name="trades.csv", opener=open):
+    path = str(tmp_path / name)
+    with opener(path, "wt") as f:
+        f.write(content)
+    return list(iter_events(path, SOURCE))
+
+
+def test_iter_events(tmp_path):
+    events = _events(tmp_path, HEADER + ROWS)
+    receive, buy, sell = events
+
+    assert type(receive) == Receive
+    assert (receive.coin, receive.amount, receive.txid) == ("BTC", 150000000, "abc")
+
+    assert type(buy) == Exchange
+    assert (buy.buy_coin, buy.buy_amount) == ("ETH", 1000000000)
+    assert (buy.sell_coin, buy.sell_amount) == ("BTC", 100000000)
+    assert (buy.fee_with, buy.fee_amount) == ("BTC", 100000)
+
+    assert type(sell) == FiatExchange
+    assert (sell.buy_coin, sell.buy_amount) == ("USD", 500000000000)
+    assert (sell.fee_with, sell.fee_amount) == ("USD", 250000000)
+    assert len(set(ev.id for ev in events)) == 3
+
+
+def test_gzipped_file(tmp_path):
+    gzipped = _events(tmp_path, HEADER + ROWS, "trades.csv.gz", gzip.open)
+    plain = _events(tmp_path, HEADER + ROWS)
+    assert [ev.id for ev in gzipped] == [ev.id for ev in plain]
+
+
+@pytest.mark.parametrize(
+    "row, missing",
+    [
+        ("2018-01-02 00:00:00,,ETH/BTC,10,0.1,,,T4", "missing side"),
+        (",Buy,ETH/BTC,10,0.1,,,T4", "missing time"),
+        ("2018-01-02 00:00:00,Buy,ETH/BTC,,0.1,,,T4", "missing qty"),
+        ("2018-01-02 00:00:00,Buy,,10,0.1,,,T4", "missing pair"),
+        ("2018-01-02 00:00:00,Buy,ETH/BTC,10,,,,T4", "missing price"),
+        ("2018-01-02 00:00:00,Deposit,,1,,,,T4", "missing coin or pair"),
+    ],
+)
+def test_empty_required_cell(tmp_path, row, missing):
+    with pytest.raises(Exception, match=f"trades.csv:2: {missing}"):
+        _events(tmp_path, HEADER + row + "\n")
+
+
+def test_mapped_column_not_in_file(tmp_path):
+    with pytest.raises(Exception, match="no Amount column"):
+        _events(tmp_path, HEADER.replace("Amount", "Volume") + ROWS)
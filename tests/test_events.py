@@ -0,0 +1,45 @@
+import json
+import loaders.binance
+from events import Exchange, get_events
+
+
+def _fill(**extra):
+    return Exchange(
+        time=1518000000000,
+        location="binance",
+        buy_coin="ETH",
+        buy_amount=5.0,
+        sell_coin="BTC",
+        sell_amount=0.25,
+        fee_with="BNB",
+        fee_amount=0.01,
+        **extra
+    )
+
+
+def test_trade_id_separates_identical_fills():
+    first, second = _fill(trade_id=1), _fill(trade_id=2)
+    assert first.id != second.id
+    # The legacy id is still the hash of the event data alone
+    assert first.legacy_id == second.legacy_id == _fill().legacy_id
+
+
+def test_binance_identical_fills_load(tmp_path):
+    trade = {
+        "isBuyer": True,
+        "qty": "5",
+        "price": "0.05",
+        "time": 1518000000000,
+        "commissionAsset": "BNB",
+        "commission": "0.01",
+    }
+    dump = {
+        "deposits": {"depositList": []},
+        "withdraws": {"withdrawList": []},
+        "trades": {"ETHBTC": [dict(trade, id=1), dict(trade, id=2)]},
+    }
+    (tmp_path / "binance.json").write_text(json.dumps(dump))
+
+    events = get_events([loaders.binance], str(tmp_path), str(tmp_path))
+    assert len(events) == 2
+    assert events[0].id != events[1].id
@@ -0,0 +1,122 @@
+import pytest
+from events import Exchange, FiatExchange
+from prices import FileProvider, LedgerPrices
+from transactions import ExchangeTx, FiatExchangeTx
+
+# 2018-02-07 10:40:00 UTC
+T0 = 1518000000
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+
+def _buy(coin, amount, usd, ts):
+    return FiatExchangeTx(
+        FiatExchange(
+            time=ts * 1000,
+            location="coinbase",
+            buy_coin=coin,
+            buy_amount=amount,
+            sell_coin="USD",
+            sell_amount=usd,
+            fee_with="USD",
+            fee_amount=0,
+        )
+    )
+
+
+def _trade(buy_coin, buy_amount, sell_coin, sell_amount, ts):
+    return ExchangeTx(
+        Exchange(
+            time=ts * 1000,
+            location="binance",
+            buy_coin=buy_coin,
+            buy_amount=buy_amount,
+            sell_coin=sell_coin,
+            sell_amount=sell_amount,
+        )
+    )
+
+
+def test_ledger_nearest_observation_on_the_day():
+    prices = LedgerPrices(
+        [_buy("BTC", 1, 8000, T0), _buy("BTC", 1, 9000, T0 + 3 * HOUR)]
+    )
+    assert prices.close("BTC", T0 + HOUR) == 8000
+    assert prices.close("BTC", T0 + 2 * HOUR) == 9000
+
+
+def test_ledger_miss():
+    prices = LedgerPrices([_buy("BTC", 1, 8000, T0)])
+    assert prices.close("ETH", T0) is None
+    # Observations from another UTC day aren't used
+    assert prices.close("BTC", T0 + DAY) is None
+    assert prices.close("BTC", T0 - DAY) is None
+
+
+def test_ledger_chains_through_crypto_trades():
+    prices = LedgerPrices(
+        [
+            _buy("BTC", 1, 8000, T0),
+            _trade("ETH", 10, "BTC", 1, T0 + HOUR),
+            _trade("XRP", 1000, "ETH", 2, T0 + 2 * HOUR),
+        ]
+    )
+    assert prices.close("ETH", T0 + 3 * HOUR) == pytest.approx(800)
+    assert prices.close("XRP", T0 + 3 * HOUR) == pytest.approx(1.6)
+    # The chain doesn't cross into another day
+    assert prices.close("ETH", T0 + DAY) is None
+
+
+def test_ledger_leaves_out_trades_at_ts():
+    prices = LedgerPrices(
+        [_buy("BTC", 1, 8000, T0), _trade("ETH", 10, "BTC", 1, T0 + HOUR)]
+    )
+    assert prices.close("ETH", T0 + HOUR) is None
+    assert prices.close("ETH", T0 + HOUR + 1) == pytest.approx(800)
+
+
+def _provider(tmp_path, coin, content):
+    (tmp_path / (coin + ".csv")).write_text(content)
+    return FileProvider(str(tmp_path))
+
+
+@pytest.fixture
+def daily(tmp_path):
+    rows = "".join(f"{T0 + day * DAY},{8000 + day}\n" for day in range(100))
+    return _provider(tmp_path, "BTC", "time,close\n" + rows)
+
+
+def test_file_exact_and_between_rows(daily):
+    for day in (0, 1, 37, 50, 99):
+        assert daily.close("BTC", T0 + day * DAY) == 8000 + day
+        assert daily.close("BTC", T0 + day * DAY + 5 * HOUR) == 8000 + day
+
+
+def test_file_miss(daily, tmp_path):
+    assert daily.close("ETH", T0) is None
+    assert daily.close("BTC", T0 - 1) is None
+    (tmp_path / "XRP.csv").write_text("")
+    assert daily.close("XRP", T0) is None
+
+
+def test_file_out_of_window(daily):
+    last = T0 + 99 * DAY
+    assert daily.close("BTC", last + FileProvider.MAX_AGE) == 8099
+    assert daily.close("BTC", last + FileProvider.MAX_AGE + 1) is None
+
+
+def test_file_klines_in_milliseconds(tmp_path):
+    rows = "".join(
+        f"{(T0 + day * DAY) * 1000},1,2,0.5,{day}.25,100\n" for day in range(10)
+    )
+    provider = _provider(tmp_path, "ETH", rows)
+    assert provider.close("ETH", T0 + 3 * DAY + HOUR) == 3.25
+
+
+def test_file_iso_dates(tmp_path):
+    provider = _provider(
+        tmp_path, "BTC", "date,close\n2018-02-06,7700\n2018-02-07,8000\n"
+    )
+    # 2018-02-07 00:00 UTC is T0 - 38400
+    assert provider.close("BTC", T0) == 8000
+    assert provider.close("BTC", T0 - 38401) == 7700
@@ -0,0 +1,123 @@
+import datetime as dt
+import pytest
+import pytz
+from tax import (
+    LOT_METHODS,
+    LotSnapshot,
+    SpecificLots,
+    _held_1yr,
+    _long_term_cutoff,
+    get_whatif_disposals,
+    replay_lots,
+)
+from units import to_units
+
+
+def _time(year, month, day):
+    return dt.datetime(year, month, day, 12, tzinfo=pytz.utc)
+
+
+def test_specid_rejects_lot_consumed_by_fifo():
+    lots = SpecificLots()
+    lots.add([_time(2017, 1, 1), to_units(1), to_units(1000), "buy1"])
+    lots.add([_time(2017, 2, 1), to_units(1), to_units(2000), "buy2"])
+
+    # Unselected disposal falls back to FIFO and uses up all of buy1
+    used = lots.take(to_units(1))
+    assert used == [[_time(2017, 1, 1), to_units(1), to_units(1000), "buy1"]]
+
+    with pytest.raises(Exception, match="Bad lot selection"):
+        lots.take(to_units(0.5), [("buy1", to_units(0.5))])
+
+
+@pytest.mark.parametrize("method", sorted(LOT_METHODS))
+def test_zero_amount_lot(method):
+    lots = LOT_METHODS[method]()
+    lots.add([_time(2017, 1, 1), 0, to_units(5), "dust"])
+    lots.add([_time(2017, 2, 1), to_units(1), to_units(1000), "buy1"])
+
+    used = lots.take(to_units(1))
+    assert used == [[_time(2017, 2, 1), to_units(1), to_units(1000), "buy1"]]
+    assert lots.open_lots() == []
+
+
+def test_replay_specid_does_not_reuse_consumed_basis():
+    records = [
+        ("buy1", (_time(2017, 1, 1), to_units(1), to_units(1000)), None, "cb", None),
+        ("buy2", (_time(2017, 2, 1), to_units(1), to_units(2000)), None, "cb", None),
+        ("sell1", None, to_units(1), "cb", None),
+        ("sell2", None, to_units(1), "cb", None),
+    ]
+    with pytest.raises(Exception, match="Bad lot selection"):
+        replay_lots("SPECID", {"sell2": [("buy1", to_units(1))]}, [], records)
+
+
+@pytest.mark.parametrize(
+    "acquired, last_short, first_long",
+    [
+        ((2017, 1, 31), (2018, 1, 31), (2018, 2, 1)),
+        ((2017, 4, 30), (2018, 4, 30), (2018, 5, 1)),
+        ((2017, 12, 31), (2018, 12, 31), (2019, 1, 1)),
+        ((2016, 2, 29), (2017, 2, 28), (2017, 3, 1)),
+        ((2019, 2, 28), (2020, 2, 28), (2020, 2, 29)),
+    ],
+)
+def test_held_1yr_month_end(acquired, last_short, first_long):
+    assert not _held_1yr(_time(*acquired), _time(*last_short))
+    assert _held_1yr(_time(*acquired), _time(*first_long))
+
+
+@pytest.mark.parametrize(
+    "disposed",
+    [
+        (2016, 2, 28),
+        (2016, 2, 29),
+        (2016, 3, 1),
+        (2017, 2, 28),
+        (2017, 3, 1),
+        (2018, 1, 31),
+        (2018, 4, 30),
+        (2018, 5, 1),
+        (2018, 12, 31),
+        (2019, 1, 1),
+    ],
+)
+def test_long_term_cutoff_agrees_with_held_1yr(disposed):
+    disposed = _time(*disposed)
+    cutoff = _long_term_cutoff(disposed)
+    for days in range(360, 372):
+        acquired = disposed - dt.timedelta(days=days)
+        is_long = acquired.date().toordinal() < cutoff
+        assert is_long == _held_1yr(acquired, disposed), acquired
+
+
+def test_replay_snapshots_open_lots_at_year_ends():
+    records = [
+        ("buy1", (_time(2017, 3, 1), to_units(2), to_units(2000)), None, "cb", None),
+        ("sell1", None, to_units(1), "cb", None),
+        ("buy2", (_time(2019, 6, 1), to_units(1), to_units(5000)), None, "cb", None),
+    ]
+    year_ends = [(2, 2017), (2, 2018), (3, 2019)]
+    _, open_lots, _, by_year = replay_lots("FIFO", {}, [], records, year_ends)
+
+    half = [_time(2017, 3, 1), to_units(1), to_units(1000), "buy1"]
+    assert by_year == {2017: [half], 2018: [half], 2019: open_lots}
+    assert len(open_lots) == 2
+
+
+def test_whatif_disposals_default_to_spot_price():
+    disposals_raw = [
+        {"scenario": "a", "coin": "BTC", "amount": 0.5, "price": 30000},
+        {"coin": "ETH", "amount": 2, "date": "2023-12-29"},
+    ]
+    disposals = get_whatif_disposals(disposals_raw, {"ETH": 2000.0})
+    assert disposals[0]["amount"] == to_units(0.5)
+    assert disposals[0]["price"] == 30000.0
+    assert disposals[1]["scenario"] == "default"
+    assert disposals[1]["price"] == 2000.0
+    assert disposals[1]["date"] == dt.datetime(2023, 12, 29, tzinfo=pytz.utc)
+
+
+def test_lot_snapshot_rejects_specid():
+    with pytest.raises(Exception, match="SPECID"):
+        LotSnapshot([], "SPECID")
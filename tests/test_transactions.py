@@ -0,0 +1,32 @@
+from events import Exchange, Receive, Send
+from transactions import ExchangeTx, Shapeshift
+from units import to_units
+
+
+def test_shapeshift_fmvs_stay_on_the_transaction():
+    send = Send(time=1518000000000, location="coinbase", coin="BTC", amount=0.1)
+    receive = Receive(time=1518000060000, location="binance", coin="ETH", amount=1)
+    tx = Shapeshift(send, receive)
+    assert tx.missing_fmv
+
+    tx.set_fmvs({"BTC": "8000", "ETH": "790"})
+    assert not tx.missing_fmv
+    assert tx.fee_usd == to_units(10)
+    assert tx.amount_realized("BTC")[2] == to_units(790)
+    assert not hasattr(send, "fmv") and not hasattr(receive, "fmv")
+
+
+def test_set_fmvs_refreshes_fees():
+    exchange = Exchange(
+        time=1518000000000,
+        location="binance",
+        buy_coin="ETH",
+        buy_amount=5.0,
+        sell_coin="BTC",
+        sell_amount=0.25,
+    )
+    tx = ExchangeTx(exchange)
+    tx.set_fmvs({"ETH": 800, "BTC": 16000})
+    assert tx.fee_usd == 0
+    tx.set_fmvs({"ETH": 790, "BTC": 16000})
+    assert tx.fee_usd == to_units(50)
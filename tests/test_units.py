@@ -0,0 +1,89 @@
+import random
+from decimal import Decimal
+import pytest
+from events import Exchange, Send
+from transactions import ExchangeTx, Spend
+from units import UNIT, to_units, from_units, value, split
+
+
+@pytest.mark.parametrize(
+    "amount, units",
+    [
+        (0.1, 10000000),
+        (0.3, 30000000),
+        (1, 100000000),
+        ("0.00000001", 1),
+        ("0.000000015", 2),  # Ties round to even
+        ("0.000000025", 2),
+        ("0.000000004", 0),
+        (Decimal("-1.23456789"), -123456789),
+        (21e6, 21000000 * UNIT),
+    ],
+)
+def test_to_units_rounds_at_one_base_unit(amount, units):
+    assert to_units(amount) == units
+
+
+def test_to_units_and_from_units_pass_none_through():
+    assert to_units(None) is None
+    assert from_units(None) is None
+
+
+def test_float_amounts_round_trip():
+    rng = random.Random(0)
+    for _ in range(1000):
+        amount = round(rng.uniform(0, 1000), 8)
+        assert from_units(to_units(amount)) == amount
+
+
+def test_value_rounds_to_a_base_unit():
+    assert value(to_units(0.5), 30000) == to_units(15000)
+    assert value(1, 0.4) == 0
+    assert value(1, 0.6) == 1
+
+
+def test_split_shares_sum_exactly():
+    rng = random.Random(0)
+    for _ in range(200):
+        total = rng.randrange(1, 10 ** 12)
+        whole = rng.randrange(1, 10 ** 10)
+        parts = []
+        remaining_total, remaining_whole = total, whole
+        while remaining_whole:
+            part = rng.randrange(1, remaining_whole + 1)
+            share = split(remaining_total, part, remaining_whole)
+            parts.append(share)
+            remaining_total -= share
+            remaining_whole -= part
+        assert sum(parts) == total
+        assert remaining_total == 0
+
+
+def test_split_whole_is_total():
+    assert split(12345, 7, 7) == 12345
+    assert split(10, 1, 3) == 3
+
+
+def test_amounts_round_trip_through_events_and_transactions():
+    exchange = Exchange(
+        time="2018-02-07T10:40:00Z",
+        location="binance",
+        buy_coin="ETH",
+        buy_amount=5.12345678,
+        sell_coin="BTC",
+        sell_amount=0.1,
+        fee_with="BNB",
+        fee_amount=0.00000001,
+    )
+    assert exchange.buy_amount == 512345678
+    assert exchange.fee_amount == 1
+    tx = ExchangeTx(exchange)
+    assert from_units(tx.buy_amount) == 5.12345678
+    assert from_units(tx.sell_amount) == 0.1
+
+    send = Send(
+        time="2018-02-08T00:00:00Z", location="coinbase", coin="BTC", amount=0.3
+    )
+    spend = Spend(send)
+    spend.set_fmvs({"BTC": 8000})
+    assert spend.amount_realized("BTC")[1:] == [30000000, to_units(2400)]
@@ -1,10 +1,56 @@
+import bisect
+import datetime
 import dateutil.parser
 import pytz
 import hashlib
 import yaml
+from units import from_units, value
+from events import build_aliases, lookup
+
+
+def _non_usd(*coins):
+    return [coin for coin in coins if coin != "USD"]
 
 
 class Transaction:
+    # Transactions are slotted and copy the fields they need from their events
+    # when built, keeping a reference to the events for auditing. Annotations
+    # (notes, groups, annotated) are only set on annotated transactions.
+    __slots__ = (
+        "id",
+        "legacy_id",
+        "affected_coins",
+        "missing_fmv",
+        "implied_fee_usd",
+        "fee_usd",
+        "notes",
+        "groups",
+        "annotated",
+    )
+
+    def __init__(self):
+        # Derived fields. affected_coins and missing_fmv are set once when the
+        # transaction is built, and the fees once finalize() runs, instead of
+        # being recomputed on every access. set_fmvs() reruns finalize().
+        self.affected_coins = []
+        self.missing_fmv = True
+        self.implied_fee_usd = None
+        self.fee_usd = None
+
+    def finalize(self):
+        """Compute the USD fee once fmvs are known"""
+        self.fee_usd = 0
+
+    def set_fmvs(self, fmvs):
+        """Take the fmvs of the transaction's coins from {coin: USD price} and
+        recompute the fields derived from them"""
+        self._apply_fmvs(fmvs)
+        self.missing_fmv = False
+        self.finalize()
+
+    def _apply_fmvs(self, fmvs):
+        raise NotImplementedError
+
     def basis_contribution(self, coin):
         raise NotImplementedError
 
@@ -24,69 +70,60 @@ class Transaction:
         if annotated:
             desc += "\n   |-> Groups: {}".format(groups)
         if implied_fee is not None:
-            desc += "\n   |-> Implied Fee: USD {:.2f}".format(self.implied_fee_usd)
+            desc += "\n   |-> Implied Fee: USD {:.2f}".format(
+                from_units(self.implied_fee_usd)
+            )
         if reported_fee is not None:
             desc += "\n   |-> Reported Fee: {} {}".format(
-                self.fee_amount, self.fee_with
+                from_units(self.fee_amount), self.fee_with
             )
             if self.fee_with != "USD" and self.fee_with != "BNB": 
                 # BNB thing is a hack bc I don't want track FMV of BNB, which is not the buy or the sell coin.
                 if self.fee_with == self.buy_coin:
-                    converted_fee = self.buy_fmv * self.fee_amount
+                    converted_fee = value(self.fee_amount, self.buy_fmv)
                 elif self.fee_with == self.sell_coin:
-                    converted_fee = self.sell_fmv * self.fee_amount
-                desc += " ({:0.2f} USD)".format(converted_fee)
+                    converted_fee = value(self.fee_amount, self.sell_fmv)
+                desc += " ({:0.2f} USD)".format(from_units(converted_fee))
 
         return desc
 
-    @property
-    def affected_coins(self):
-        # Sanity checking
-        if hasattr(self, "coin"):
-            assert not hasattr(self, "buy_coin")
-            assert not hasattr(self, "sell_coin")
-            affected = [self.coin]
-
-        elif hasattr(self, "buy_coin"):
-            assert hasattr(self, "sell_coin")
-            assert not hasattr(self, "coin")
-            affected = [self.buy_coin, self.sell_coin]
-
-        else:
-            # It's a shapeshift
-            assert not hasattr(self, "coin")
-            assert not hasattr(self, "buy_coin")
-            assert not hasattr(self, "sell_coin")
-            affected = [self.send.coin, self.receive.coin]
-
-        if "USD" in affected:
-            affected.remove("USD")
-        return affected
-
-    @property
-    def missing_fmv(self):
-        # All fiat transactions have fmv instrinsic in it.
-        if self.__class__.__name__ == "FiatExchangeTx":
-            return False
-
-        if getattr(self, "fmv", None) or getattr(self, "buy_fmv", None):
-            return False
-        else:
-            return True
-
-    @property
-    def fee_usd(self):
-        raise NotImplementedError
-
 
 class ExchangeTx(Transaction):
+    __slots__ = (
+        "exchange",
+        "time",
+        "location",
+        "buy_coin",
+        "buy_amount",
+        "sell_coin",
+        "sell_amount",
+        "fee_with",
+        "fee_amount",
+        "buy_fmv",
+        "sell_fmv",
+    )
+
     def __init__(self, exchange):
+        Transaction.__init__(self)
         self.exchange = exchange
+        self.time = exchange.time
+        self.location = exchange.location
+        self.buy_coin = exchange.buy_coin
+        self.buy_amount = exchange.buy_amount
+        self.sell_coin = exchange.sell_coin
+        self.sell_amount = exchange.sell_amount
+        self.fee_with = getattr(exchange, "fee_with", None)
+        self.fee_amount = getattr(exchange, "fee_amount", None)
+        self.buy_fmv = getattr(exchange, "buy_fmv", None)
+        self.sell_fmv = getattr(exchange, "sell_fmv", None)
         self.generate_id()
+        self.affected_coins = _non_usd(self.buy_coin, self.sell_coin)
+        self.missing_fmv = not self.buy_fmv
 
     def generate_id(self):
         # Only change is to make the prefix 4 characters
         self.id = self.exchange.id[:3] + "x" + self.exchange.id[3:]
+        self.legacy_id = self.exchange.legacy_id[:3] + "x" + self.exchange.legacy_id[3:]
 
     def entries(self):
         return [
@@ -94,72 +131,96 @@ class ExchangeTx(Transaction):
             [self.buy_amount, -self.sell_amount, -self.fee_amount],
         ]
 
-    def __getattr__(self, attr):
-        return getattr(self.exchange, attr)
-
     def __str__(self):
         return "{} ({}) - EXCH {} {} (USD {}) -> {} {} (USD {})".format(
             self.time.strftime("%Y-%m-%d %H:%M:%S"),
             self.id,
             self.sell_coin,
-            self.sell_amount,
-            round(self.sell_amount * self.sell_fmv, 2),
+            from_units(self.sell_amount),
+            round(from_units(value(self.sell_amount, self.sell_fmv)), 2),
             self.buy_coin,
-            self.buy_amount,
-            round(self.buy_amount * self.buy_fmv, 2),
+            from_units(self.buy_amount),
+            round(from_units(value(self.buy_amount, self.buy_fmv)), 2),
         )
 
     def basis_contribution(self, coin):
-        """Returns tuple of (datetime of tx, number of coins received, cost per coin)
+        """Returns tuple of (datetime of tx, number of coins received, total cost)
         Fees are not added to basis here. They are instead removed from the amount realized of the ExchangeTx"""
         if coin == self.buy_coin:
-            return [self.time, self.buy_amount, self.buy_fmv]
+            return [self.time, self.buy_amount, value(self.buy_amount, self.buy_fmv)]
         else:
             return None
 
     def amount_realized(self, coin):
-        """Returns tuple of (datetime of tx, number of coins exchanged, amount sold per coin net of fees)"""
+        """Returns tuple of (datetime of tx, number of coins exchanged, total amount realized net of fees)"""
         if coin == self.sell_coin:
             fee = max(0, self.fee_usd)  # Ignore the fee if its negative
-            ar_per_coin = ((self.sell_amount * self.sell_fmv) - fee) / self.sell_amount
-            return [self.time, self.sell_amount, ar_per_coin]
+            ar = value(self.sell_amount, self.sell_fmv) - fee
+            return [self.time, self.sell_amount, ar]
         else:
             return None
 
-    @property
-    def fee_usd(self):
-        return self.implied_fee_usd
+    def finalize(self):
+        self.implied_fee_usd = value(self.sell_amount, self.sell_fmv) - value(
+            self.buy_amount, self.buy_fmv
+        )
+        self.fee_usd = self.implied_fee_usd
+
+    def _apply_fmvs(self, fmvs):
+        self.buy_fmv = float(fmvs[self.buy_coin])
+        self.sell_fmv = float(fmvs[self.sell_coin])
 
 
 class FiatExchangeTx(ExchangeTx):
+    __slots__ = ("investing", "redeeming", "rate")
+
+    def __init__(self, exchange):
+        ExchangeTx.__init__(self, exchange)
+        self.investing = exchange.investing
+        self.redeeming = exchange.redeeming
+        self.rate = exchange.rate
+        # All fiat transactions have fmv instrinsic in it.
+        self.missing_fmv = False
     def basis_contribution(self, coin):
-        """Returns tuple of (datetime of tx, number of coins bought, cost per coin including fees)"""
+        """Returns tuple of (datetime of tx, number of coins bought, total cost including fees)"""
         if self.investing:
             assert coin == self.buy_coin
-            cost_per_coin = (self.sell_amount + self.fee_amount) / self.buy_amount
-            return [self.time, self.buy_amount, cost_per_coin]
+            cost = self.sell_amount + self.fee_amount
+            return [self.time, self.buy_amount, cost]
         else:
             return None
 
     def amount_realized(self, coin):
-        """Returns tuple of (datetime of tx, number of coins sold, amount sold per coin net of fees)"""
+        """Returns tuple of (datetime of tx, number of coins sold, total amount realized net of fees)"""
         if self.investing:
             return None
         else:
             assert coin == self.sell_coin
-            ar_per_coin = (self.buy_amount - self.fee_amount) / self.sell_amount
-            return [self.time, self.sell_amount, ar_per_coin]
+            ar = self.buy_amount - self.fee_amount
+            return [self.time, self.sell_amount, ar]
 
     def __str__(self):
         return self.exchange.__str__(self.id)
 
-    @property
-    def fee_usd(self):
-        return self.fee_amount
+    def finalize(self):
+        self.fee_usd = self.fee_amount
 
 
 class SendReceive(Transaction):
+    __slots__ = (
+        "send",
+        "receive",
+        "time",
+        "origin",
+        "destination",
+        "coin",
+        "amount",
+        "implied_fee",
+        "fmv",
+    )
+
     def __init__(self, send, receive):
+        Transaction.__init__(self)
         self.send = send
         self.receive = receive
         self.time = self.send.time  # Time is time of sending
@@ -167,24 +228,29 @@ class SendReceive(Transaction):
         self.destination = self.receive.location
         self.coin = self.send.coin
         self.amount = self.send.amount
-        self.implied_fee = round(self.send.amount - self.receive.amount, 8)
+        self.implied_fee = self.send.amount - self.receive.amount
         self.generate_id()
+        self.affected_coins = _non_usd(self.coin)
 
     def entries(self):
         return (self.coin, -self.fee)
 
     def generate_id(self):
-        # Id is 'srtx-' with last 2 chars of send a '/' and last two chars of recv
-        self.id = "srtx-" + self.send.id[-2:] + "/" + self.receive.id[-2:]
+        # Id is 'srtx-' with last 6 chars of send a '/' and last 6 chars of recv
+        # The legacy id only used the last 2 chars of each
+        self.id = "srtx-" + self.send.id[-6:] + "/" + self.receive.id[-6:]
+        self.legacy_id = (
+            "srtx-" + self.send.legacy_id[-2:] + "/" + self.receive.legacy_id[-2:]
+        )
 
     def __str__(self):
         return "{} ({}) - SENDRECV {} {} (- {} {:f} fee) from {} to {}".format(
             self.time.strftime("%Y-%m-%d %H:%M:%S"),
             self.id,
             self.coin,
-            self.amount,
+            from_units(self.amount),
             self.coin,
-            self.implied_fee,
+            from_units(self.implied_fee),
             self.origin,
             self.destination,
         )
@@ -197,93 +263,126 @@ class SendReceive(Transaction):
         """This takes the position blockchain fees don't trigger any AR."""
         return None
 
-    @property
-    def fee_usd(self):
-        return self.implied_fee * self.fmv
+    def finalize(self):
+        self.implied_fee_usd = value(self.implied_fee, self.fmv)
+        self.fee_usd = self.implied_fee_usd
+
+    def _apply_fmvs(self, fmvs):
+        self.fmv = float(fmvs[self.coin])
 
 
 class Spend(Transaction):
+    __slots__ = ("send", "time", "location", "coin", "amount", "txid", "fmv")
+
     def __init__(self, send):
+        Transaction.__init__(self)
         self.send = send
+        self.time = send.time
+        self.location = send.location
+        self.coin = send.coin
+        self.amount = send.amount
+        self.txid = getattr(send, "txid", None)
+        self.fmv = getattr(send, "fmv", None)
         self.generate_id()
+        self.affected_coins = _non_usd(self.coin)
+        self.missing_fmv = not self.fmv
 
     def generate_id(self):
         # Only change is to make the prefix 4 characters
         self.id = self.send.id[:3] + "x" + self.send.id[3:]
+        self.legacy_id = self.send.legacy_id[:3] + "x" + self.send.legacy_id[3:]
 
     def entries(self):
         return (self.coin, -self.amount)
 
+    def _apply_fmvs(self, fmvs):
+        self.fmv = float(fmvs[self.coin])
+
     def basis_contribution(self, coin):
         """Spending coins does not add to available basis"""
         return None
 
     def amount_realized(self, coin):
-        """Returns tuple of (datetime of tx, number of coins spend, fmv of each coin spent)"""
+        """Returns tuple of (datetime of tx, number of coins spend, fmv of the coins spent)"""
         assert coin == self.coin
         # Make sure fmv exists
-        return [self.time, self.amount, self.fmv]
-
-    def __getattr__(self, attr):
-        return getattr(self.send, attr)
+        return [self.time, self.amount, value(self.amount, self.fmv)]
 
     def __str__(self):
         return "{} ({}) - SPEND {} {} from {}".format(
             self.time.strftime("%Y-%m-%d %H:%M:%S"),
             self.id,
             self.coin,
-            self.amount,
+            from_units(self.amount),
             self.location,
         )
 
 
 class Earn(Transaction):
+    __slots__ = ("receive", "time", "location", "coin", "amount", "txid", "fmv")
+
     def __init__(self, receive):
+        Transaction.__init__(self)
         self.receive = receive
+        self.time = receive.time
+        self.location = receive.location
+        self.coin = receive.coin
+        self.amount = receive.amount
+        self.txid = getattr(receive, "txid", None)
+        self.fmv = getattr(receive, "fmv", None)
         self.generate_id()
+        self.affected_coins = _non_usd(self.coin)
+        self.missing_fmv = not self.fmv
 
     def generate_id(self):
         # Only change is to make the prefix 4 characters
         self.id = self.receive.id[:3] + "x" + self.receive.id[3:]
+        self.legacy_id = self.receive.legacy_id[:3] + "x" + self.receive.legacy_id[3:]
 
     def entries(self):
         return (self.coin, self.amount)
 
+    def _apply_fmvs(self, fmvs):
+        self.fmv = float(fmvs[self.coin])
+
     def basis_contribution(self, coin):
         """Earning coins triggers income tax and you get a corresponding basis"""
-        return self.amount
+        return [self.time, self.amount, value(self.amount, self.fmv)]
 
     def amount_realized(self, coin):
         """No amount realized for cap gains purposes when you earn crypto"""
         return None
 
-    def __getattr__(self, attr):
-        return getattr(self.receive, attr)
-
     def __str__(self):
         return "{} ({}) - EARN {} {} by {}".format(
             self.time.strftime("%Y-%m-%d %H:%M:%S"),
             self.id,
             self.coin,
-            self.amount,
+            from_units(self.amount),
             self.location,
         )
 
-    @property
-    def fee_usd(self):
-        return 0.00
-
 
 class Shapeshift(Transaction):
+    __slots__ = ("send", "receive", "time", "send_fmv", "receive_fmv")
+
     def __init__(self, send, receive):
+        Transaction.__init__(self)
         self.send = send
         self.receive = receive
         self.time = self.send.time  # Time is time of sending
+        self.send_fmv = getattr(send, "fmv", None)
+        self.receive_fmv = getattr(receive, "fmv", None)
         self.generate_id()
+        self.affected_coins = _non_usd(send.coin, receive.coin)
 
     def generate_id(self):
-        # Id is 'shax-' with last 2 chars of send a '/' and last two chars of recv
-        self.id = "shax-" + self.send.id[-2:] + "/" + self.receive.id[-2:]
+        # Id is 'shax-' with last 6 chars of send a '/' and last 6 chars of recv
+        # The legacy id only used the last 2 chars of each
+        self.id = "shax-" + self.send.id[-6:] + "/" + self.receive.id[-6:]
+        self.legacy_id = (
+            "shax-" + self.send.legacy_id[-2:] + "/" + self.receive.legacy_id[-2:]
+        )
 
     def entries(self):
         return [
@@ -296,38 +395,48 @@ class Shapeshift(Transaction):
             self.time.strftime("%Y-%m-%d %H:%M:%S"),
             self.id,
             self.send.coin,
-            self.send.amount,
-            round(self.send.amount * self.send.fmv, 2),
+            from_units(self.send.amount),
+            round(from_units(value(self.send.amount, self.send_fmv)), 2),
             self.send.location,
             self.receive.coin,
-            self.receive.amount,
-            round(self.receive.amount * self.receive.fmv, 2),
+            from_units(self.receive.amount),
+            round(from_units(value(self.receive.amount, self.receive_fmv)), 2),
             self.receive.location,
         )
 
     def basis_contribution(self, coin):
-        """Returns tuple of (datetime of tx, number of coins received, cost per coin)
+        """Returns tuple of (datetime of tx, number of coins received, total cost)
         Fees are not added to basis here. They are instead removed from the amount realized of the Shapeshift"""
         if coin == self.receive.coin:
-            return [self.time, self.receive.amount, self.receive.fmv]
+            return [
+                self.time,
+                self.receive.amount,
+                value(self.receive.amount, self.receive_fmv),
+            ]
         else:
             return None
 
     def amount_realized(self, coin):
-        """Returns tuple of (datetime of tx, number of coins exchanged, amount sold per coin net of fees)"""
+        """Returns tuple of (datetime of tx, number of coins exchanged, total amount realized net of fees)"""
         if coin == self.send.coin:
             fee = max(0, self.fee_usd)  # Ignore the fee if its negative
-            ar_per_coin = ((self.send.amount * self.send.fmv) - fee) / self.send.amount
-            return [self.time, self.send.amount, ar_per_coin]
+            ar = value(self.send.amount, self.send_fmv) - fee
+            return [self.time, self.send.amount, ar]
         else:
             return None
 
-    @property
-    def fee_usd(self):
-        return self.implied_fee_usd
+    def finalize(self):
+        self.implied_fee_usd = value(self.send.amount, self.send_fmv) - value(
+            self.receive.amount, self.receive_fmv
+        )
+        self.fee_usd = self.implied_fee_usd
 
+    def _apply_fmvs(self, fmvs):
+        self.send_fmv = float(fmvs[self.send.coin])
+        self.receive_fmv = float(fmvs[self.receive.coin])
 
-def get_transactions(events, tx_data_file):
+
+def get_transactions(events, tx_data_file, partial=False):
     """Convert a list of events into a list of transactions using
     the data in the tx_data_file.
 
@@ -335,6 +444,8 @@ def get_transactions(events, tx_data_file):
        events: list of events to parse
        tx_data_file: File containing matching data (for SendReceive) and
            Shapeshift data
+       partial: events are only part of the ledger (e.g., one year's partition)
+           so skip pairs whose events aren't present
 
     Returns:
         List of transactions, sorted by time.
@@ -342,55 +453,43 @@ def get_transactions(events, tx_data_file):
     all_transactions = []
 
     tx_data = yaml.load(open(tx_data_file))
+    aliases = build_aliases(events)
+    remaining = set(events)
 
-    # Send Receive Pairs
-    sendreceive_pairs = tx_data.pop("SendReceive")
-    for sendreceive_pair in sendreceive_pairs:
-        send_id, receive_id = sendreceive_pair.split()
+    def in_events(pair):
+        return not partial or all(id in aliases for id in pair.split())
 
-        # Pop the appropriate Send and Receive events from the events array
+    def pop_event(event_id, typ):
+        # Pop the event from the remaining events
         # Also error check for bad ids in the tx file
         try:
-            send = next(filter(lambda x: x.id == send_id, events))
-            assert send.__class__.__name__ == "Send"
-            events.remove(send)
-        except (StopIteration, AssertionError):
-            raise Exception("Bad event id: {}".format(send_id))
-
-        try:
-            receive = next(filter(lambda x: x.id == receive_id, events))
-            events.remove(receive)
-            assert receive.__class__.__name__ == "Receive"
-        except (StopIteration, AssertionError):
-            raise Exception("Bad event id: {}".format(receive_id))
+            event = lookup(aliases, event_id)
+            assert event.__class__.__name__ == typ
+            remaining.remove(event)
+        except (KeyError, AssertionError):
+            raise Exception("Bad event id: {}".format(event_id))
+        return event
 
+    # Send Receive Pairs
+    sendreceive_pairs = tx_data.pop("SendReceive")
+    for sendreceive_pair in filter(in_events, sendreceive_pairs):
+        send_id, receive_id = sendreceive_pair.split()
+        send = pop_event(send_id, "Send")
+        receive = pop_event(receive_id, "Receive")
         sendreceive = SendReceive(send, receive)
         all_transactions.append(sendreceive)
 
     # Shapeshift Pairs
     sendreceive_pairs = tx_data.pop("Shapeshift")
-    for sendreceive_pair in sendreceive_pairs:
+    for sendreceive_pair in filter(in_events, sendreceive_pairs):
         send_id, receive_id = sendreceive_pair.split()
-
-        # Pop the appropriate Send and Receive events from the events array
-        # Also error check for bad ids in the tx file
-        try:
-            send = next(filter(lambda x: x.id == send_id, events))
-            assert send.__class__.__name__ == "Send"
-            events.remove(send)
-        except (StopIteration, AssertionError):
-            raise Exception("Bad event id: {}".format(send_id))
-
-        try:
-            receive = next(filter(lambda x: x.id == receive_id, events))
-            events.remove(receive)
-            assert receive.__class__.__name__ == "Receive"
-        except (StopIteration, AssertionError):
-            raise Exception("Bad event id: {}".format(receive_id))
-
+        send = pop_event(send_id, "Send")
+        receive = pop_event(receive_id, "Receive")
         shapeshift = Shapeshift(send, receive)
         all_transactions.append(shapeshift)
 
+    events = [event for event in events if event in remaining]
+
     # Spend Txs
     spend_events = [event for event in events if event.__class__.__name__ == "Send"]
     for event in spend_events:
@@ -425,19 +524,140 @@ def get_transactions(events, tx_data_file):
     # There should be no events left
     assert len(events) == 0
 
+    # Confirm all transactions have a unique id
+    seen = set()
+    for tx in all_transactions:
+        if tx.id in seen:
+            raise Exception("Duplicate transaction id: {}".format(tx.id))
+        seen.add(tx.id)
+
     # Sort all transactions by time
     all_transactions.sort(key=lambda x: x.time)
     return all_transactions
 
 
-def annotate_transactions(transactions, tx_annotation_file):
-    """Annotate transactions with information in an annotation file."""
+def propose_matches(
+    events, tx_data_file, tolerance=0.01, window=24, usd_tolerance=0.05
+):
+    """Propose SendReceive and Shapeshift pairs for the Send and Receive
+    events that are not yet matched in the tx_data_file.
+
+    Args:
+       events: list of events to match
+       tx_data_file: File containing existing matching data
+       tolerance: Largest fraction of the sent amount a receive may be short by
+       window: Hours after a send within which the receive must happen
+       usd_tolerance: Largest fractional USD value difference for a Shapeshift
+
+    Returns:
+        Dict of 'SendReceive' and 'Shapeshift' lists of (send, receive, reason).
+    """
+    try:
+        tx_data = yaml.load(open(tx_data_file)) or {}
+    except FileNotFoundError:
+        tx_data = {}
+    aliases = build_aliases(events)
+    matched = set()
+    for typ in ("SendReceive", "Shapeshift"):
+        for pair in tx_data.get(typ, []):
+            for id in pair.split():
+                try:
+                    matched.add(lookup(aliases, id).id)
+                except KeyError:
+                    raise Exception(
+                        "Bad event id: {} in {} pair '{}'".format(id, typ, pair)
+                    )
+
+    sends = [
+        ev for ev in events if ev.__class__.__name__ == "Send" and ev.id not in matched
+    ]
+    receives = [
+        ev
+        for ev in events
+        if ev.__class__.__name__ == "Receive" and ev.id not in matched
+    ]
+    proposals = {"SendReceive": [], "Shapeshift": []}
+    used = set()
+
+    # Exact hash join on the on-chain transaction id
+    receives_by_txid = {}
+    for receive in receives:
+        if getattr(receive, "txid", None):
+            receives_by_txid.setdefault((receive.coin, receive.txid), []).append(
+                receive
+            )
+    for send in sends:
+        candidates = receives_by_txid.get((send.coin, getattr(send, "txid", None)))
+        if not candidates:
+            continue
+        receive = candidates.pop(0)
+        proposals["SendReceive"].append((send, receive, "txid"))
+        used.update((send.id, receive.id))
+
+    sends = [ev for ev in sends if ev.id not in used]
+    receives = [ev for ev in receives if ev.id not in used]
+    window = datetime.timedelta(hours=window)
+
+    # Sorted sweep by coin: a receive must land within the window after the
+    # send and be short of the sent amount by no more than the tolerance
+    receives_by_coin = {}
+    for receive in sorted(receives, key=lambda x: x.time):
+        receives_by_coin.setdefault(receive.coin, []).append(receive)
+    times_by_coin = {
+        coin: [ev.time for ev in evs] for coin, evs in receives_by_coin.items()
+    }
+    for send in sorted(sends, key=lambda x: x.time):
+        coin_receives = receives_by_coin.get(send.coin, [])
+        times = times_by_coin.get(send.coin, [])
+        start = bisect.bisect_left(times, send.time)
+        end = bisect.bisect_right(times, send.time + window)
+        for receive in coin_receives[start:end]:
+            if receive.id in used:
+                continue
+            if send.amount * (1 - tolerance) <= receive.amount <= send.amount:
+                proposals["SendReceive"].append((send, receive, "sweep"))
+                used.update((send.id, receive.id))
+                break
+
+    # Cross-coin Shapeshift candidates, compared by USD value
+    sends = [ev for ev in sends if ev.id not in used and getattr(ev, "fmv", None)]
+    receives = sorted(
+        (ev for ev in receives if ev.id not in used and getattr(ev, "fmv", None)),
+        key=lambda x: x.time,
+    )
+    times = [ev.time for ev in receives]
+    for send in sorted(sends, key=lambda x: x.time):
+        send_usd = send.amount * send.fmv
+        if send_usd == 0:
+            continue
+        best = None
+        start = bisect.bisect_left(times, send.time)
+        end = bisect.bisect_right(times, send.time + window)
+        for receive in receives[start:end]:
+            if receive.id in used or receive.coin == send.coin:
+                continue
+            diff = abs(send_usd - receive.amount * receive.fmv) / send_usd
+            if diff <= usd_tolerance and (best is None or diff < best[0]):
+                best = (diff, receive)
+        if best:
+            proposals["Shapeshift"].append((send, best[1], "usd"))
+            used.update((send.id, best[1].id))
+
+    return proposals
+
+
+def annotate_transactions(transactions, tx_annotation_file, partial=False):
+    """Annotate transactions with information in an annotation file.
+    If the transactions are only part of the ledger, unknown ids are skipped."""
     annotations = yaml.load(open(tx_annotation_file))
+    aliases = build_aliases(transactions)
 
     for ann_id, ann_data in annotations.items():
+        if partial and ann_id not in aliases:
+            continue
         try:
-            (tx,) = [tx for tx in transactions if tx.id == ann_id]
-        except ValueError:
+            tx = lookup(aliases, ann_id)
+        except KeyError:
             raise Exception("Bad annotation id: " + ann_id)
 
         related_txids = ann_data.get("related", [])
@@ -449,10 +669,14 @@ def annotate_transactions(transactions, tx_annotation_file):
         tx.annotated = True
 
         for rid in related_txids:
+            if partial and rid not in aliases:
+                continue
             try:
-                (rtx,) = [tx for tx in transactions if tx.id == rid]
-            except ValueError:
-                raise Exception("Bad annotation id: " + rid)
+                rtx = lookup(aliases, rid)
+            except KeyError:
+                raise Exception(
+                    "Bad annotation id: {} related to {}".format(rid, ann_id)
+                )
 
             rtx.notes = notes
             rtx.groups = groups
@@ -475,41 +699,25 @@ def fmv_transactions(transactions, tx_fmv_file):
         fmvs["comment"] = comment
         fmv_data[id] = fmvs
 
+    # Key the fmv data by transaction, whether stored under a current or legacy id
+    aliases = build_aliases(transactions)
+    fmv_data = {aliases.get(id): fmvs for id, fmvs in fmv_data.items()}
     for tx in transactions:
         if not tx.missing_fmv:
             continue
         try:
-            fmvs = fmv_data[tx.id]
+            fmvs = fmv_data[tx]
         except KeyError:
             raise RuntimeError(f"{tx.id} missing fmv information. Run updatefmv?")
         fmvs.pop("comment")
-
-        if hasattr(tx, "coin"):
-            tx.fmv = float(fmvs[tx.coin])
-        elif hasattr(tx, "buy_coin"):
-            tx.buy_fmv = float(fmvs[tx.buy_coin])
-            tx.sell_fmv = float(fmvs[tx.sell_coin])
-        else:
-            # It's a shapeshift
-            tx.send.fmv = float(fmvs[tx.send.coin])
-            tx.receive.fmv = float(fmvs[tx.receive.coin])
+        tx.set_fmvs(fmvs)
 
     return transactions
 
 
 def imply_fees(transactions):
-    """Imply the USD fees in Shapeshift or Exchange types based on fmv of the exchanged"""
+    """Imply the USD fees in Shapeshift or Exchange types based on fmv of the exchanged
+    and finalize the USD fee of every transaction"""
     for tx in transactions:
-        if tx.__class__.__name__ == "ExchangeTx":
-            tx.implied_fee_usd = (tx.sell_amount * tx.sell_fmv) - (
-                tx.buy_amount * tx.buy_fmv
-            )
-            tx.implied_fee_usd = round(tx.implied_fee_usd, 2)
-        if tx.__class__.__name__ == "Shapeshift":
-            tx.implied_fee_usd = (tx.send.amount * tx.send.fmv) - (
-                tx.receive.amount * tx.receive.fmv
-            )
-            tx.implied_fee_usd = round(tx.implied_fee_usd, 2)
-        if tx.__class__.__name__ == "SendReceive":
-            tx.implied_fee_usd = tx.implied_fee * tx.fmv
+        tx.finalize()
     return transactions
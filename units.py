@@ -0,0 +1,36 @@
+from decimal import Decimal, ROUND_HALF_EVEN
+
+# All coin amounts and USD values are held as integer base units of 1e-8,
+# i.e., satoshis for coins and 1e-8 dollars for USD. Prices (fmvs) stay as
+# floats in USD per coin and only meet amounts through value().
+UNIT = 10 ** 8
+
+
+def to_units(amount):
+    """Convert a coin or USD amount (float, int, str or Decimal) to base units.
+    Floats are converted through their shortest repr so 0.1 becomes exactly 10000000."""
+    if amount is None:
+        return None
+    if type(amount) == float:
+        amount = repr(amount)
+    return int((Decimal(amount) * UNIT).to_integral_value(ROUND_HALF_EVEN))
+
+
+def from_units(units):
+    """Convert base units back to a float amount for display"""
+    if units is None:
+        return None
+    return units / UNIT
+
+
+def value(units, price):
+    """USD value, in base units, of `units` of a coin worth `price` USD per coin"""
+    return int(round(units * price))
+
+
+def split(total, part, whole):
+    """Share of the integer `total` attributable to `part` out of `whole`.
+    Taking successive shares and subtracting them from the total never loses a unit."""
+    if part == whole:
+        return total
+    return (total * part + whole // 2) // whole
@@ -0,0 +1,162 @@
+"""Rerun a command whenever the portfolio's files change.
+
+Changes are noticed through inotify where the C library provides it, and by
+polling modification times otherwise. Either way the directories are
+compared against a snapshot of the files' modification times and sizes, so
+editors that save by writing a new file and renaming it over the old one are
+handled the same as ones that write in place.
+"""
+import ctypes
+import ctypes.util
+import datetime
+import difflib
+import io
+import os
+import select
+import time
+from contextlib import redirect_stdout
+
+# Seconds between scans when polling
+POLL_INTERVAL = 1.0
+# Seconds to wait for an editor to finish saving before rescanning
+SETTLE_TIME = 0.2
+
+# inotify(7) event masks
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+)
+
+
+def _ignored(name):
+    """Editor swap and backup files and partial writes"""
+    return name.startswith(".") or name.endswith(("~", ".swp", ".tmp"))
+
+
+def _inotify(directories):
+    """Return a non-blocking inotify file descriptor watching the directories,
+    or None if inotify isn't available"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    for directory in directories:
+        if libc.inotify_add_watch(fd, os.fsencode(directory), WATCH_MASK) < 0:
+            os.close(fd)
+            return None
+    return fd
+
+
+class Watcher(object):
+    """Wait for files in a set of directories to change"""
+
+    def __init__(self, directories):
+        self.directories = sorted(set(directories))
+        self.fd = _inotify(self.directories)
+        self.snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        for directory in self.directories:
+            try:
+                names = os.listdir(directory)
+            except FileNotFoundError:
+                continue
+            for name in names:
+                path = os.path.join(directory, name)
+                if _ignored(name) or not os.path.isfile(path):
+                    continue
+                stat = os.stat(path)
+                snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def _drain(self):
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+
+    def wait(self):
+        """Block until some files change and return their paths"""
+        while True:
+            if self.fd is None:
+                time.sleep(POLL_INTERVAL)
+            else:
+                select.select([self.fd], [], [])
+                time.sleep(SETTLE_TIME)
+                self._drain()
+            snapshot = self._scan()
+            changed = [
+                path
+                for path in sorted(set(snapshot) | set(self.snapshot))
+                if snapshot.get(path) != self.snapshot.get(path)
+            ]
+            self.snapshot = snapshot
+            if changed:
+                return changed
+
+
+def _capture(render):
+    output = io.StringIO()
+    with redirect_stdout(output):
+        render()
+    return output.getvalue()
+
+
+def watch(pipeline, render, directories):
+    """Print what render() prints, then watch the directories and, after each
+    change, recompute only the pipeline stages that read the changed files and
+    print a diff of render()'s output. Runs until interrupted."""
+    watcher = Watcher(directories)
+    previous = _capture(render)
+    print(previous, end="")
+    print(f"Watching {', '.join(watcher.directories)} (Ctrl-C to stop)")
+    if watcher.fd is None:
+        print(f"inotify isn't available, polling every {POLL_INTERVAL:g}s")
+
+    try:
+        while True:
+            changed = watcher.wait()
+            stages = pipeline.invalidate(changed)
+            names = ", ".join(os.path.basename(path) for path in changed)
+            now = datetime.datetime.now().strftime("%H:%M:%S")
+            if not stages:
+                print(f"\n[{now}] {names} changed, nothing to recompute")
+                continue
+            print(f"\n[{now}] {names} changed, recomputing {', '.join(stages)}")
+            try:
+                output = _capture(render)
+            except Exception as e:
+                # Likely a file saved halfway through an edit. The stage that
+                # failed stays dropped and is retried after the next change.
+                print(f"Error: {e}")
+                continue
+            diff = list(
+                difflib.unified_diff(
+                    previous.splitlines(),
+                    output.splitlines(),
+                    "before",
+                    "after",
+                    lineterm="",
+                )
+            )
+            print("\n".join(diff) if diff else "No change in output")
+            previous = output
+    except KeyboardInterrupt:
+        pass